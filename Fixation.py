@@ -9,39 +9,25 @@ Simply shows a fixation cross for a set amount of time
 """
 
 # import necessary libraries & functions
-from psychopy import visual, core, event
+import engine  # runs the protocol: window, fixation cross and data files
 
 ######################
 #  CHANGE PARAMETERS #
 ######################
 RestDuration = 600  
 end_exp_key = 'escape'
+non_slip = True  # True = keep every phase on time from the trigger, skipping frames after a dropped one
+physio_source = ''  # stream to record end-tidal CO2/O2 from, e.g. 'serial:COM3:9600' (see physio_stream.py)
+physio_delay = 0  # seconds the gas sampling line delays the end-tidal signal
+dashboard_port = 0  # show the run to the operator at http://localhost:<port>, e.g. 8000 (0 = off)
+simulate = False  # True = run headless on a virtual clock, with scripted keys
 
 #######
 # RUN #
 #######
 
-globalClock = core.Clock()  # to track the time since experiment started
-
-# Set-up the Window
-win = visual.Window(
-    size=(1440, 900), fullscr=True, screen=0,
-    allowGUI=False, allowStencil=False,
-    monitor='testMonitor', color=[0, 0, 0], colorSpace='rgb',
-    blendMode='avg', useFBO=True)
-
-# Display Fixation
-rest = visual.TextStim(win=win, name='rest',
-                       text=u'+',
-                       font=u'Arial',
-                       pos=(0, 0), height=0.5, wrapWidth=None, ori=0,
-                       color=u'white', colorSpace='rgb', opacity=1,
-                       alignHoriz='center', depth=0.0)
-
-rest.draw()
-win.flip()
-event.waitKeys(maxWait=RestDuration, keyList=['escape'], timeStamped=False)
-
-# make sure everything is closed down
-win.close()
-core.quit()
+# The task itself is described in protocols/Fixation.json - the parameters above (or given on the command line, see
+# startup.py) fill it in
+protocolName = 'Fixation.json'
+if __name__ == '__main__':  # not when read by a session (see Run_Session.py)
+    engine.run_script(globals(), protocolName)
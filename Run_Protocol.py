@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run Protocol
+
+Runs any task described by a protocol file (see engine.py for what goes in one), so a new design does not need a
+new script. Give the task parameters the protocol uses in its own "parameters" block, or on the command line:
+
+    python Run_Protocol.py --protocol my_design.json --participant P01 tHold=15
+
+"""
+
+# import necessary libraries & functions
+import engine  # runs the protocol: window, stimuli, trigger, rest blocks, trials and data files
+
+######################
+#  CHANGE PARAMETERS #
+######################
+protocolName = ''  # protocol in the protocols folder to run, if none is given with --protocol
+end_exp_key = 'escape'
+non_slip = True  # True = keep every phase on time from the trigger, skipping frames after a dropped one
+profile_frames = False  # True = time each stage of every frame, to find what makes frames drop
+dashboard_port = 0  # show the run to the operator at http://localhost:<port>, e.g. 8000 (0 = off)
+simulate = False  # True = run headless on a virtual clock, with scripted keys and trigger
+
+#######
+# RUN #
+#######
+
+if __name__ == '__main__':
+    engine.run_script(globals(), protocolName)
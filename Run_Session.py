@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run Session
+
+Runs several tasks one after another in the same full-screen window (see session.py), e.g. a resting fixation
+block, then Breath_Hold, then Cued_Deep_Breathing. Each task uses the parameters in its own script, and saves its
+own data files; the session keeps one log file.
+
+    python Run_Session.py --participant P01 trialnum=2
+
+A name=value change on the command line applies to every task with that parameter.
+
+"""
+
+# import necessary libraries & functions
+import session  # runs the tasks in one window
+
+######################
+#  CHANGE PARAMETERS #
+######################
+tasks = ['Fixation.py', 'Breath_Hold.py', 'Cued_Deep_Breathing.py']  # task scripts, in the order they are run
+dashboard_port = 0  # show the run to the operator at http://localhost:<port>, e.g. 8000 (0 = off)
+simulate = False  # True = run headless on a virtual clock, with scripted keys and trigger
+
+#######
+# RUN #
+#######
+
+if __name__ == '__main__':
+    session.run_session(globals())
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark Timing
+
+Measures how far the phase onsets of a task land from the ideal schedule, over a grid of task parameters and
+simulated displays. Every run is the real task (engine.run_task) on the virtual clock of simulation.py, so the
+whole grid runs in seconds. Displays are simulated at each frame rate, with and without flip jitter and dropped
+frames (seeded, so every run of the benchmark gives the same numbers).
+
+    python benchmark_timing.py
+    python benchmark_timing.py --task Breath_Hold.py tHold=15,18,21 trialnum=1,5 --frame-rates 60 144
+
+Prints one line per run and saves every phase of every run to benchmark_timing.tsv: onset error (flip time minus
+planned time, ms) for the phase's onsets - mean, largest, and at its last onset - and the frames dropped. The
+'all' row of a run is the whole run; its last onset error is how far the schedule has slipped by the end.
+
+"""
+
+from __future__ import absolute_import, division
+from psychopy import data, logging
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import engine  # runs the task
+import frame_log  # dropped frames and onset error per phase
+import startup  # turns name=value strings into parameters
+import task_protocol  # reads each task script, and fills in and checks its protocol
+
+FRAME_RATES = [60, 75, 120, 144]
+# (flip jitter in seconds, chance of a dropped frame per flip) of each simulated display
+DISPLAYS = [(0.0, 0.0), (0.002, 0.0), (0.002, 0.01)]
+# task parameters swept by default, for each task script
+DEFAULT_GRID = {'Breath_Hold.py': {'tBreathPace': [4, 6], 'tHold': [15, 18], 'trialnum': [1, 3]},
+                'Cued_Deep_Breathing.py': {'tCDBPace': [2, 4], 'trialnum': [1, 3]}}
+SEED = 1
+
+
+def grid_points(grid):
+    """Every combination of the parameter values in grid ({name: [values]}), as dicts"""
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def known_parameters(taskScript, scriptDir):
+    """Names of the parameters a task script can be given: its own, and the ones its protocol uses"""
+    namespace = task_protocol.read_task(os.path.join(scriptDir, taskScript))
+    protocol, parameters = task_protocol.load_task(namespace, os.path.join(scriptDir, 'protocols',
+                                                                           namespace['protocolName']))
+    return set(parameters) | task_protocol.protocol_parameters(protocol)
+
+
+def run_once(protocol, frameRate, flipJitter, dropRate, workDir, seed=SEED):
+    """Run a (filled in) protocol on a simulated display, returning its FrameLog"""
+    psy = engine.Modules(simulate=True, frameRate=frameRate, flipJitter=flipJitter, dropRate=dropRate, seed=seed)
+    win, measuredRate, frameDur = engine.open_window(psy)
+    filename = os.path.join(workDir, 'benchmark')
+    thisExp = data.ExperimentHandler(name='benchmark', version='', extraInfo={}, runtimeInfo=None,
+                                     originPath=None, savePickle=False, saveWideText=False,
+                                     dataFileName=filename)
+    completed, frameLog = engine.run_task(psy, win, frameDur, protocol, thisExp, filename, quiet=True)
+    thisExp.abort()
+    return frameLog
+
+
+def onset_errors(frameLog):
+    """
+    Per phase (and for the whole run): number of onsets, mean, largest and last onset error, and frames dropped
+    """
+    errors = {}
+    phases = []
+    for flipTime, frameN, trial, phase in frameLog.onsets():
+        if phase not in errors:
+            phases.append(phase)
+            errors[phase] = []
+        errors[phase].append(flipTime - frameLog.planned_time(frameN))
+    errors['all'] = [flipTime - frameLog.planned_time(frameN) for flipTime, frameN, trial, phase in frameLog.onsets()]
+    dropped = dict((row['phase'], row['dropped']) for row in frameLog.summary())
+
+    rows = []
+    for phase in phases + ['all']:
+        phaseErrors = errors[phase]
+        rows.append({'phase': phase,
+                     'onsets': len(phaseErrors),
+                     'onset_error_mean': sum(phaseErrors) / len(phaseErrors) if phaseErrors else None,
+                     'onset_error_max': max(phaseErrors, key=abs) if phaseErrors else None,
+                     'onset_error_last': phaseErrors[-1] if phaseErrors else None,
+                     'dropped': dropped.get(phase, 0)})
+    return rows
+
+
+def benchmark(tasks, frameRates=FRAME_RATES, displays=DISPLAYS, scriptDir=None, outFile='benchmark_timing.tsv'):
+    """
+    Run every task script in tasks ({script: grid}) over its parameter grid, on every frame rate and display.
+    Returns the result rows (also saved to outFile)
+    """
+    scriptDir = scriptDir or os.path.dirname(os.path.abspath(__file__))
+    workDir = tempfile.mkdtemp(prefix='benchmark_timing_')
+    logging.console.setLevel(logging.ERROR)  # each run's drift warning would bury the results
+    columns = ['task', 'frame_rate', 'flip_jitter_ms', 'drop_rate', 'parameters', 'phase', 'onsets',
+               'onset_error_mean_ms', 'onset_error_max_ms', 'onset_error_last_ms', 'dropped']
+    results = []
+    try:
+        for taskScript in sorted(tasks):
+            namespace = task_protocol.read_task(os.path.join(scriptDir, taskScript))
+            protocolFile = os.path.join(scriptDir, 'protocols', namespace['protocolName'])
+            for point in grid_points(tasks[taskScript]):
+                protocol, parameters = task_protocol.load_task(namespace, protocolFile)
+                startup.apply_parameters(parameters, point, task_protocol.protocol_parameters(protocol))
+                protocol = task_protocol.resolve(protocol, parameters)
+                errors = task_protocol.check_protocol(protocol)
+                pointName = ' '.join('%s=%s' % (name, point[name]) for name in sorted(point))
+                if errors:
+                    print('%s %s skipped: %s' % (taskScript, pointName, '; '.join(errors)))
+                    continue
+                for frameRate, (flipJitter, dropRate) in itertools.product(frameRates, displays):
+                    frameLog = run_once(protocol, frameRate, flipJitter, dropRate, workDir)
+                    rows = onset_errors(frameLog)
+                    for row in rows:
+                        results.append(dict(row, task=taskScript, frame_rate=frameRate, flip_jitter=flipJitter,
+                                            drop_rate=dropRate, parameters=pointName))
+                    total = rows[-1]
+                    print('%-24s %-40s %3i Hz jitter %4.1f ms drop %.3f: onset error mean %s ms, max %s ms, '
+                          'at end %s ms, %i dropped'
+                          % (taskScript, pointName, frameRate, flipJitter * 1000, dropRate,
+                             frame_log._ms(total['onset_error_mean']), frame_log._ms(total['onset_error_max']),
+                             frame_log._ms(total['onset_error_last']), total['dropped']))
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    with open(outFile, 'w') as resultFile:
+        resultFile.write('\t'.join(columns) + '\n')
+        for row in results:
+            resultFile.write('%s\t%i\t%.1f\t%.4f\t%s\t%s\t%i\t%s\t%s\t%s\t%i\n' % (
+                row['task'], row['frame_rate'], row['flip_jitter'] * 1000, row['drop_rate'], row['parameters'],
+                row['phase'], row['onsets'], frame_log._ms(row['onset_error_mean']),
+                frame_log._ms(row['onset_error_max']), frame_log._ms(row['onset_error_last']), row['dropped']))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--task', action='append', help='task script to benchmark (default: %s)'
+                        % ', '.join(sorted(DEFAULT_GRID)))
+    parser.add_argument('--frame-rates', type=float, nargs='+', default=FRAME_RATES, help='display rates in Hz')
+    parser.add_argument('--out', default='benchmark_timing.tsv', help='file to save the results to')
+    parser.add_argument('grid', nargs='*', metavar='name=v1,v2,...', help='parameter values to sweep')
+    args = parser.parse_args(argv)
+
+    grid = {}
+    for item in args.grid:
+        if '=' not in item:
+            parser.error('parameters must be given as name=v1,v2,..., not ' + item)
+        name, values = item.split('=', 1)
+        grid[name] = values.split(',')
+    tasks = dict((taskScript, dict(DEFAULT_GRID.get(taskScript, {}))) for taskScript in args.task or DEFAULT_GRID)
+    # each name=values goes to the tasks that have that parameter, and has to be one of at least one task
+    scriptDir = os.path.dirname(os.path.abspath(__file__))
+    used = set()
+    for taskScript in tasks:
+        known = known_parameters(taskScript, scriptDir)
+        taskGrid = dict((name, values) for name, values in grid.items() if name in known)
+        tasks[taskScript].update(taskGrid)
+        used.update(taskGrid)
+    unknown = [name for name in grid if name not in used]
+    if unknown:
+        parser.error('unknown parameter: ' + ', '.join(unknown))
+    benchmark(tasks, args.frame_rates, outFile=args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+BIDS Events
+
+Builds the event timeline of a task from its parameters, without running it: a BIDS events.tsv (with its JSON
+sidecar) and the block and HRF-convolved regressors of every phase, sampled once per volume (TR) or at the rate of
+the physiological recordings. Everything is computed on whole arrays with NumPy - no per-sample loops - so a whole
+study's worth of runs takes seconds.
+Onsets are in seconds from the scanner trigger (the first volume), as BIDS expects.
+
+    python bids_events.py Breath_Hold.py --out sub-01_task-breathhold
+    python bids_events.py Cued_Deep_Breathing.py trialnum=3 --out sub-01_task-cdb --physio-rate 1000
+
+"""
+
+from __future__ import absolute_import, division
+from collections import namedtuple
+import argparse
+import gzip
+import json
+import math
+import os
+import numpy as np
+
+# Event timeline of a run, one entry per event: onset and duration in seconds, trial_type = phase name ('rest' for a
+# rest block), trial = trial number (-1 for a rest block)
+Events = namedtuple('Events', ['onset', 'duration', 'trial_type', 'trial'])
+
+MICROTIME_RATE = 10.0  # Hz - regressors sampled slower than this (e.g. once per volume) are convolved this finely
+
+_kernels = {}  # HRF kernels already sampled, by sampling interval and length
+
+
+def design(protocol, frameDur=None):
+    """
+    The designed events of a (filled in) protocol. With frameDur, onsets are placed on the frame the frame plan
+    shows them on (see frame_plan.compile_plan), otherwise at their ideal times
+    """
+    phases = protocol.get('phases', [])
+    trialnum = protocol.get('trialnum', 0)
+    doRest = protocol.get('doRest', 0)
+    restStart = protocol.get('tResting_start', 0) if doRest in [1, 3] else 0
+    restEnd = protocol.get('tResting_end', 0) if doRest in [2, 3] else 0
+
+    # ideal onset of every phase of every trial, from the start of the first trial: trials x phases
+    durations = np.array([phase['duration'] for phase in phases], dtype=float)
+    trialOnsets = np.concatenate([[0.0], np.cumsum(durations)[:-1]])
+    onsets = (np.arange(trialnum)[:, None] * durations.sum() + trialOnsets[None, :]).ravel()
+    offsets = onsets + np.tile(durations, trialnum)
+    if frameDur is not None:
+        onsets = np.round(onsets / frameDur) * frameDur
+        offsets = np.round(offsets / frameDur) * frameDur
+        restStart = round(restStart / frameDur) * frameDur
+    onsets += restStart
+    offsets += restStart
+    names = np.tile(np.array([phase['name'] for phase in phases], dtype=object), trialnum)
+    trials = np.repeat(np.arange(trialnum), len(phases))
+
+    # rest blocks before and after the trials
+    trialsEnd = offsets[-1] if len(offsets) else restStart
+    if restStart:
+        onsets, offsets = np.concatenate([[0.0], onsets]), np.concatenate([[restStart], offsets])
+        names, trials = np.concatenate([['rest'], names]), np.concatenate([[-1], trials])
+    if restEnd:
+        onsets, offsets = np.concatenate([onsets, [trialsEnd]]), np.concatenate([offsets, [trialsEnd + restEnd]])
+        names, trials = np.concatenate([names, ['rest']]), np.concatenate([trials, [-1]])
+    return Events(onsets, offsets - onsets, names.astype(object), trials)
+
+
+def describe_phases(protocol):
+    """What each trial_type is, for the events sidecar"""
+    levels = {'rest': 'Rest: fixation cross'}
+    for phase in protocol.get('phases', []):
+        if phase.get('text') is not None:
+            levels[phase['name']] = 'Text shown: ' + ' '.join(phase['text'].split())
+        else:
+            levels[phase['name']] = 'IN / OUT cued breathing, one breath every %g s' % phase['breathPace']
+    return levels
+
+
+def write_events(fileName, events, protocol=None):
+    """BIDS events.tsv, and its JSON sidecar next to it (describing each trial_type if the protocol is given)"""
+    with open(fileName, 'w') as eventFile:
+        eventFile.write('onset\tduration\ttrial_type\ttrial\n')
+        for onset, duration, trialType, trial in zip(*events):
+            eventFile.write('%.4f\t%.4f\t%s\t%s\n' % (onset, duration, trialType, trial if trial >= 0 else 'n/a'))
+
+    sidecar = {'onset': {'Description': 'Onset of the event from the first scanner trigger', 'Units': 's'},
+               'duration': {'Description': 'Duration of the event', 'Units': 's'},
+               'trial_type': {'Description': 'Phase of the breathing task shown'},
+               'trial': {'Description': 'Trial (repeat) number, counting from 0 - n/a for rest blocks'}}
+    if protocol is not None:
+        sidecar['trial_type']['Levels'] = describe_phases(protocol)
+        sidecar['TaskName'] = protocol.get('name', '')
+    with open(os.path.splitext(fileName)[0] + '.json', 'w') as sidecarFile:
+        json.dump(sidecar, sidecarFile, indent=2, sort_keys=True)
+
+
+def sample_times(duration, rate):
+    """Times of the samples of a recording of duration seconds at rate Hz, from 0"""
+    return np.arange(int(math.ceil(round(duration * rate, 6)))) / rate
+
+
+def block_regressors(events, times, trialTypes=None):
+    """
+    One boxcar per trial_type (1 while an event of that type is on), sampled at times (sorted).
+    Returns the trial types and a samples x trial types array
+    """
+    if trialTypes is None:
+        trialTypes = sorted(set(events.trial_type))
+    blocks = np.zeros((len(times), len(trialTypes)))
+    for column, trialType in enumerate(trialTypes):
+        isType = events.trial_type == trialType
+        # +1 where each event starts, -1 where it ends: the running sum is the number of events on at each sample
+        starts = np.searchsorted(times, events.onset[isType], side='left')
+        ends = np.searchsorted(times, events.onset[isType] + events.duration[isType], side='left')
+        steps = np.zeros(len(times) + 1)
+        np.add.at(steps, starts, 1)
+        np.add.at(steps, ends, -1)
+        blocks[:, column] = np.cumsum(steps[:-1]) > 0
+    return list(trialTypes), blocks
+
+
+def hrf(dt, length=32.0):
+    """SPM's canonical haemodynamic response (double gamma, peak 6 s, undershoot 16 s), sampled every dt s"""
+    key = (round(dt, 9), length)
+    if key not in _kernels:
+        t = np.arange(0, length, dt)
+        peak = t ** 5 * np.exp(-t) / math.gamma(6)
+        undershoot = t ** 15 * np.exp(-t) / math.gamma(16)
+        kernel = peak - undershoot / 6
+        _kernels[key] = kernel / kernel.sum()
+    return _kernels[key]
+
+
+def convolve(signals, kernel):
+    """Convolve every column of signals with kernel (FFT, so long physio-rate signals stay fast), same length out"""
+    n = signals.shape[0]
+    nfft = 1 << (n + len(kernel) - 2).bit_length()
+    spectrum = np.fft.rfft(signals, nfft, axis=0) * np.fft.rfft(kernel, nfft)[:, None]
+    convolved = np.fft.irfft(spectrum, nfft, axis=0)[:n]
+    convolved[np.abs(convolved) < 1e-12] = 0.0  # FFT round-off, where the response should be exactly 0
+    return convolved
+
+
+def regressors(events, duration, rate, convolved=True):
+    """
+    Block regressors of every trial_type over duration seconds at rate Hz (1 / TR for one sample per volume), and
+    their HRF convolution. Returns sample times, column names and a samples x columns array
+    """
+    times = sample_times(duration, rate)
+    trialTypes, blocks = block_regressors(events, times)
+    names = [trialType + '_block' for trialType in trialTypes]
+    if not convolved:
+        return times, names, blocks
+
+    # the response is worked out on a grid of at least MICROTIME_RATE, then sampled at rate
+    oversample = int(math.ceil(MICROTIME_RATE / rate))
+    fineRate = rate * oversample
+    fineTypes, fineBlocks = block_regressors(events, sample_times(len(times) / rate, fineRate), trialTypes)
+    responses = convolve(fineBlocks, hrf(1.0 / fineRate))[::oversample]
+    return times, names + [trialType + '_hrf' for trialType in trialTypes], np.hstack([blocks, responses])
+
+
+def _table(values):
+    """Tab separated text of a 2D array, formatted in one go rather than row by row"""
+    row = '\t'.join(['%.6g'] * values.shape[1]) + '\n'
+    return (row * values.shape[0]) % tuple(values.ravel())
+
+
+def write_regressors(fileName, times, names, values, rate=None):
+    """
+    Regressors as a tab separated table with a header and a time column - or if fileName ends in .tsv.gz, as a BIDS
+    physio-style file (no header, no time column) with a JSON sidecar giving the columns and the sampling rate
+    """
+    if not fileName.endswith('.tsv.gz'):
+        with open(fileName, 'w') as regressorFile:
+            regressorFile.write('\t'.join(['time'] + names) + '\n')
+            regressorFile.write(_table(np.column_stack([times, values])))
+        return
+    with gzip.open(fileName, 'wt', compresslevel=1) as regressorFile:
+        regressorFile.write(_table(values))
+    with open(fileName[:-len('.tsv.gz')] + '.json', 'w') as sidecarFile:
+        json.dump({'SamplingFrequency': rate, 'StartTime': float(times[0]) if len(times) else 0.0,
+                   'Columns': names}, sidecarFile, indent=2)
+
+
+def main(argv=None):
+    import startup  # turns name=value strings into parameters
+    import task_protocol  # reads the task script and fills in its protocol
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('task', help='task script whose parameters to use, e.g. Breath_Hold.py')
+    parser.add_argument('--out', required=True, help='file name stem, e.g. sub-01_task-breathhold')
+    parser.add_argument('--physio-rate', type=float, help='also sample the regressors at this rate in Hz')
+    parser.add_argument('--frame-rate', type=float, help='place onsets on the frames of a display at this rate')
+    parser.add_argument('parameters', nargs='*', metavar='name=value', help='task parameter to change')
+    args = parser.parse_intermixed_args(argv)  # name=value changes may come before or after the options
+
+    scriptDir = os.path.dirname(os.path.abspath(args.task))
+    namespace = task_protocol.read_task(args.task)
+    protocol, parameters = task_protocol.load_task(namespace, os.path.join(scriptDir, 'protocols',
+                                                                           namespace['protocolName']))
+    startup.apply_parameters(parameters, dict(item.split('=', 1) for item in args.parameters),
+                             task_protocol.protocol_parameters(protocol))
+    protocol = task_protocol.resolve(protocol, parameters)
+
+    events = design(protocol, 1.0 / args.frame_rate if args.frame_rate else None)
+    write_events(args.out + '_events.tsv', events, protocol)
+    MRinfo = protocol.get('MRinfo', {'TR': 3, 'volumes': 300})
+    scanDuration = max(MRinfo['TR'] * MRinfo['volumes'], (events.onset + events.duration).max())
+    write_regressors(args.out + '_regressors.tsv', *regressors(events, scanDuration, 1.0 / MRinfo['TR']))
+    if args.physio_rate:
+        write_regressors(args.out + '_physio_regressors.tsv.gz', *regressors(events, scanDuration, args.physio_rate),
+                         rate=args.physio_rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Dashboard
+
+A page for the operator, at http://localhost:<port>, showing what the participant is seeing while the task runs
+full-screen: task, trial and phase, the time left in the phase and the run, dropped frames, scanner triggers and the
+last key presses. The page is served by a separate process. The task only writes a few numbers into a block of
+shared memory on each flip - no I/O and no drawing - and the dashboard process reads them from there.
+
+"""
+
+from __future__ import absolute_import, division
+from multiprocessing import shared_memory
+import json
+import multiprocessing
+import struct
+import threading
+import time
+
+# Written by the frame loop, guarded by a sequence number that is odd while a write is in progress:
+#   sequence, flip time, time.monotonic() at the flip, planned end of the phase and of the run (globalClock),
+#   frameDur, frameN, trial, dropped frames, status, task, phase
+STATE = struct.Struct('<q5d3q16s48s32s')
+# Written by the input listener, under the same sequence number: number of key presses, number of triggers, then
+# the last KEY_SLOTS key presses (time on globalClock, key, kind), the latest at slot (number of key presses - 1) %
+# KEY_SLOTS
+KEY_SLOTS = 12
+KEY_COUNTS = struct.Struct('<2q')
+KEY = struct.Struct('<d16s8s')
+SIZE = STATE.size + KEY_COUNTS.size + KEY_SLOTS * KEY.size
+
+PAGE = u'''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Breathing task</title>
+<style>
+body {font-family: sans-serif; background: #222; color: #eee; margin: 2em}
+td {padding: 0.2em 1.5em 0.2em 0} .big {font-size: 2.5em} .warn {color: #f66}
+</style></head>
+<body>
+<div class="big" id="phase"></div>
+<table>
+<tr><td>Task</td><td id="task"></td></tr>
+<tr><td>Status</td><td id="status"></td></tr>
+<tr><td>Trial</td><td id="trial"></td></tr>
+<tr><td>Phase time left</td><td id="phaseLeft"></td></tr>
+<tr><td>Run time left</td><td id="runLeft"></td></tr>
+<tr><td>Dropped frames</td><td id="dropped"></td></tr>
+<tr><td>Scanner triggers</td><td id="triggers"></td></tr>
+<tr><td>Key presses</td><td id="keys"></td></tr>
+</table>
+<script>
+function show(id, text) { document.getElementById(id).textContent = text; }
+function update() {
+  fetch('/state').then(function (response) { return response.json(); }).then(function (state) {
+    show('phase', state.phase); show('task', state.task); show('status', state.status);
+    show('trial', state.trial < 0 ? '-' : state.trial + 1);
+    show('phaseLeft', state.phaseLeft === null ? '-' : state.phaseLeft.toFixed(1) + ' s');
+    show('runLeft', state.runLeft === null ? '-' : state.runLeft.toFixed(1) + ' s');
+    show('dropped', state.dropped); show('triggers', state.triggers);
+    document.getElementById('dropped').className = state.dropped ? 'warn' : '';
+    show('keys', state.keys.map(function (key) {
+      return key.key + ' (' + key.kind + ', ' + key.time.toFixed(2) + ' s)'; }).join(', '));
+  }).catch(function () { show('status', 'not running'); });
+}
+setInterval(update, 250); update();
+</script></body></html>
+'''
+
+
+def _text(value, size):
+    return value.encode('utf-8')[:size]
+
+
+def _string(raw):
+    return raw.rstrip(b'\0').decode('utf-8', 'replace')
+
+
+class Publisher(object):
+    """
+    The task's side: owns the shared memory, and starts the dashboard process serving it on port.
+    frame() is called on every flip, so it only does a little arithmetic and writes a few numbers
+    """
+
+    def __init__(self, port):
+        self.memory = shared_memory.SharedMemory(create=True, size=SIZE)
+        self.memory.buf[:SIZE] = b'\0' * SIZE
+        self.process = multiprocessing.Process(target=serve, args=(self.memory.name, port), name='Dashboard')
+        self.process.daemon = True  # closes with the experiment
+        self.process.start()
+        self.offset = 0.0  # getTime at the globalClock reset, for key times
+        self.phaseEnds = {}  # (trial, phase): planned end on globalClock
+        self._state = [0, 0.0, 0.0, 0.0, 0.0, 0.0, 0, -1, 0, b'', b'', b'']
+        self._showing = None  # (trial, phase) on screen
+        self._last = None  # (flip time, frameN) of the previous flip
+        self._keys = 0
+        self._triggers = 0
+        self._writing = threading.Lock()  # the frame loop and the input listener take turns with the sequence number
+        print('Operator dashboard: http://localhost:%i' % port)
+
+    def _publish(self):
+        state = self._state
+        with self._writing:
+            state[0] += 1  # odd: being written
+            STATE.pack_into(self.memory.buf, 0, *state)
+            state[0] += 1
+            struct.pack_into('<q', self.memory.buf, 0, state[0])
+
+    def start_task(self, task, frameDur, phaseEnds, runEnd):
+        """A new task: its name, frame duration, the planned end of every (trial, phase), and of the whole run"""
+        self.phaseEnds = phaseEnds
+        self._showing = None
+        self._last = None
+        state = self._state
+        state[4], state[5], state[6], state[7], state[8] = runEnd, frameDur, 0, -1, 0
+        state[9], state[10], state[11] = b'waiting', _text(task, 48), b''
+        self._publish()
+
+    def align(self, clock):
+        """Give key times on clock (globalClock, reset at the trigger)"""
+        self.offset = clock.getLastResetTime()
+
+    def status(self, status):
+        self._state[9] = _text(status, 16)
+        self._publish()
+
+    def show(self, flipTime, trial, phase, phaseEnd):
+        """Something other than a planned frame went on screen, e.g. a rest block"""
+        state = self._state
+        state[1], state[2], state[3], state[7] = flipTime, time.monotonic(), phaseEnd, trial
+        state[11] = _text(phase, 32)
+        self._showing = (trial, phase)
+        self._last = None
+        self._publish()
+
+    def frame(self, flipTime, frameN, trial, phase):
+        """A planned frame was flipped at flipTime"""
+        state = self._state
+        if self._last is not None:
+            # frames the flip came later than planned, beyond a frame's tolerance
+            late = (flipTime - self._last[0]) / state[5] - (frameN - self._last[1])
+            if late > 0.5:
+                state[8] += int(late + 0.5)
+        self._last = (flipTime, frameN)
+        if self._showing != (trial, phase):
+            self._showing = (trial, phase)
+            state[3], state[7], state[11] = self.phaseEnds.get((trial, phase), 0.0), trial, _text(phase, 32)
+        state[1], state[2], state[6] = flipTime, time.monotonic(), frameN
+        self._publish()
+
+    def key(self, t, name, kind):
+        """A key press or trigger (called from the input listener's thread)"""
+        state = self._state
+        with self._writing:
+            state[0] += 1  # odd: being written
+            struct.pack_into('<q', self.memory.buf, 0, state[0])
+            offset = STATE.size + KEY_COUNTS.size + (self._keys % KEY_SLOTS) * KEY.size
+            KEY.pack_into(self.memory.buf, offset, t - self.offset, _text(name, 16), _text(kind, 8))
+            self._keys += 1
+            if kind == 'trigger':
+                self._triggers += 1
+            KEY_COUNTS.pack_into(self.memory.buf, STATE.size, self._keys, self._triggers)
+            state[0] += 1
+            struct.pack_into('<q', self.memory.buf, 0, state[0])
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
+        self.memory.close()
+        self.memory.unlink()
+
+
+def read_state(buf):
+    """
+    What the dashboard shows, read from the shared memory (retrying while the frame loop or the input listener is
+    writing)
+    """
+    while True:
+        sequence = struct.unpack_from('<q', buf, 0)[0]
+        state = STATE.unpack_from(buf, 0)
+        nKeys, triggers = KEY_COUNTS.unpack_from(buf, STATE.size)
+        slots = [KEY.unpack_from(buf, STATE.size + KEY_COUNTS.size + (n % KEY_SLOTS) * KEY.size)
+                 for n in range(max(0, nKeys - KEY_SLOTS), nKeys)]
+        if sequence % 2 == 0 and struct.unpack_from('<q', buf, 0)[0] == sequence:
+            break
+        time.sleep(0.0005)
+    sequence, flipTime, publishedAt, phaseEnd, runEnd, frameDur, frameN, trial, dropped = state[:9]
+    status, task, phase = [_string(raw) for raw in state[9:]]
+    now = flipTime + time.monotonic() - publishedAt  # on globalClock
+    running = status == 'running'
+    keys = [{'time': t, 'key': _string(name), 'kind': _string(kind)} for t, name, kind in slots]
+    return {'task': task, 'status': status, 'trial': trial, 'phase': phase, 'frameN': frameN, 'dropped': dropped,
+            'phaseLeft': max(0.0, phaseEnd - now) if running and phaseEnd else None,
+            'runLeft': max(0.0, runEnd - now) if running else None,
+            'triggers': triggers, 'keys': keys[::-1]}
+
+
+def serve(memoryName, port):
+    """The dashboard process: serve the page and the state in the shared memory until terminated"""
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    memory = shared_memory.SharedMemory(name=memoryName)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/state':
+                body, contentType = json.dumps(read_state(memory.buf)).encode('utf-8'), 'application/json'
+            else:
+                body, contentType = PAGE.encode('utf-8'), 'text/html; charset=utf-8'
+            self.send_response(200)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # keep the console for the task
+
+    HTTPServer(('127.0.0.1', port), Handler).serve_forever()
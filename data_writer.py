@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Data Writer
+
+Writes a data file as the run goes, on a background thread: the frame loop only puts rows on a queue, and the
+writer formats them, appends them to the file and makes sure they are on disk at every flush (called between
+trials). If the run is aborted or crashes, every row up to the last trial is already saved.
+
+"""
+
+from __future__ import absolute_import, division
+import os
+import queue
+import threading
+
+_FLUSH = object()  # on the queue: make sure everything so far is on disk
+_CLOSE = object()  # on the queue: write what is left and close the file
+
+
+class DataWriter(object):
+    """
+    A tab separated file with a header of columns, and one line per row added.
+    rowFormat = how to write a row (a tuple of values), e.g. '%.6f\\t%s\\t%s\\n'
+    """
+
+    def __init__(self, fileName, columns, rowFormat):
+        self.fileName = fileName
+        self.rowFormat = rowFormat
+        self.rows = 0  # rows written
+        self._queue = queue.Queue()
+        self._file = open(fileName, 'w')
+        self._file.write('\t'.join(columns) + '\n')
+        self._thread = threading.Thread(target=self._write, name='DataWriter')
+        self._thread.daemon = True  # never keeps the experiment from closing
+        self._thread.start()
+
+    def add(self, row):
+        self._queue.put(row)
+
+    def flush(self):
+        """Have every row added so far written to disk (without waiting for it)"""
+        self._queue.put(_FLUSH)
+
+    def close(self):
+        """Write every row added so far and close the file - waits until it is done"""
+        if self._thread is not None:
+            self._queue.put(_CLOSE)
+            self._thread.join()
+            self._thread = None
+
+    def _write(self):
+        while True:
+            row = self._queue.get()
+            if row is _FLUSH or row is _CLOSE:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                if row is _CLOSE:
+                    self._file.close()
+                    return
+            else:
+                self._file.write(self.rowFormat % row)
+                self.rows += 1
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Design Planner
+
+Searches task parameters for designs that fit the scan, before anyone sits in the scanner. Give ranges for the
+parameters of a task script; every combination is filled into the task's protocol and checked, in parallel on
+every core:
+    - the protocol can be run (e.g. a whole number of breaths in every paced phase, see task_protocol.check_protocol)
+    - the run, rest blocks included, fits in the scan (MRinfo TR x volumes, or --max-length)
+    - phases are at least as long as asked (e.g. --min-duration recover=8)
+    - phase onsets fall on a volume (within --align-tolerance, if given)
+The designs that pass are ranked - by default most trials first, then onsets closest to the start of a volume,
+then least scan time left unused - and saved to design_planner.tsv.
+
+    python design_planner.py Breath_Hold.py tHold=10:30:1 tPace=12:36:3 tBreathPace=4,5,6 tRecover=6:12:1
+    python design_planner.py Cued_Deep_Breathing.py tCDB=20:60:2 tCDBPace=2:6:1 tFree=10:40:2 --volumes 200
+
+A range is start:stop:step (stop included) or a list of values. If trialnum is not swept, each design gets as many
+trials as fit in the scan.
+
+"""
+
+from __future__ import absolute_import, division
+from collections import Counter, namedtuple
+import argparse
+import itertools
+import math
+import multiprocessing
+import os
+import re
+import time
+import numpy as np
+import bids_events  # the event timeline of a protocol
+import startup  # turns name=value strings into parameters
+import task_protocol  # reads the task script, and fills in and checks each protocol
+
+# What a design has to meet: TR and volumes of the scan, longest run allowed (seconds, None = the whole scan),
+# largest distance of a phase onset from the start of a volume (seconds, None = not checked), and the shortest
+# duration allowed for phases ({phase name: seconds})
+Constraints = namedtuple('Constraints', ['TR', 'volumes', 'maxLength', 'alignTolerance', 'minDurations'])
+
+RANKINGS = {'trials': lambda row: -row['trialnum'],  # most trials first
+            'alignment': lambda row: round(row['tr_error_mean'], 6),  # onsets nearest the start of a volume first
+            'idle': lambda row: round(row['idle'], 6)}  # least unused scan time first
+CHUNK = 500  # designs sent to a worker at a time
+
+_task = {}  # the task being planned, in each worker process (see _start_worker)
+
+
+def parse_range(text):
+    """Values of a range given as start:stop:step (stop included) or v1,v2,..."""
+    if ':' not in text:
+        return [startup.guess_value(value) for value in text.split(',')]
+    start, stop, step = [startup.guess_value(value) for value in text.split(':')]
+    if step <= 0:
+        raise ValueError('the step of a range has to be positive: ' + text)
+    values = [start + n * step for n in range(int(math.floor(round((stop - start) / step, 9))) + 1)]
+    if all(isinstance(value, int) for value in [start, stop, step]):
+        return values
+    return [round(value, 9) for value in values]
+
+
+def tr_errors(onsets, TR):
+    """Distance of each onset (seconds from the trigger) from the start of the nearest volume"""
+    remainder = np.mod(onsets, TR)
+    return np.minimum(remainder, TR - remainder)
+
+
+def fit_trials(protocol, limit):
+    """Most trials of a (filled in) protocol that fit in limit seconds, with its rest blocks"""
+    trialLength = sum(phase['duration'] for phase in protocol.get('phases', []))
+    doRest = protocol.get('doRest', 0)
+    rest = (protocol.get('tResting_start', 0) if doRest in [1, 3] else 0) + \
+        (protocol.get('tResting_end', 0) if doRest in [2, 3] else 0)
+    if trialLength <= 0:
+        return 0
+    return max(0, int(math.floor(round((limit - rest) / trialLength, 9))))
+
+
+def check_design(protocol, constraints, fitTrials=False):
+    """
+    Check a (filled in) protocol against the constraints. Returns the reason it fails, or None and the numbers it is
+    ranked on
+    """
+    errors = task_protocol.check_protocol(protocol)
+    if errors:
+        return re.sub(r'^[0-9.]+ ', 'n ', errors[0]), None  # the same reason for any number of breaths
+    for phase in protocol.get('phases', []):
+        if phase['duration'] < constraints.minDurations.get(phase['name'], 0):
+            return 'phase %s shorter than %g s' % (phase['name'], constraints.minDurations[phase['name']]), None
+
+    scanLength = constraints.TR * constraints.volumes
+    limit = min(scanLength, constraints.maxLength or scanLength)
+    if fitTrials:
+        protocol = dict(protocol, trialnum=fit_trials(protocol, limit))
+    if protocol.get('trialnum', 0) < 1:
+        return 'not one trial fits in the scan', None
+    events = bids_events.design(protocol)
+    runLength = float((events.onset + events.duration).max())
+    if runLength > limit + 1e-9:
+        return 'longer than %g s' % limit, None
+
+    errors = tr_errors(events.onset[events.trial >= 0], constraints.TR)
+    if constraints.alignTolerance is not None and errors.max() > constraints.alignTolerance + 1e-9:
+        return 'onsets more than %g s off a volume' % constraints.alignTolerance, None
+    return None, {'trialnum': protocol['trialnum'], 'run_length': runLength, 'scan_length': scanLength,
+                  'idle': scanLength - runLength, 'onsets': len(errors),
+                  'tr_error_mean': float(errors.mean()), 'tr_error_max': float(errors.max())}
+
+
+def _start_worker(protocol, parameters, names, constraints, fitTrials):
+    _task.update(protocol=protocol, parameters=parameters, names=names, constraints=constraints,
+                 fitTrials=fitTrials)
+
+
+def _check_chunk(chunk):
+    """Check a list of designs (tuples of values of _task['names']) in a worker: [(values, reason, numbers)]"""
+    results = []
+    parameters = dict(_task['parameters'])
+    for values in chunk:
+        parameters.update(zip(_task['names'], values))
+        reason, numbers = check_design(task_protocol.resolve(_task['protocol'], parameters), _task['constraints'],
+                                       _task['fitTrials'])
+        results.append((values, reason, numbers))
+    return results
+
+
+def plan(protocol, parameters, ranges, constraints, processes=None, rank=('trials', 'alignment', 'idle')):
+    """
+    Check every combination of the parameter values in ranges ({name: [values]}, typed like parameters) filled
+    into protocol (not yet filled in). Returns the passing designs as rows, best first, and a Counter of the
+    reasons the others failed
+    """
+    names = sorted(ranges)
+    designs = list(itertools.product(*[ranges[name] for name in names]))
+    chunks = [designs[start:start + CHUNK] for start in range(0, len(designs), CHUNK)]
+    initargs = (protocol, parameters, names, constraints, 'trialnum' not in ranges)
+    if processes == 1:
+        _start_worker(*initargs)
+        checked = map(_check_chunk, chunks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_start_worker, initargs=initargs)
+        checked = pool.imap_unordered(_check_chunk, chunks)
+
+    rows = []
+    rejected = Counter()
+    try:
+        for results in checked:
+            for values, reason, numbers in results:
+                if reason is None:
+                    rows.append(dict(numbers, parameters=dict(zip(names, values))))
+                else:
+                    rejected[reason] += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    rows.sort(key=lambda row: tuple(RANKINGS[criterion](row) for criterion in rank)
+              + tuple(row['parameters'][name] for name in names))
+    return rows, rejected
+
+
+def save_plan(fileName, rows, names):
+    with open(fileName, 'w') as planFile:
+        planFile.write('\t'.join(['rank'] + names + ['trialnum', 'run_length', 'scan_length', 'idle', 'onsets',
+                                                     'tr_error_mean', 'tr_error_max']) + '\n')
+        for rank, row in enumerate(rows, 1):
+            planFile.write('\t'.join(['%i' % rank] + ['%s' % row['parameters'][name] for name in names]) +
+                           '\t%i\t%.3f\t%.3f\t%.3f\t%i\t%.4f\t%.4f\n' % (
+                               row['trialnum'], row['run_length'], row['scan_length'], row['idle'], row['onsets'],
+                               row['tr_error_mean'], row['tr_error_max']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('task', help='task script whose protocol and parameters to use, e.g. Breath_Hold.py')
+    parser.add_argument('ranges', nargs='+', metavar='name=start:stop:step', help='parameter values to try')
+    parser.add_argument('--tr', type=float, help='TR in seconds (default: MRinfo of the protocol)')
+    parser.add_argument('--volumes', type=int, help='volumes in the scan (default: MRinfo of the protocol)')
+    parser.add_argument('--max-length', type=float, help='longest run allowed in seconds (default: the scan)')
+    parser.add_argument('--align-tolerance', type=float,
+                        help='reject designs with a phase onset further than this from the start of a volume (s)')
+    parser.add_argument('--min-duration', action='append', default=[], metavar='phase=seconds',
+                        help='shortest a phase may be, e.g. recover=8')
+    parser.add_argument('--rank', default='trials,alignment,idle',
+                        help='what to rank the designs on, in order (from %s)' % ', '.join(sorted(RANKINGS)))
+    parser.add_argument('--processes', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--top', type=int, default=10, help='number of designs to print')
+    parser.add_argument('--out', default='design_planner.tsv', help='file to save the ranked designs to')
+    args = parser.parse_args(argv)
+
+    rank = args.rank.split(',')
+    for criterion in rank:
+        if criterion not in RANKINGS:
+            parser.error('cannot rank on %s (choose from %s)' % (criterion, ', '.join(sorted(RANKINGS))))
+    scriptDir = os.path.dirname(os.path.abspath(args.task))
+    namespace = task_protocol.read_task(args.task)
+    protocol, parameters = task_protocol.load_task(namespace, os.path.join(scriptDir, 'protocols',
+                                                                           namespace['protocolName']))
+    extraNames = task_protocol.protocol_parameters(protocol)
+
+    # each value typed like the parameter it is for (checking the parameter exists)
+    ranges = {}
+    for item in args.ranges:
+        if '=' not in item:
+            parser.error('ranges must be given as name=start:stop:step or name=v1,v2,..., not ' + item)
+        name, text = item.split('=', 1)
+        ranges[name] = []
+        for value in parse_range(text):
+            typed = dict(parameters)
+            startup.apply_parameters(typed, {name: str(value)}, extraNames)
+            ranges[name].append(typed[name])
+
+    MRinfo = task_protocol.resolve(protocol, parameters).get('MRinfo', {'TR': 3, 'volumes': 300})
+    minDurations = dict((item.split('=', 1)[0], float(item.split('=', 1)[1])) for item in args.min_duration)
+    constraints = Constraints(args.tr or MRinfo['TR'], args.volumes or MRinfo['volumes'], args.max_length,
+                              args.align_tolerance, minDurations)
+
+    started = time.time()
+    rows, rejected = plan(protocol, parameters, ranges, constraints, args.processes, rank)
+    nDesigns = len(rows) + sum(rejected.values())
+    print('%i designs checked in %.1f s: %i fit a scan of %i volumes (TR %g s)'
+          % (nDesigns, time.time() - started, len(rows), constraints.volumes, constraints.TR))
+    for reason, count in rejected.most_common():
+        print('  %7i rejected: %s' % (count, reason))
+
+    names = sorted(ranges)
+    save_plan(args.out, rows, names)
+    for position, row in enumerate(rows[:args.top], 1):
+        print('%3i. %-50s %2i trials, %6.1f s (%5.1f s unused), onsets %.3f s off a volume on average'
+              % (position, ' '.join('%s=%s' % (name, row['parameters'][name]) for name in names), row['trialnum'],
+                 row['run_length'], row['idle'], row['tr_error_mean']))
+
+
+if __name__ == '__main__':
+    main()
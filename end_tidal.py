@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End Tidal
+
+Finds end-tidal peaks in the CO2 signal while it is being recorded (see physio_stream.py), tags each one with the
+phase of the task that was on screen, and tells the operator straight away whether the exhalations the analysis
+depends on - e.g. just before and just after the breath hold - were captured, so a trial can be repeated or the
+participant reminded while they are still in the scanner.
+The detector is peakdet's (a peak is confirmed once the signal has fallen delta below it), done one sample at a
+time with constant work per sample, on its own thread: the frame loop does nothing extra.
+
+Exhalation checks are given in the protocol, each a window around the onset of one phase of every trial:
+    {"name": "pre-hold exhalation", "phase": "hold", "from": -4, "to": 1}
+A check is captured if an end-tidal peak falls in the window (seconds from the phase onset, after taking away the
+delay of the gas sampling line).
+
+"""
+
+from __future__ import absolute_import, division
+from bisect import bisect_right
+import threading
+import time
+import frame_plan  # the phase onsets of the task
+
+POLL_INTERVAL = 0.05  # seconds between looks at the ring buffer
+
+
+class PeakDetector(object):
+    """
+    Online peakdet: feed samples one at a time, get each peak back once the signal has dropped delta below it.
+    sign = -1 finds troughs instead (e.g. end-tidal O2)
+    """
+
+    def __init__(self, delta, sign=1):
+        self.delta = delta
+        self.sign = sign
+        self.best = None  # (time, value) of the highest point since the last trough, signed
+        self.lowest = None
+        self.lookingForPeak = True
+
+    def add(self, t, value):
+        """Add a sample, returning (time, value) of the peak it confirms, or None"""
+        signed = self.sign * value
+        if self.best is None:
+            self.best = self.lowest = (t, signed)
+            return None
+        if signed > self.best[1]:
+            self.best = (t, signed)
+        if signed < self.lowest[1]:
+            self.lowest = (t, signed)
+        if self.lookingForPeak:
+            if signed < self.best[1] - self.delta:
+                peak = self.best
+                self.lowest = (t, signed)
+                self.lookingForPeak = False
+                return peak[0], self.sign * peak[1]
+        elif signed > self.lowest[1] + self.delta:
+            self.best = (t, signed)
+            self.lookingForPeak = True
+        return None
+
+    def candidate(self):
+        """Time of the highest point so far that may still turn out to be a peak, or None"""
+        if self.lookingForPeak and self.best is not None:
+            return self.best[0]
+        return None
+
+
+class PhaseTimeline(object):
+    """Which phase of which trial is on screen at a time on globalClock, from the onsets (time, trial, phase)"""
+
+    def __init__(self, onsets):
+        self.onsets = sorted(onsets)
+        self._times = [onset[0] for onset in self.onsets]
+
+    def at(self, t):
+        """(trial, phase) on screen at t - (-1, 'baseline') before the first onset"""
+        index = bisect_right(self._times, t) - 1
+        if index < 0:
+            return -1, 'baseline'
+        return self.onsets[index][1], self.onsets[index][2]
+
+    def windows(self, checks):
+        """Every window a check covers: (start, end, check name, trial), in time order"""
+        windows = []
+        for onsetTime, trial, phase in self.onsets:
+            for check in checks:
+                if check['phase'] == phase:
+                    windows.append((onsetTime + check['from'], onsetTime + check['to'], check['name'], trial))
+        return sorted(windows)
+
+
+def planned_timeline(plan, frameDur, planStart, doRest):
+    """The phase onsets a frame plan will show, on globalClock (rest blocks included)"""
+    onsets = []
+    if doRest == 1 or doRest == 3:
+        onsets.append((0.0, -1, 'rest'))
+    for trial, phase, onsetFrame, onsetTime, nFrames in frame_plan.summarise_plan(plan, frameDur):
+        onsets.append((planStart + onsetTime, trial, phase))
+    if doRest == 2 or doRest == 3:
+        onsets.append((planStart + len(plan) * frameDur, -1, 'rest'))
+    return PhaseTimeline(onsets)
+
+
+class EndTidalMonitor(object):
+    """
+    Reads the CO2 channel of a physio_stream.PhysioRecorder as it is recorded, on a background thread: finds the
+    end-tidal peaks, tags them with the phase on screen, and reports each exhalation check as its window closes.
+    delay = seconds the gas sampling line delays the signal; report = function given each message for the operator
+    """
+
+    def __init__(self, recorder, timeline, checks=(), delta=3.0, delay=0.0, channel='CO2', report=print,
+                 pollInterval=POLL_INTERVAL):
+        self.recorder = recorder
+        self.timeline = timeline
+        self.column = 1 + recorder.channels.index(channel)
+        self.detector = PeakDetector(delta)
+        self.delay = delay
+        self.report = report
+        self.pollInterval = pollInterval
+        self.peaks = []  # (time on globalClock, corrected for the delay, value, trial, phase)
+        self.results = []  # (check name, trial, captured, time of the peak or None, value or None)
+        self._windows = timeline.windows(checks)  # still open, in time order
+        self._captured = {}  # window: first peak in it
+        self._next = 0  # next sample of the ring buffer to look at
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._monitor, name='EndTidalMonitor')
+        self._thread.daemon = True  # never keeps the experiment from closing
+        self._thread.start()
+
+    def stop(self):
+        """Look at every sample recorded so far, then report the checks still open"""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.update()
+        while self._windows:
+            self._close(self._windows.pop(0))
+
+    def _monitor(self):
+        while self._running:
+            self.update()
+            time.sleep(self.pollInterval)
+
+    def update(self):
+        """Run the detector over the samples recorded since the last update (once aligned to globalClock)"""
+        if self.recorder.offset is None:
+            return
+        rows, self._next, lost = self.recorder.buffer.since(self._next)
+        times = self.recorder.clock_times(rows[:, 0]) - self.delay  # on globalClock, like the timeline
+        for t, value in zip(times.tolist(), rows[:, self.column].tolist()):
+            peak = self.detector.add(t, value)
+            if peak is not None:
+                self._add_peak(peak)
+            # a window closes once it is over, unless a peak in it may still be confirmed
+            while self._windows and self._windows[0][1] < t and not self._pending(self._windows[0]):
+                self._close(self._windows.pop(0))
+
+    def _pending(self, window):
+        candidate = self.detector.candidate()
+        return candidate is not None and window[0] <= candidate <= window[1] and window not in self._captured
+
+    def _add_peak(self, peak):
+        t, value = peak
+        trial, phase = self.timeline.at(t)
+        self.peaks.append((t, value, trial, phase))
+        for window in self._windows:
+            if window[0] > t:
+                break
+            if t <= window[1] and window not in self._captured:
+                self._captured[window] = peak
+
+    def _close(self, window):
+        start, end, name, trial = window
+        peak = self._captured.pop(window, None)
+        if peak is None:
+            self.results.append((name, trial, False, None, None))
+            self.report('** trial %i: %s MISSED - no end-tidal peak between %.1f and %.1f s'
+                        % (trial, name, start, end))
+        else:
+            self.results.append((name, trial, True, peak[0], peak[1]))
+            self.report('trial %i: %s captured (%.1f at %.1f s)' % (trial, name, peak[1], peak[0]))
+
+    def save(self, peakFile, checkFile):
+        """The end-tidal peaks, and the result of every exhalation check"""
+        with open(peakFile, 'w') as peaks:
+            peaks.write('time\tvalue\ttrial\tphase\n')
+            for t, value, trial, phase in self.peaks:
+                peaks.write('%.3f\t%.3f\t%i\t%s\n' % (t, value, trial, phase))
+        with open(checkFile, 'w') as checks:
+            checks.write('check\ttrial\tcaptured\ttime\tvalue\n')
+            for name, trial, captured, t, value in self.results:
+                if captured:
+                    checks.write('%s\t%i\t1\t%.3f\t%.3f\n' % (name, trial, t, value))
+                else:
+                    checks.write('%s\t%i\t0\tn/a\tn/a\n' % (name, trial))
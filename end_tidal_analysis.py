@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End Tidal Analysis
+
+Makes the end-tidal traces from a run's physio recording after the run, and sums them up per trial and phase of the
+task - the peak detection and interpolation the README describes, lined up with what was on screen:
+
+    python end_tidal_analysis.py data/P01_Breath_Hold.py_2026_Oct_18_1200_physio.tsv --task Breath_Hold.py
+
+The recording is first copied, a chunk at a time, into a binary .npy file next to it (done once), which is then read
+through memory maps, one chunk at a time: memory use stays the same however long the recording and however many
+channels it has. End-tidal peaks (troughs for O2) are found with the same peakdet as the online monitor (see
+end_tidal.py, a peak is confirmed once the signal has fallen delta below it), after NumPy has cut each chunk down to
+the lowest and highest sample of every --block seconds (in time order) and then to the turning points - the same
+peaks, as long as a breath cannot rise and fall by delta within one block. The detector carries on from one chunk to
+the next, so a peak across a chunk boundary is found too.
+
+Saves, next to the recording:
+    _endtidal.tsv          the end-tidal trace of each channel, interpolated linearly between peaks, at --rate Hz
+    _endtidal_peaks.tsv    every end-tidal peak, with the trial and phase on screen when the breath was taken
+    _endtidal_phases.tsv   per phase of every trial (from the run's _phases.tsv): peaks, and mean, lowest and highest
+                           end-tidal value of each channel
+    _endtidal_trials.tsv   per trial: the mean end-tidal value of each phase, the lowest and highest of the trial, and
+                           the highest peak in each exhalation check window of the protocol (e.g. just before and
+                           just after the breath hold) with the change from the first check to the last
+
+Times are on the task's clock (0 = the scanner trigger), with the delay of the gas sampling line taken away.
+
+"""
+
+from __future__ import absolute_import, division
+import argparse
+import os
+import numpy as np
+import end_tidal  # the peak detector and exhalation check windows
+
+CHUNK = 1000000  # samples read at a time
+BLOCK = 0.02  # seconds - each chunk is cut down to the lowest and highest sample of every block before peakdet
+SIGNS = {'O2': -1}  # channels whose end-tidal values are troughs, not peaks
+
+
+def read_channels(physioFile):
+    """Names of the channels of a _physio.tsv (the columns after time)"""
+    with open(physioFile) as recording:
+        return recording.readline().strip().split('\t')[1:]
+
+
+def _parse(lines, columns):
+    """Lines of tab separated numbers as an array of rows"""
+    return np.fromstring(''.join(lines), dtype=float, sep=' ').reshape(-1, columns)
+
+
+def to_memmap(physioFile, chunk=CHUNK):
+    """
+    The samples of a _physio.tsv (time, then a column per channel) as a read-only memory map of a .npy copy, written
+    chunk by chunk the first time (and again if the recording is newer than the copy)
+    """
+    npyFile = os.path.splitext(physioFile)[0] + '.npy'
+    if not os.path.exists(npyFile) or os.path.getmtime(npyFile) < os.path.getmtime(physioFile):
+        columns = 1 + len(read_channels(physioFile))
+        with open(physioFile) as recording:
+            recording.readline()
+            samples = sum(1 for line in recording if line.strip() and not line.startswith('#'))
+        copy = np.lib.format.open_memmap(npyFile + '.part', mode='w+', dtype=np.float64, shape=(samples, columns))
+        written = 0
+        with open(physioFile) as recording:
+            recording.readline()
+            lines = []
+            for line in recording:
+                if line.strip() and not line.startswith('#'):
+                    lines.append(line)
+                if len(lines) == chunk or (lines and written + len(lines) == samples):
+                    window = _window(copy, written, len(lines), 'r+')
+                    window[:] = _parse(lines, columns)
+                    window.flush()
+                    del window
+                    written += len(lines)
+                    lines = []
+        del copy
+        os.replace(npyFile + '.part', npyFile)
+    return np.load(npyFile, mmap_mode='r')
+
+
+def _window(samples, start, rows, mode='r'):
+    """
+    rows samples of a .npy memory map from sample start on, mapped on their own, so their pages are let go once the
+    window is dropped (pages read through the map of the whole file stay in memory)
+    """
+    return np.memmap(samples.filename, dtype=samples.dtype, mode=mode, shape=(rows,) + samples.shape[1:],
+                     offset=samples.offset + start * samples.strides[0])
+
+
+def chunks(samples, chunk=CHUNK):
+    """The samples of a .npy memory map, chunk samples at a time"""
+    for start in range(0, len(samples), chunk):
+        window = _window(samples, start, min(chunk, len(samples) - start))
+        yield np.array(window)
+        del window
+
+
+def sample_rate(samples):
+    """Samples per second of a recording, from the median interval of its first samples"""
+    intervals = np.diff(samples[:10000, 0])
+    intervals = intervals[intervals > 0]
+    if not len(intervals):
+        return 1.0
+    return 1.0 / np.median(intervals)
+
+
+def turning_points(times, values, block):
+    """
+    The samples of a chunk that peakdet can tell apart from the rest: the lowest and highest of every block of
+    samples, in time order, less any that only continue a rise or a fall (the first and last sample always stay)
+    """
+    n = len(values)
+    if block > 1 and n > block:
+        full = n // block * block
+        blocks = values[:full].reshape(-1, block)
+        starts = np.arange(0, full, block)
+        extremes = np.concatenate([np.sort(np.column_stack([starts + blocks.argmin(axis=1),
+                                                            starts + blocks.argmax(axis=1)]), axis=1).ravel(),
+                                   [full + values[full:].argmin(), full + values[full:].argmax()] if full < n else []])
+        extremes = np.concatenate([[0], extremes.astype(int), [n - 1]])
+        extremes = extremes[np.concatenate([[True], np.diff(extremes) > 0])]
+        times, values = times[extremes], values[extremes]
+    if len(values) > 2:
+        steps = np.diff(values)
+        keep = np.concatenate([[True], steps[:-1] * steps[1:] <= 0, [True]])
+        times, values = times[keep], values[keep]
+    return times, values
+
+
+def find_peaks(samples, channels, delta=3.0, delay=0.0, block=BLOCK, chunk=CHUNK):
+    """
+    End-tidal peaks of every channel of samples (time, channel values...) read chunk by chunk:
+    {channel: (times, values)}, times corrected for the delay of the gas sampling line
+    """
+    blockSamples = max(1, int(round(block * sample_rate(samples))))
+    detectors = [end_tidal.PeakDetector(delta, SIGNS.get(channel, 1)) for channel in channels]
+    peaks = [[] for channel in channels]
+    for rows in chunks(samples, chunk):
+        for column, detector in enumerate(detectors):
+            times, values = turning_points(rows[:, 0] - delay, rows[:, column + 1], blockSamples)
+            add = detector.add
+            for t, value in zip(times.tolist(), values.tolist()):
+                peak = add(t, value)
+                if peak is not None:
+                    peaks[column].append(peak)
+    return dict((channel, (np.array([t for t, value in found]), np.array([value for t, value in found])))
+                for channel, found in zip(channels, peaks))
+
+
+def interpolate(peaks, times):
+    """The end-tidal trace at times, linear between peaks (NaN before the first peak and after the last)"""
+    peakTimes, values = peaks
+    if len(peakTimes) < 2:
+        return np.full(len(times), np.nan)
+    return np.interp(times, peakTimes, values, left=np.nan, right=np.nan)
+
+
+def save_trace(fileName, peaks, channels, start, end, rate, chunk=CHUNK):
+    """Write the interpolated end-tidal traces from start to end, rate samples per second, a chunk at a time"""
+    line = '\t'.join(['%.6f'] + ['%.4f'] * len(channels)) + '\n'
+    with open(fileName, 'w') as traceFile:
+        traceFile.write('\t'.join(['time'] + channels) + '\n')
+        total = int(np.floor((end - start) * rate)) + 1
+        for first in range(0, total, chunk):
+            times = start + np.arange(first, min(first + chunk, total)) / rate
+            rows = np.column_stack([times] + [interpolate(peaks[channel], times) for channel in channels])
+            traceFile.write((line * len(rows)) % tuple(rows.ravel()))
+
+
+def read_phases(phaseFile):
+    """(trial, phase, onset, offset) of every phase shown, from a run's _phases.tsv"""
+    with open(phaseFile) as phases:
+        columns = phases.readline().strip().split('\t')
+        rows = []
+        for line in phases:
+            values = dict(zip(columns, line.rstrip('\n').split('\t')))
+            rows.append((int(values['trial']), values['phase'], float(values['onset']), float(values['offset'])))
+    return rows
+
+
+def phase_metrics(peaks, channels, phases, rate):
+    """Per phase: (trial, phase, onset, offset, {channel: (peaks, mean, lowest, highest)})"""
+    rows = []
+    for trial, phase, onset, offset in phases:
+        times = np.arange(onset, offset, 1.0 / rate)
+        metrics = {}
+        for channel in channels:
+            peakTimes, values = peaks[channel]
+            inPhase = (peakTimes >= onset) & (peakTimes < offset)
+            trace = interpolate(peaks[channel], times)
+            trace = trace[~np.isnan(trace)]
+            if len(trace):
+                metrics[channel] = (int(inPhase.sum()), trace.mean(), trace.min(), trace.max())
+            else:
+                metrics[channel] = (int(inPhase.sum()), np.nan, np.nan, np.nan)
+        rows.append((trial, phase, onset, offset, metrics))
+    return rows
+
+
+def trial_metrics(peaks, channels, phases, phaseRows, checks):
+    """
+    Per trial: {'trial', '<phase>_<channel>_mean', '<channel>_min', '<channel>_max', '<check>_<channel>' (the
+    highest peak in the check's window - lowest trough for O2 - e.g. the end-tidal CO2 of the exhalation before the
+    hold) and, with two checks or more, '<channel>_change' from the first check to the last}
+    """
+    timeline = end_tidal.PhaseTimeline([(onset, trial, phase) for trial, phase, onset, offset in phases])
+    windows = timeline.windows(checks)
+    trials = sorted(set(trial for trial, phase, onset, offset in phases if trial >= 0))
+    rows = []
+    for trial in trials:
+        row = {'trial': trial}
+        inTrial = [metrics for phaseTrial, phase, onset, offset, metrics in phaseRows if phaseTrial == trial]
+        for channel in channels:
+            for phaseTrial, phase, onset, offset, metrics in phaseRows:
+                if phaseTrial == trial:
+                    row['%s_%s_mean' % (phase, channel)] = metrics[channel][1]
+            row['%s_min' % channel] = np.fmin.reduce([metrics[channel][2] for metrics in inTrial])
+            row['%s_max' % channel] = np.fmax.reduce([metrics[channel][3] for metrics in inTrial])
+            peakTimes, values = peaks[channel]
+            sign = SIGNS.get(channel, 1)
+            checkValues = []
+            for check in checks:
+                found = [values[(peakTimes >= start) & (peakTimes <= end)] for start, end, name, windowTrial
+                         in windows if name == check['name'] and windowTrial == trial]
+                found = np.concatenate(found) if found else np.array([])
+                value = sign * (sign * found).max() if len(found) else np.nan
+                row['%s_%s' % (check['name'], channel)] = value
+                checkValues.append(value)
+            if len(checks) > 1:
+                row['%s_change' % channel] = checkValues[-1] - checkValues[0]
+        rows.append(row)
+    return rows
+
+
+def _value(value):
+    return 'n/a' if value is None or np.isnan(value) else '%.4f' % value
+
+
+def save_tables(fileStem, peaks, channels, phases, phaseRows, trialRows):
+    timeline = end_tidal.PhaseTimeline([(onset, trial, phase) for trial, phase, onset, offset in phases])
+    with open(fileStem + '_endtidal_peaks.tsv', 'w') as peakFile:
+        peakFile.write('channel\ttime\tvalue\ttrial\tphase\n')
+        for channel in channels:
+            for t, value in zip(*peaks[channel]):
+                trial, phase = timeline.at(t)
+                peakFile.write('%s\t%.3f\t%.4f\t%i\t%s\n' % (channel, t, value, trial, phase))
+    with open(fileStem + '_endtidal_phases.tsv', 'w') as phaseFile:
+        phaseFile.write('\t'.join(['trial', 'phase', 'onset', 'offset'] +
+                                  ['%s_%s' % (channel, metric) for channel in channels
+                                   for metric in ['peaks', 'mean', 'min', 'max']]) + '\n')
+        for trial, phase, onset, offset, metrics in phaseRows:
+            phaseFile.write('%i\t%s\t%.3f\t%.3f' % (trial, phase, onset, offset) +
+                            ''.join('\t%i\t%s\t%s\t%s' % (metrics[channel][0], _value(metrics[channel][1]),
+                                                          _value(metrics[channel][2]), _value(metrics[channel][3]))
+                                    for channel in channels) + '\n')
+    with open(fileStem + '_endtidal_trials.tsv', 'w') as trialFile:
+        names = []
+        for row in trialRows:
+            names += [name for name in row if name not in names]
+        trialFile.write('\t'.join(names) + '\n')
+        for row in trialRows:
+            trialFile.write('\t'.join('%i' % row['trial'] if name == 'trial' else _value(row.get(name))
+                                      for name in names) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('physio', help='the run\'s _physio.tsv')
+    parser.add_argument('--phases', help='the run\'s _phases.tsv (default: next to the recording)')
+    parser.add_argument('--task', help='task script the run used, for its exhalation checks, peak_delta and delay')
+    parser.add_argument('--delta', type=float, help='how far a channel has to fall after a peak to count it '
+                                                    '(default: the protocol\'s peak_delta, or 3)')
+    parser.add_argument('--delay', type=float, help='seconds the gas sampling line delays the signal '
+                                                    '(default: the protocol\'s, or 0)')
+    parser.add_argument('--rate', type=float, default=10.0, help='samples per second of the end-tidal trace')
+    parser.add_argument('--block', type=float, default=BLOCK, help='seconds of recording cut down to 2 samples')
+    parser.add_argument('--chunk', type=int, default=CHUNK, help='samples read at a time')
+    args = parser.parse_args(argv)
+
+    checks, physio = [], {}
+    if args.task:
+        import task_protocol  # reads the task's protocol
+        namespace = task_protocol.read_task(args.task)
+        protocol, parameters = task_protocol.load_task(namespace,
+                                                       os.path.join(os.path.dirname(os.path.abspath(args.task)),
+                                                                    'protocols', namespace['protocolName']))
+        protocol = task_protocol.resolve(protocol, parameters)
+        checks, physio = protocol.get('exhalation_checks', []), protocol.get('physio') or {}
+    delta = args.delta if args.delta is not None else physio.get('peak_delta', 3.0)
+    delay = args.delay if args.delay is not None else physio.get('delay', 0.0)
+
+    fileStem = args.physio[:-len('_physio.tsv')] if args.physio.endswith('_physio.tsv') else \
+        os.path.splitext(args.physio)[0]
+    channels = read_channels(args.physio)
+    samples = to_memmap(args.physio, args.chunk)
+    if not len(samples):
+        parser.error('no samples in ' + args.physio)
+    peaks = find_peaks(samples, channels, delta, delay, args.block, args.chunk)
+    save_trace(fileStem + '_endtidal.tsv', peaks, channels, samples[0, 0] - delay, samples[-1, 0] - delay,
+               args.rate, args.chunk)
+    for channel in channels:
+        print('%s: %i end-tidal peaks' % (channel, len(peaks[channel][0])))
+
+    phaseFile = args.phases or fileStem + '_phases.tsv'
+    if os.path.exists(phaseFile):
+        phases = read_phases(phaseFile)
+        phaseRows = phase_metrics(peaks, channels, phases, args.rate)
+        trialRows = trial_metrics(peaks, channels, phases, phaseRows, checks)
+        save_tables(fileStem, peaks, channels, phases, phaseRows, trialRows)
+        for row in trialRows:
+            if checks:
+                shown = [name for name in row if name.endswith('_change') or
+                         any(name.startswith(check['name']) for check in checks)]
+            else:
+                shown = [name for name in row if name.endswith('_min') or name.endswith('_max')]
+            print('trial %i: ' % row['trial'] + ', '.join('%s %s' % (name, _value(row[name])) for name in shown))
+    else:
+        print('no %s: end-tidal values not summed up per phase' % phaseFile)
+
+
+if __name__ == '__main__':
+    main()
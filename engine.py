@@ -0,0 +1,629 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Engine
+
+Runs any breathing task described by a protocol file (see the protocols folder): window set-up, stimuli,
+instructions, scanner trigger, rest blocks, the trial loop and saving the data. Every task goes through the same
+frame loop, so a timing fix here reaches Breath_Hold, Cued_Deep_Breathing and Fixation at once, and a new design
+only needs a new protocol file.
+
+A protocol is JSON. Values written as "$name" are filled in from the task parameters (the CHANGE PARAMETERS section
+of the script running it, the protocol's own "parameters" block, or the command line):
+
+    name           name of the task
+    instructions   text shown until the space key is pressed, or null for no instructions screen
+    dialog         false to never ask for the participant (default true)
+    trigger        false to start straight away instead of waiting for the scanner with launchScan (default true)
+    MRinfo         {"sync": trigger key, "TR": seconds, "volumes": number of volumes}
+    doRest         0 = no rest; 1 = rest before the trials; 2 = rest after; 3 = rest before AND after
+    tResting_start, tResting_end   duration of each rest block (fixation cross) in seconds
+    trialnum       number of trial repeats
+    non_slip       true (default) to time every phase and rest block from the trigger, catching up on dropped
+                   frames so the run keeps its designed length; false to show every frame of the plan in turn
+    hold_static    true (default) to leave the screen as it is while nothing on it changes, instead of redrawing it
+                   every frame - false to redraw every frame. Held screens are not dropped frames: they are marked
+                   in the frame log and left out of its dropped frame and jitter counts
+    profile_frames true to time each stage of every trial frame (keys, plan, draw, flip, log) and save per-phase
+                   histograms and the worst frames at the end of the run (see frame_profiler.py; default false)
+    phases         list of the phases of one trial, each with:
+                     name, duration
+                     text (shown throughout), or breathPace (alternate IN / OUT every half breathPace seconds)
+                     countdown (true to count the seconds down underneath)
+                     pos, height, color, wrapWidth (how the text looks)
+    countdown      pos, height and color of the countdown numbers
+    physio         {"source": where to read the end-tidal signal from during the run (see physio_stream.py, "" for
+                   nowhere), "channels": names of the signals in the stream, "delay": seconds the gas sampling line
+                   delays the signal, "peak_delta": how far CO2 has to fall after an end-tidal peak to count it}
+    exhalation_checks   exhalations to check for an end-tidal peak during the run (see end_tidal.py)
+    end_exp_key    key to press to end the experiment prematurely
+    parameters     default values for the "$name"s the protocol uses (optional)
+
+"""
+
+from __future__ import absolute_import, division
+import os
+import sys
+import frame_plan  # compiles the trial phases into a frame-by-frame plan
+import frame_log  # keeps the time of every flip, tagged with trial and phase
+import data_writer  # streams the data rows to disk as the run goes
+import glyph_cache  # lays out every cue word and countdown number once
+import input_listener  # reads keys and triggers on a background thread
+import startup  # command line / config file launch and cached frame rate
+import task_protocol  # reads, fills in and checks the protocol
+# PsychoPy, and the parts of a run that only some protocols ask for (the frame profiler, stimulus atlas, operator
+# dashboard, end-tidal recording and scanner pulse counting), are only imported once a task runs and needs them, so
+# reading a task script stays light
+
+# how text looks unless the protocol says otherwise
+DEFAULT_STYLE = {'pos': [0, 0], 'height': 0.5, 'color': u'white', 'wrapWidth': None}
+DEFAULT_COUNTDOWN = {'pos': [0, -0.3], 'height': 0.2, 'color': u'yellow'}
+# frames before the screen changes that a held screen starts being redrawn again, so the change itself is still
+# timed by the flip - a late wake-up from the wait costs nothing as long as it is less than this
+WAKE_FRAMES = 2
+
+
+class Abort(Exception):
+    """The end experiment key was pressed"""
+
+
+##############
+#  PROTOCOLS #
+##############
+
+def trial_phases(protocol):
+    """The phases of one trial, for the frame plan"""
+    return [frame_plan.Phase(phase['name'], phase['duration'], phase.get('text'), phase.get('countdown', False),
+                             phase.get('breathPace')) for phase in protocol.get('phases', [])]
+
+
+#########################
+#  PSYCHOPY AND DISPLAY #
+#########################
+
+class Modules(object):
+    """
+    The PsychoPy modules a task runs with - the real ones, or the headless stand-ins of simulation.py
+    (simOptions = the simulated display and scanner, see simulation.install)
+    """
+
+    def __init__(self, simulate=False, simKeys=None, **simOptions):
+        self.simulate = simulate
+        if simulate:
+            import simulation
+            simOptions.setdefault('frameRate', 60)
+            modules = simulation.install(keys=simKeys, **simOptions)
+            self.gui, self.visual, self.core, self.event, self.launchScan = modules
+            self.Keyboard = self.event.Keyboard
+            self.listenThreaded = False  # keys are polled from the frame loop, on the virtual clock
+            self.getTime = self.core.virtualClock.getTime
+        else:
+            from psychopy import visual, core, event  # gui is only loaded if the dialog is needed
+            from psychopy.clock import getTime
+            try:
+                from psychopy.hardware.keyboard import Keyboard  # timestamps key presses at sub-millisecond resolution
+                self.listenThreaded = True
+            except ImportError:  # PsychoPy before 3.1
+                Keyboard = input_listener.EventKeyboard
+                self.listenThreaded = False
+            from psychopy.hardware.emulator import launchScan  # to read TTL pulse from MR scanner as trigger
+            self.gui = None
+            self.visual, self.core, self.event, self.Keyboard, self.launchScan = (visual, core, event, Keyboard,
+                                                                                  launchScan)
+            # the raw timer core.Clock counts from (getLastResetTime), which core.getTime does not: it starts at 0
+            # when PsychoPy is loaded. Anything timestamped off the frame loop is stamped on this one
+            self.getTime = getTime
+
+    def ask(self, expInfo, title):
+        """Show the participant dialog, False if cancelled"""
+        if self.gui is None:
+            from psychopy import gui
+            self.gui = gui
+        dlg = self.gui.DlgFromDict(dictionary=expInfo, title=title)
+        return dlg.OK is not False
+
+
+def open_window(psy, frameRateProfiles=None, remeasure=False):
+    """Full screen window, and the duration of one frame on it"""
+    win = psy.visual.Window(
+        size=(1440, 900), fullscr=True, screen=0,
+        allowGUI=False, allowStencil=False,
+        monitor='testMonitor', color=[0, 0, 0], colorSpace='rgb',
+        blendMode='avg', useFBO=True)
+    win.recordFrameIntervals = True
+
+    # frame rate of monitor, if we can measure it - cached per computer, screen and resolution (see startup.py)
+    frameRate = startup.frame_rate(win, frameRateProfiles, screen=0, remeasure=remeasure)
+    if frameRate is not None:
+        frameDur = 1.0 / round(frameRate)
+    else:
+        frameDur = 1.0 / 60.0  # could not measure, so guess
+        print('**WARNING: could not retrieve frame rate, had to assume 60fps. Experiment timings may be wrong**')
+    return win, frameRate, frameDur
+
+
+def hold(win, listener, seconds):
+    """
+    Leave the screen as it is for seconds, waking for the abort key (True if it was pressed). The window stops
+    timing frame intervals meanwhile: a held screen is a deliberate wait, not dropped frames for PsychoPy to warn
+    about and count
+    """
+    win.recordFrameIntervals = False
+    aborted = listener.wait_abort(max(seconds, 0))
+    win.recordFrameIntervals = True  # the next flip starts timing afresh
+    return aborted
+
+
+def new_glyph_cache(psy, win, scriptDir):
+    """
+    GlyphCache on win, taking its stimuli from the stimulus atlas in the data folder (see stimulus_atlas.py) - a
+    virtual display has nothing to rasterise, so it lays the texts out as usual
+    """
+    if psy.simulate:
+        return glyph_cache.GlyphCache(win, psy.visual.TextStim)
+    import stimulus_atlas  # keeps the texts rasterised on disk between launches
+    atlas = stimulus_atlas.StimulusAtlas(win, psy.visual.TextStim, psy.visual.ImageStim,
+                                         scriptDir + os.sep + u'data/stimulus_atlas')
+    return glyph_cache.GlyphCache(win, psy.visual.TextStim, atlas)
+
+
+##########
+#  TASKS #
+##########
+
+def run_task(psy, win, frameDur, protocol, thisExp, filename, glyphs=None, publisher=None, quiet=False):
+    """
+    Run one task on an open window: compile its frame plan, show the instructions, wait for the trigger, then the
+    rest blocks and trials. Adds a row per phase to thisExp, and saves the flip times, key presses and scanner
+    volumes next to filename (both None to keep no data).
+    glyphs = a glyph_cache.GlyphCache on win to reuse stimuli from (and add this task's to), e.g. across a session
+    publisher = a dashboard.Publisher to show the run on the operator dashboard
+    quiet = True to log the frame plan instead of printing it, e.g. when the task is run many times over
+    Returns whether the task ran to the end (False if the end experiment key was pressed), and its FrameLog.
+    """
+    from psychopy import data, logging
+    core = psy.core
+    doRest = protocol.get('doRest', 0)
+    trialnum = protocol.get('trialnum', 0)
+    end_exp_key = protocol.get('end_exp_key', 'escape')
+
+    # Compile the trials into a frame-by-frame plan now, so the whole schedule is fixed (and logged) before the
+    # trigger
+    phases = trial_phases(protocol)
+    for warning in frame_plan.check_plan(phases, frameDur):
+        print('** WARNING: ' + warning)
+    plan = frame_plan.compile_plan(phases, trialnum, frameDur)
+    for planTrial, planPhase, onsetFrame, onsetTime, nFrames in frame_plan.summarise_plan(plan, frameDur):
+        logging.exp('plan: trial %i %s onset frame %i (%.3f s), %i frames' % (planTrial, planPhase, onsetFrame,
+                                                                              onsetTime, nFrames))
+    if plan:
+        planSummary = 'Frame plan: %i frames, %.3f s (designed %.3f s)' % (
+            len(plan), len(plan) * frameDur, sum(phase.duration for phase in phases) * trialnum)
+        if quiet:
+            logging.exp(planSummary)
+        else:
+            print(planSummary)
+    trialPlans = frame_plan.split_trials(plan, trialnum)
+
+    # Record every flip against the plan: the trials are planned to start after the first rest block
+    if doRest == 1 or doRest == 3:
+        planStart = protocol['tResting_start']
+    else:
+        planStart = 0
+    frameLog = frame_log.FrameLog(frameDur, planStart, capacity=len(plan) + 2)  # room for the rest blocks too
+    runEnd = planStart + len(plan) * frameDur  # designed end of the run after the trigger
+    if doRest == 2 or doRest == 3:
+        runEnd += protocol['tResting_end']
+    nonSlip = protocol.get('non_slip', True)
+    if protocol.get('profile_frames', False):
+        import frame_profiler  # times each stage of every frame
+        profiler = frame_profiler.FrameProfiler(capacity=len(plan))
+        stamp = frame_profiler.stamp
+    else:
+        profiler = None
+    if publisher is not None:
+        phaseEnds = dict(((planTrial, planPhase), planStart + (onsetFrame + nFrames) * frameDur)
+                         for planTrial, planPhase, onsetFrame, onsetTime, nFrames
+                         in frame_plan.summarise_plan(plan, frameDur))
+        publisher.start_task(protocol.get('name', ''), frameDur, phaseEnds, runEnd)
+
+    # Every cue word and countdown number is laid out once here (or loaded from the stimulus atlas), then swapped
+    # in frame by frame
+    if glyphs is None:
+        glyphs = glyph_cache.GlyphCache(win, psy.visual.TextStim)
+    for phase in protocol.get('phases', []):
+        style = dict(DEFAULT_STYLE, **phase)
+        glyphs.add(phase['name'], frame_plan.plan_texts(plan, phase['name']),
+                   font=u'Arial',
+                   pos=style['pos'], height=style['height'], wrapWidth=style['wrapWidth'], ori=0,
+                   color=style['color'], colorSpace='rgb', opacity=1,
+                   alignHoriz='center', depth=0.0)
+    style = dict(DEFAULT_COUNTDOWN, **protocol.get('countdown', {}))
+    glyphs.add('timedisplay', frame_plan.plan_countdowns(plan),
+               font=u'Arial',
+               pos=style['pos'], height=style['height'], wrapWidth=None, ori=0,
+               color=style['color'], colorSpace='rgb', opacity=1,
+               alignHoriz='center', depth=0.0)
+    glyphs.add('fixation', [u'+'],
+               font=u'Arial',
+               pos=DEFAULT_STYLE['pos'], height=DEFAULT_STYLE['height'], wrapWidth=None, ori=0,
+               color=DEFAULT_STYLE['color'], colorSpace='rgb', opacity=1,
+               alignHoriz='center', depth=0.0)
+    if protocol.get('instructions'):
+        glyphs.add('Instruct', [protocol['instructions']],
+                   font=u'Arial',
+                   pos=DEFAULT_STYLE['pos'], height=0.15, wrapWidth=1, ori=0,
+                   color=DEFAULT_STYLE['color'], colorSpace='rgb', opacity=1,
+                   alignHoriz='center', depth=0.0)
+    glyphs.prerender()
+    frameLog.display = {'size': list(win.size), 'color': [float(value) for value in win.color],
+                        'styles': dict((name, glyphs.styles[name]) for name in ['timedisplay', 'fixation'] +
+                                       [phase['name'] for phase in protocol.get('phases', [])])}
+    if glyphs.atlas is not None:
+        glyphs.atlas.save()
+        logging.exp('stimulus atlas: %i texts loaded, %i rasterised'
+                    % (glyphs.atlas.loaded, glyphs.atlas.rasterised))
+    trialDraws = [glyphs.resolve(trialPlan) for trialPlan in trialPlans]  # what to draw on each frame of each trial
+    if protocol.get('hold_static', True):
+        trialRuns = [frame_plan.static_runs(trialPlan) for trialPlan in trialPlans]
+    else:
+        trialRuns = [[1] * len(trialPlan) for trialPlan in trialPlans]
+    fixation = glyphs.get('fixation', u'+')
+
+    # Record the end-tidal signal from now on, so there is a baseline before the trigger
+    physio = protocol.get('physio') or {}
+    if physio.get('source') and filename is not None:
+        import end_tidal  # finds end-tidal peaks as the signal is recorded
+        import physio_stream  # records the end-tidal signal on the task clock
+        recorder = physio_stream.PhysioRecorder(physio_stream.open_source(physio['source'], psy.getTime),
+                                                physio.get('channels', ['CO2', 'O2']), psy.getTime,
+                                                filename + '_physio.tsv')
+        recorder.start()
+    else:
+        recorder = None
+
+    # DISPLAY INSTRUCTIONS TO PARTICIPANT
+    if protocol.get('instructions'):
+        glyphs.draw('Instruct', protocol['instructions'])
+        win.flip()
+        psy.event.waitKeys(maxWait=300, keyList=['space'], timeStamped=False)  # space key to start or after a wait
+
+    # Listen for the abort key and scanner triggers from now on, off the frame loop
+    MRinfo = protocol.get('MRinfo', {'sync': 5, 'TR': 3, 'volumes': 300})
+    useTrigger = protocol.get('trigger', True)
+    if useTrigger:
+        triggerKeys = [str(MRinfo['sync'])]
+    else:
+        triggerKeys = []
+    listener = input_listener.InputListener(psy.Keyboard(), psy.getTime, [end_exp_key], triggerKeys,
+                                            threaded=psy.listenThreaded,
+                                            onEvent=publisher.key if publisher is not None else None)
+    listener.start()
+
+    # TRIGGER THE START OF THE TASK WITH MRI
+    triggerClock = core.Clock()  # reset by launchScan at the trigger
+    if useTrigger:
+        psy.launchScan(win, MRinfo, mode='scan', globalClock=triggerClock)
+    globalClock = core.Clock()  # to track the time since experiment started
+    triggerOffset = triggerClock.getTime() - globalClock.getTime()  # time from the trigger to the globalClock reset
+    if publisher is not None:
+        publisher.align(globalClock)
+        publisher.status('running')
+    if recorder is not None:
+        recorder.align(globalClock)
+        # end-tidal peaks and exhalation checks, reported to the operator as the run goes
+        timeline = end_tidal.planned_timeline(plan, frameDur, planStart, doRest)
+        monitor = end_tidal.EndTidalMonitor(recorder, timeline, protocol.get('exhalation_checks', []),
+                                            delta=physio.get('peak_delta', 3.0), delay=physio.get('delay', 0.0),
+                                            report=logging.warning)
+        monitor.start()
+    if useTrigger:
+        import scanner_sync  # counts scanner pulses and measures clock drift
+        pulses = scanner_sync.PulseTracker(MRinfo['TR'], MRinfo['volumes'])  # every volume after the first, too
+    else:
+        pulses = None
+
+    # Every phase row and key press is written to disk as the run goes, so an aborted or crashed run keeps its data
+    columns, rowFormat = frame_log.PHASE_COLUMNS, frame_log.PHASE_FORMAT
+    if pulses is not None:
+        columns, rowFormat = columns + frame_log.SCANNER_COLUMNS, rowFormat + frame_log.SCANNER_FORMAT
+    if filename is not None:
+        phaseWriter = data_writer.DataWriter(filename + '_phases.tsv', columns, rowFormat + '\n')
+        keyWriter = data_writer.DataWriter(filename + '_keys.tsv', ['time', 'key', 'kind'], '%.6f\t%s\t%s\n')
+    else:
+        phaseWriter = keyWriter = None
+
+    def log_phases(endTime=None):
+        """Data rows for the phases shown so far, re-anchored to the scanner volumes received so far"""
+        newEvents = listener.drain(globalClock)
+        if pulses is not None:
+            pulses.add_events(newEvents)
+        frame_log.add_phase_rows(thisExp, frameLog.phase_rows(endTime), triggerOffset, pulses, phaseWriter)
+        if filename is not None:
+            for event in newEvents:
+                keyWriter.add(event)
+            phaseWriter.flush()
+            keyWriter.flush()
+
+    # With non_slip, every deadline is counted from the trigger (globalClock = 0): a late flip is caught up by
+    # skipping frames of the plan, and the rest blocks end on time, so nothing carries over into what follows
+    completed = True
+    error = None  # whatever else ended the run, raised again once the data are saved
+    lastFlip = None  # time of the latest flip on globalClock
+    skipped = 0  # frames of the plan skipped to keep to it
+    try:
+        # REST BLOCK TO START?
+        if doRest == 1 or doRest == 3:
+            fixation.draw()
+            win.flip()
+            lastFlip = globalClock.getTime()
+            # planned for the first vsync after the trigger, the earliest it can go up
+            frameLog.add(lastFlip, 1 - frame_plan.to_frames(planStart, frameDur), -1, 'rest', u'+', '',
+                         listener.key_flags(frame_log.KEY_FLAGS), held=True)
+            if publisher is not None:
+                publisher.show(lastFlip, -1, 'rest', planStart)
+            if nonSlip:
+                restLeft = planStart - globalClock.getTime()
+                if plan:
+                    restLeft -= frameDur / 2  # so the first trial frame goes on the vsync nearest its planned time
+            else:
+                restLeft = protocol['tResting_start']
+            if hold(win, listener, restLeft):
+                raise Abort()
+
+        # START TRIALS
+        if plan:
+            # set up handler to look after randomisation of conditions etc
+            trials = data.TrialHandler(nReps=trialnum, method='sequential',
+                                       originPath=-1,
+                                       trialList=[None],
+                                       seed=None, name='trials')
+            for thisTrial in trials:
+                # every frame is already in the plan, with its glyphs: draw them and flip
+                trialPlan, frameDraws, frameRuns = (trialPlans[trials.thisN], trialDraws[trials.thisN],
+                                                    trialRuns[trials.thisN])
+                index = 0
+                while index < len(trialPlan):
+                    if profiler is not None:
+                        stamps = [stamp()]
+
+                    if listener.check_abort():
+                        raise Abort()
+                    if profiler is not None:
+                        stamps.append(stamp())
+
+                    if nonSlip and lastFlip is not None:
+                        # the frame planned for the coming vsync, past any the display fell behind on
+                        due = frame_plan.due_frame(lastFlip, planStart, frameDur) - trialPlan[0].frameN
+                        if due > index:
+                            skipped += min(due, len(trialPlan)) - index
+                            index = due
+                            if index >= len(trialPlan):
+                                break
+                    frame = trialPlan[index]
+                    if profiler is not None:
+                        stamps.append(stamp())
+
+                    for stim in frameDraws[index]:
+                        stim.draw()
+                    if profiler is not None:
+                        stamps.append(stamp())
+                    win.flip()
+                    if profiler is not None:
+                        stamps.append(stamp())
+                    lastFlip = globalClock.getTime()
+                    held = frameRuns[index] > WAKE_FRAMES + 1
+                    frameLog.add(lastFlip, frame.frameN, frame.trial, frame.phase, frame.text, frame.countdown,
+                                 listener.key_flags(frame_log.KEY_FLAGS), held)
+                    if publisher is not None:
+                        publisher.frame(lastFlip, frame.frameN, frame.trial, frame.phase)
+                    if profiler is not None:
+                        stamps.append(stamp())
+                        profiler.add(frameLog.n - 1, stamps)
+
+                    if held:
+                        # nothing on screen changes for a while: leave it, and sleep until just before the change
+                        # (waking for the abort key) rather than redrawing the same frame
+                        resume = index + frameRuns[index] - WAKE_FRAMES
+                        if nonSlip:
+                            holdEnd = planStart + (trialPlan[resume].frameN - 0.5) * frameDur
+                        else:
+                            holdEnd = lastFlip + (resume - index - 0.5) * frameDur
+                        if hold(win, listener, holdEnd - globalClock.getTime()):
+                            raise Abort()
+                        index = resume
+                    else:
+                        index += 1
+
+                # one data row per phase shown so far (the phase still on screen is added once it ends)
+                log_phases()
+
+        # REST BLOCK TO FINISH?
+        if doRest == 2 or doRest == 3:
+            fixation.draw()
+            win.flip()
+            lastFlip = globalClock.getTime()
+            frameLog.add(lastFlip, len(plan), -1, 'rest', u'+', '', listener.key_flags(frame_log.KEY_FLAGS),
+                         held=True)
+            if nonSlip:
+                restEnd = runEnd
+            else:
+                restEnd = lastFlip + protocol['tResting_end']
+            if publisher is not None:
+                publisher.show(lastFlip, -1, 'rest', restEnd)
+            if hold(win, listener, restEnd - globalClock.getTime()):
+                raise Abort()
+    except Abort:
+        completed = False
+    except BaseException as exception:
+        completed = False
+        error = exception
+        logging.error('run stopped by %r - saving the data so far' % exception)
+
+    try:
+        # When the run ended, and how far that drifted from its designed length
+        if frameLog.n:
+            if completed and plan and not (doRest == 2 or doRest == 3):
+                frameLog.endTime = lastFlip + frameDur  # the last frame stays up for one frame
+            else:
+                frameLog.endTime = globalClock.getTime()  # the end of the rest block, or the abort
+        if completed and frameLog.n:
+            endTime = frameLog.endTime
+            logging.warning('run: %.3f s after the trigger, designed %.3f s (drift %+.1f ms, %i frames skipped to '
+                            'keep to the plan)' % (endTime, runEnd, (endTime - runEnd) * 1000, skipped))
+
+        # Close the last phase, then save the time of every flip, and how well each phase kept to the plan
+        listener.stop()
+        if publisher is not None:
+            publisher.status('done' if completed else 'aborted')
+        if recorder is not None:
+            recorder.stop()
+            logging.exp('physio: %i samples, %i lost, %i lines skipped'
+                        % (recorder.buffer.written, recorder.lost, recorder.skipped))
+            monitor.stop()
+            monitor.save(filename + '_peaks.tsv', filename + '_exhalations.tsv')
+        log_phases(globalClock.getTime())
+        if filename is not None:
+            frameLog.save(filename + '_frames.bin')
+            frameLog.save_summary(filename + '_frames_summary.tsv')
+        if profiler is not None and profiler.n and filename is not None:
+            for row in profiler.save(filename, frameLog):
+                if row['stage'] == 'total':
+                    logging.exp('profile: %s %i frames, %.3f ms per frame on average, 99%% under %.3f ms, '
+                                'longest %.3f ms' % (row['phase'], row['frames'], row['mean'] * 1000,
+                                                     row['p99'] * 1000, row['max'] * 1000))
+            record, costs, interval = profiler.worst(frameLog, 1)[0]
+            logging.exp('profile: longest frame %i (trial %i %s): %s' % (
+                record['frameN'], record['trial'], frameLog.phases[record['phase']],
+                ', '.join('%s %.3f ms' % (stage, cost * 1000)
+                          for stage, cost in zip(frame_profiler.STAGES, costs))))
+
+        # Save the arrival time of every volume
+        if pulses is not None and filename is not None:
+            pulses.save(filename + '_volumes.tsv')
+            logging.exp('scanner: %i volumes, %i missed, drift %.1f ppm (%.6f s over the run)'
+                        % (len(pulses.pulses), pulses.missed(), pulses.drift_ppm(), pulses.total_drift()))
+    finally:
+        # the rows and key presses streamed so far are kept, even if the report above fails
+        if filename is not None:
+            phaseWriter.close()
+            keyWriter.close()
+    if error is not None:
+        raise error
+    return completed, frameLog
+
+
+def new_experiment(expInfo, expName, scriptDir):
+    """ExperimentHandler for one task run, and the file name stem its data files share"""
+    from psychopy import data
+    info = dict(expInfo, expName=expName)
+    # Data file name stem = absolute path + name; later add .psyexp, .csv, .log, etc
+    filename = scriptDir + os.sep + u'data/%s_%s_%s' % (info['Participant'], expName, info['date'])
+
+    # An ExperimentHandler isn't essential but helps with data saving
+    thisExp = data.ExperimentHandler(name=expName, version='',
+                                     extraInfo=info, runtimeInfo=None,
+                                     originPath=None,
+                                     savePickle=True, saveWideText=True,
+                                     dataFileName=filename)
+    return thisExp, filename
+
+
+def save_experiment(thisExp, filename):
+    from psychopy import logging
+    # These should auto-save but just in case:
+    thisExp.saveAsWideText(filename + '.csv')
+    thisExp.saveAsPickle(filename)
+    logging.flush()
+    thisExp.abort()  # or data files will save again on exit
+
+
+def add_parameters(thisExp, parameters):
+    """Keep the numeric task parameters with the data"""
+    for name, value in sorted(parameters.items()):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            thisExp.extraInfo[name] = value
+
+
+def frame_rate_profiles(psy, scriptDir):
+    """Where the measured frame rate is cached (see startup.py) - nothing to cache for a virtual display"""
+    if psy.simulate:
+        return None
+    return scriptDir + os.sep + u'data/frame_rate_profiles.json'
+
+
+def run(protocol, parameters, scriptDir, expName, launchOptions):
+    """Run one task from start to finish: dialog, data files, window, the task itself, save and close"""
+    from psychopy import data, logging
+    psy = Modules(simulate=parameters.get('simulate', False))
+    errors = task_protocol.check_protocol(protocol)
+    if errors:
+        for error in errors:
+            print('** WARNING: ' + error)
+        psy.core.quit()
+
+    # Define Paths & Data Saving
+    os.chdir(scriptDir)  # to ensure relative paths start from the same directory
+
+    expInfo = {'Participant': '', 'Session': '001'}
+    expInfo.update(launchOptions.info)
+    if protocol.get('dialog', True) and not expInfo['Participant']:  # not given at launch, so ask
+        if not psy.ask(expInfo, expName):
+            psy.core.quit()  # user pressed cancel
+    expInfo['date'] = data.getDateStr()  # add a simple timestamp
+
+    if protocol.get('dialog', True) or expInfo['Participant']:
+        thisExp, filename = new_experiment(expInfo, expName, scriptDir)
+        add_parameters(thisExp, parameters)
+        # save a log file for detailed info
+        logging.LogFile(filename + '.log', level=logging.EXP)
+    else:
+        # a task that never asks who is taking part (e.g. Fixation) keeps no data unless a participant is given
+        thisExp = filename = None
+    logging.console.setLevel(logging.WARNING)  # this outputs to the screen, not a file
+
+    win, frameRate, frameDur = open_window(psy, frame_rate_profiles(psy, scriptDir), launchOptions.remeasure)
+    if thisExp is not None:
+        thisExp.extraInfo['frameRate'] = frameRate
+
+    if parameters.get('dashboard_port'):
+        import dashboard  # shows the run to the operator, from another process
+        publisher = dashboard.Publisher(parameters['dashboard_port'])
+    else:
+        publisher = None
+
+    try:
+        completed, frameLog = run_task(psy, win, frameDur, protocol, thisExp, filename,
+                                       new_glyph_cache(psy, win, scriptDir), publisher)
+        if not completed:
+            logging.exp('run aborted with the end experiment key')
+    finally:
+        # whatever was collected, however the run ended
+        if filename is not None:
+            save_experiment(thisExp, filename)
+        # Close everything
+        if publisher is not None:
+            publisher.close()
+        win.close()
+    psy.core.quit()
+
+
+def run_script(namespace, protocolName):
+    """
+    Run a task script: namespace is the script's globals() - its CHANGE PARAMETERS fill in the protocol
+    protocols/<protocolName> (or the protocol file given with --protocol), command line / config file changes win
+    """
+    launchOptions = startup.parse_args(sys.argv[1:], description=namespace.get('__doc__'))
+    scriptDir = os.path.dirname(os.path.abspath(namespace['__file__']))
+    if launchOptions.protocol:
+        protocolFile = launchOptions.protocol
+    elif protocolName:
+        protocolFile = os.path.join(scriptDir, 'protocols', protocolName)
+    else:
+        sys.exit('no protocol to run - give one with --protocol')
+
+    protocol, parameters = task_protocol.load_task(namespace, protocolFile)
+    startup.apply_parameters(parameters, launchOptions.parameters, task_protocol.protocol_parameters(protocol))
+    run(task_protocol.resolve(protocol, parameters), parameters, scriptDir, os.path.basename(namespace['__file__']),
+        launchOptions)
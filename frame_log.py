@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Frame Log
+
+Keeps the time of every flip, tagged with the trial, phase and frame of the frame plan it showed, and saves it at
+the end of the run with a per-phase summary: dropped frames, frame interval jitter and phase onset error, all
+checked against the frameDur the plan was built with.
+Flip times are in seconds on globalClock (reset at the scanner trigger).
+
+Each flip is one fixed-width binary record in a preallocated array - frameN, flip time, trial, ids of the phase,
+text and countdown shown, and flags for the keys pressed since the previous flip - so the frame loop never formats
+text. The run is saved as _frames.bin (the records) and _frames.json (what the ids stand for); turn it into a
+table afterwards with
+
+    python frame_log.py data/P01_Breath_Hold.py_2026_Oct_18_1200_frames.bin --csv
+    python frame_log.py data/P01_Breath_Hold.py_2026_Oct_18_1200_frames.bin --parquet
+
+"""
+
+from __future__ import absolute_import, division
+import argparse
+import json
+import math
+import os
+import numpy as np
+
+# One flip: frameN, flip time on globalClock, trial (-1 outside the trials), then ids into the run's list of phase
+# names and of texts (the text shown, and the countdown - text id 0 is ''), and the keys pressed since the previous
+# flip (KEY_FLAGS bits), and whether the screen was then held on purpose (a rest block, or a screen left as it is
+# while nothing on it changes) rather than redrawn on the next vsync
+RECORD = np.dtype([('frameN', '<i4'), ('flip_time', '<f8'), ('trial', '<i2'), ('phase', '<u2'), ('text', '<u2'),
+                   ('countdown', '<u2'), ('keys', 'u1'), ('held', 'u1')])
+KEY_FLAGS = {'key': 1, 'trigger': 2, 'abort': 4}
+
+# The data row of each phase shown (see add_phase_rows), and how it is written to a file - the scanner columns are
+# only there when the scanner pulses are counted
+PHASE_COLUMNS = ['trial', 'phase', 'frameN', 'onset', 'offset', 'duration', 'onset_trigger', 'offset_trigger',
+                 'planned_onset']
+PHASE_FORMAT = '%i\t%s\t%i' + '\t%.6f' * 6
+SCANNER_COLUMNS = ['onset_scanner', 'offset_scanner', 'onset_volume']
+SCANNER_FORMAT = '\t%.6f' * 3
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of numbers (None if the list is empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def add_phase_rows(thisExp, rows, triggerOffset, pulses=None, writer=None):
+    """
+    Add phase rows to the ExperimentHandler (if there is one), one row each, with onset and offset on globalClock
+    and relative to the scanner trigger (triggerOffset = time from the trigger to the globalClock reset).
+    With a scanner_sync.PulseTracker, onset and offset are also given on the scanner's volume timeline.
+    With a data_writer.DataWriter (on PHASE_COLUMNS, and SCANNER_COLUMNS with pulses), each row is streamed to it too.
+    """
+    names = PHASE_COLUMNS
+    if pulses is not None:
+        names = PHASE_COLUMNS + SCANNER_COLUMNS
+    for row in rows:
+        values = (row['trial'], row['phase'], row['frameN'], row['onset'], row['offset'], row['duration'],
+                  row['onset'] + triggerOffset, row['offset'] + triggerOffset, row['planned_onset'])
+        if pulses is not None:
+            values += (pulses.to_scanner_time(row['onset']), pulses.to_scanner_time(row['offset']),
+                       pulses.to_volume(row['onset']))
+        if thisExp is not None:
+            for name, value in zip(names, values):
+                thisExp.addData(name, value)
+            thisExp.nextEntry()
+        if writer is not None:
+            writer.add(values)
+
+
+def _ms(seconds):
+    """Format seconds as milliseconds for the summary file"""
+    if seconds is None:
+        return 'n/a'
+    return '%.3f' % (seconds * 1000)
+
+
+class FrameLog(object):
+    """
+    Flip times of one run.
+    frameN is the frame index relative to the first frame of the first trial, so the planned time of any flip is
+    planStart + frameN * frameDur (frames shown before the trials, like the rest block, have negative frameN).
+    The wait after a rest block is not a frame interval: the first trial frame after it is only checked for its
+    onset, so neither the rest nor the trial are charged for it (see intervals).
+    capacity = number of flips to make room for up front (e.g. the length of the frame plan) - it grows if needed
+    """
+
+    def __init__(self, frameDur, planStart=0.0, capacity=1024):
+        self.frameDur = frameDur
+        self.planStart = planStart  # time of the first trial frame after the trigger, as designed
+        self.data = np.zeros(max(capacity, 1), dtype=RECORD)
+        self.n = 0  # flips recorded
+        self.phases = []  # phase names, by id
+        self.texts = ['']  # texts shown, by id
+        self.endTime = None  # when the last screen of the run came down, on globalClock
+        self.display = {}  # window size and colour, and the style of each stimulus - saved for replay.py
+        self._phaseIds = {}
+        self._textIds = {'': 0}
+        self._scanned = 0  # records already turned into phase rows
+        self._showing = None  # first record of the phase on screen, not yet turned into a row
+
+    def _id(self, ids, names, name):
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+        return ids[name]
+
+    def add(self, flipTime, frameN, trial, phase, text='', countdown='', keys=0, held=False):
+        if self.n == len(self.data):
+            self.data = np.concatenate([self.data, np.zeros(len(self.data), dtype=RECORD)])
+        self.data[self.n] = (frameN, flipTime, trial, self._id(self._phaseIds, self.phases, phase),
+                             self._id(self._textIds, self.texts, text),
+                             self._id(self._textIds, self.texts, countdown), keys, held)
+        self.n += 1
+
+    @property
+    def records(self):
+        """(flip time, frameN, trial, phase) of every flip"""
+        phases = self.phases
+        return [(flipTime, frameN, trial, phases[phase]) for flipTime, frameN, trial, phase
+                in zip(self.data['flip_time'][:self.n].tolist(), self.data['frameN'][:self.n].tolist(),
+                       self.data['trial'][:self.n].tolist(), self.data['phase'][:self.n].tolist())]
+
+    def planned_time(self, frameN):
+        return self.planStart + frameN * self.frameDur
+
+    def intervals(self):
+        """
+        (interval since the previous flip, planned interval, record) for every flip meant to follow the previous one
+        on the next vsync, so the planned interval is one frame - a frame of the plan skipped to catch up is still
+        dropped. Flips after a held screen (a rest block, or a screen left as it is) are left out: a hold is a
+        deliberate wait, not a dropped frame
+        """
+        records = self.records
+        held = self.data['held'][:self.n].tolist()
+        return [(record[0] - previous[0], self.frameDur, record)
+                for previous, record, wasHeld in zip(records[:-1], records[1:], held[:-1]) if not wasHeld]
+
+    def onsets(self):
+        """The first flip of every phase of every trial"""
+        onsets = []
+        for record in self.records:
+            if not onsets or onsets[-1][2] != record[2] or onsets[-1][3] != record[3]:
+                onsets.append(record)
+        return onsets
+
+    def _phase_row(self, onset, offsetTime):
+        flipTime, frameN, trial, phase = onset
+        return {'trial': trial, 'phase': phase, 'frameN': frameN,
+                'onset': flipTime, 'offset': offsetTime, 'duration': offsetTime - flipTime,
+                'planned_onset': self.planned_time(frameN)}
+
+    def phase_rows(self, endTime=None):
+        """
+        One row per phase that has finished since the last call: onset is its first flip, offset the first flip of
+        whatever replaced it. Pass endTime to close the phase still on screen too (at the end of the run, or abort).
+        Call between trials - it only reads the flips already recorded.
+        """
+        rows = []
+        new = self.data[self._scanned:self.n]
+        for record in zip(new['flip_time'].tolist(), new['frameN'].tolist(), new['trial'].tolist(),
+                          [self.phases[phase] for phase in new['phase'].tolist()]):
+            if self._showing is None:
+                self._showing = record
+            elif record[2] != self._showing[2] or record[3] != self._showing[3]:
+                rows.append(self._phase_row(self._showing, record[0]))
+                self._showing = record
+        self._scanned = self.n
+        if endTime is not None and self._showing is not None:
+            rows.append(self._phase_row(self._showing, endTime))
+            self._showing = None
+        return rows
+
+    def save(self, fileName):
+        """
+        The records as fixed-width binary (fileName, e.g. ..._frames.bin), and next to it a JSON file with what
+        their ids stand for and the timing they are checked against (see load)
+        """
+        self.data[:self.n].tofile(fileName)
+        with open(os.path.splitext(fileName)[0] + '.json', 'w') as metaFile:
+            json.dump({'records': self.n, 'dtype': RECORD.descr, 'frameDur': self.frameDur,
+                       'planStart': self.planStart, 'phases': self.phases, 'texts': self.texts,
+                       'keyFlags': KEY_FLAGS, 'endTime': self.endTime,
+                       'display': self.display}, metaFile, indent=1)
+
+    def summary(self):
+        """
+        Per phase (and for the whole run): number of flips timed, dropped frames (the whole frames an interval ran
+        over its planned length), jitter of the frame intervals around their planned length and onset error
+        against plan. Held screens are not drops: only the intervals from intervals() are counted
+        """
+        phases = []
+        intervals = {}
+        onsetErrors = {}
+        for interval, plannedInterval, record in self.intervals():
+            phase = record[3]
+            if phase not in intervals:
+                phases.append(phase)
+                intervals[phase] = []
+            intervals[phase].append(interval - plannedInterval)
+        for flipTime, frameN, trial, phase in self.onsets():
+            if phase not in phases:
+                phases.append(phase)
+            onsetErrors.setdefault(phase, []).append(flipTime - self.planned_time(frameN))
+        intervals['all'] = [interval - plannedInterval for interval, plannedInterval, record in self.intervals()]
+        onsetErrors['all'] = [error for phase in onsetErrors for error in onsetErrors[phase]]
+
+        rows = []
+        for phase in phases + ['all']:
+            overruns = intervals.get(phase, [])  # interval minus its planned length
+            errors = onsetErrors.get(phase, [])
+            dropped = sum(int(round(overrun / self.frameDur)) for overrun in overruns
+                          if overrun > 0.5 * self.frameDur)
+            jitter = [abs(overrun) for overrun in overruns]
+            rows.append({'phase': phase,
+                         'flips': len(overruns),
+                         'dropped': dropped,
+                         'jitter_p50': percentile(jitter, 50),
+                         'jitter_p95': percentile(jitter, 95),
+                         'jitter_p99': percentile(jitter, 99),
+                         'jitter_max': max(jitter) if jitter else None,
+                         'onsets': len(errors),
+                         'onset_error_mean': sum(errors) / len(errors) if errors else None,
+                         'onset_error_max': max(errors, key=abs) if errors else None})
+        return rows
+
+    def save_summary(self, fileName):
+        """Per-phase summary, times in milliseconds"""
+        with open(fileName, 'w') as summaryFile:
+            summaryFile.write('phase\tflips\tdropped\tjitter_p50_ms\tjitter_p95_ms\tjitter_p99_ms\tjitter_max_ms\t'
+                              'onsets\tonset_error_mean_ms\tonset_error_max_ms\n')
+            for row in self.summary():
+                summaryFile.write('%s\t%i\t%i\t%s\t%s\t%s\t%s\t%i\t%s\t%s\n' % (
+                    row['phase'], row['flips'], row['dropped'], _ms(row['jitter_p50']), _ms(row['jitter_p95']),
+                    _ms(row['jitter_p99']), _ms(row['jitter_max']), row['onsets'], _ms(row['onset_error_mean']),
+                    _ms(row['onset_error_max'])))
+            summaryFile.write('# frameDur = %.6f s, planned start of first trial = %.3f s after trigger\n'
+                              % (self.frameDur, self.planStart))
+
+
+##############
+#  EXPORTING #
+##############
+
+def load(fileName):
+    """The records of a saved frame log (..._frames.bin) and the contents of its JSON file"""
+    with open(os.path.splitext(fileName)[0] + '.json') as metaFile:
+        meta = json.load(metaFile)
+    return np.fromfile(fileName, dtype=[tuple(field) for field in meta['dtype']]), meta  # as it was saved
+
+
+def to_columns(records, meta):
+    """A saved frame log as named columns, with the ids turned back into names and the planned time of every flip"""
+    phases = np.array(meta['phases'], dtype=object)
+    texts = np.array(meta['texts'], dtype=object)
+    interval = np.concatenate([[np.nan], np.diff(records['flip_time'])])
+    columns = [('flip_time', records['flip_time']),
+               ('interval', interval),
+               ('planned_time', meta['planStart'] + records['frameN'] * meta['frameDur']),
+               ('frameN', records['frameN']),
+               ('trial', records['trial']),
+               ('phase', phases[records['phase']] if len(phases) else np.array([], dtype=object)),
+               ('text', texts[records['text']]),
+               ('countdown', texts[records['countdown']])]
+    for kind, flag in sorted(meta['keyFlags'].items(), key=lambda item: item[1]):
+        columns.append((kind, (records['keys'] & flag) > 0))
+    if 'held' in records.dtype.names:
+        columns.append(('held', records['held'] > 0))
+    return columns
+
+
+def export_csv(fileName, outFile, delimiter=','):
+    """A saved frame log as a CSV (or, with delimiter='\\t', TSV) table"""
+    columns = to_columns(*load(fileName))
+    with open(outFile, 'w') as table:
+        table.write(delimiter.join(name for name, values in columns) + '\n')
+        text = [np.char.mod('%.6f', values) if values.dtype.kind == 'f' else np.asarray(values).astype(str)
+                for name, values in columns]
+        text[1][:1] = ''  # no interval before the first flip
+        for row in zip(*text):
+            table.write(delimiter.join(row) + '\n')
+
+
+def export_parquet(fileName, outFile):
+    """A saved frame log as a Parquet table (needs pyarrow)"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('exporting to Parquet needs pyarrow: pip install pyarrow')
+    columns = to_columns(*load(fileName))
+    table = pyarrow.table(dict((name, pyarrow.array(values.tolist() if values.dtype == object else values))
+                               for name, values in columns))
+    pyarrow.parquet.write_table(table, outFile)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export a saved frame log (..._frames.bin) as a table')
+    parser.add_argument('frames', nargs='+', help='_frames.bin file(s)')
+    parser.add_argument('--csv', action='store_true', help='write a .csv next to each file')
+    parser.add_argument('--tsv', action='store_true', help='write a .tsv next to each file')
+    parser.add_argument('--parquet', action='store_true', help='write a .parquet next to each file')
+    args = parser.parse_args(argv)
+    if not (args.csv or args.tsv or args.parquet):
+        args.csv = True
+    for fileName in args.frames:
+        stem = os.path.splitext(fileName)[0]
+        if args.csv:
+            export_csv(fileName, stem + '.csv')
+        if args.tsv:
+            export_csv(fileName, stem + '.tsv', delimiter='\t')
+        if args.parquet:
+            export_parquet(fileName, stem + '.parquet')
+
+
+if __name__ == '__main__':
+    main()
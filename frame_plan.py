@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Frame Plan
+
+Compiles the phases of a breathing task into a flat, frame-indexed render plan before the task starts.
+Each entry of the plan says which stimulus is on screen for that frame and what text it shows, so the trial loop
+only has to look the entry up, draw it and flip - no timers are created and nothing is decided while the
+participant is watching. Phase onsets are fixed to the frame, and the whole schedule can be checked up front.
+
+"""
+
+from __future__ import absolute_import, division
+from collections import namedtuple
+import math
+
+# One phase of a trial:
+#   name = name of the stimulus shown during the phase (e.g. 'pace', 'hold')
+#   duration = length of the phase in seconds
+#   text = text shown, or None to alternate 'IN' / 'OUT' every half breathPace
+#   countdown = True to show the seconds remaining underneath
+#   breathPace = duration of one breath in + out in seconds (only used when text is None)
+Phase = namedtuple('Phase', ['name', 'duration', 'text', 'countdown', 'breathPace'])
+
+# One frame of the plan (frameN counts from the first frame of the first trial, countdown is '' when not shown)
+PlanFrame = namedtuple('PlanFrame', ['frameN', 'trial', 'phase', 'text', 'countdown'])
+
+
+def to_frames(seconds, frameDur):
+    """Number of whole frames closest to a duration in seconds"""
+    return int(round(seconds / frameDur))
+
+
+def due_frame(flipTime, planStart, frameDur):
+    """
+    frameN planned for the vsync after a flip at flipTime (seconds on the clock planStart is on) - the frame to
+    draw next to keep to the plan, whatever was dropped before
+    """
+    return to_frames(flipTime + frameDur - planStart, frameDur)
+
+
+def _cue(phase, frameOffset, frameDur):
+    """Text shown on a given frame of a phase"""
+    if phase.text is not None:
+        return phase.text
+    # index of the half breath this frame falls into - boundaries are rounded to the nearest frame
+    halfBreath = phase.breathPace / 2
+    half = int(math.ceil(round((frameOffset + 0.5) * frameDur / halfBreath, 6))) - 1
+    if half % 2 == 0:
+        return u'IN'
+    return u'OUT'
+
+
+def _countdown(nFrames, frameOffset, frameDur):
+    """Whole seconds remaining in the phase, counting down to 1 (never shows 0)"""
+    remaining = (nFrames - frameOffset) * frameDur
+    return str(int(math.ceil(round(remaining, 6))))
+
+
+def compile_plan(phases, trialnum, frameDur):
+    """
+    Build the frame-by-frame plan for trialnum repeats of phases.
+    Phase boundaries are placed on the frame closest to their ideal onset from the start of the first trial,
+    so rounding to whole frames never accumulates over trials.
+    """
+    plan = []
+    tOnset = 0.0
+    for trial in range(trialnum):
+        for phase in phases:
+            firstFrame = to_frames(tOnset, frameDur)
+            nFrames = to_frames(tOnset + phase.duration, frameDur) - firstFrame
+            for frameOffset in range(nFrames):
+                if phase.countdown:
+                    countdown = _countdown(nFrames, frameOffset, frameDur)
+                else:
+                    countdown = ''
+                plan.append(PlanFrame(firstFrame + frameOffset, trial, phase.name,
+                                      _cue(phase, frameOffset, frameDur), countdown))
+            tOnset += phase.duration
+    return plan
+
+
+def split_trials(plan, trialnum):
+    """Split the plan into one list of frames per trial"""
+    trialPlans = [[] for trial in range(trialnum)]
+    for frame in plan:
+        trialPlans[frame.trial].append(frame)
+    return trialPlans
+
+
+def static_runs(plan):
+    """
+    For every frame of the plan, how many frames from it on show exactly the same thing (phase, text and
+    countdown) - the frames the screen can simply be left as it is
+    """
+    runs = [1] * len(plan)
+    for n in range(len(plan) - 2, -1, -1):
+        frame, following = plan[n], plan[n + 1]
+        if (frame.phase, frame.text, frame.countdown) == (following.phase, following.text, following.countdown):
+            runs[n] = runs[n + 1] + 1
+    return runs
+
+
+def plan_texts(plan, phase):
+    """Every text shown during a phase, in order of first appearance"""
+    texts = []
+    for frame in plan:
+        if frame.phase == phase and frame.text not in texts:
+            texts.append(frame.text)
+    return texts
+
+
+def plan_countdowns(plan):
+    """Every countdown value shown anywhere in the plan"""
+    countdowns = set(frame.countdown for frame in plan if frame.countdown)
+    return sorted(countdowns, key=int)
+
+
+def summarise_plan(plan, frameDur):
+    """
+    List every phase of the plan as (trial, phase, onset frame, onset in seconds, number of frames),
+    in the order they will be shown
+    """
+    blocks = []
+    for frame in plan:
+        if blocks and blocks[-1][0] == frame.trial and blocks[-1][1] == frame.phase:
+            blocks[-1][4] += 1
+        else:
+            blocks.append([frame.trial, frame.phase, frame.frameN, frame.frameN * frameDur, 1])
+    return [tuple(block) for block in blocks]
+
+
+def check_plan(phases, frameDur):
+    """Return a list of warnings about phases that cannot be shown as designed at this frame rate"""
+    warnings = []
+    for phase in phases:
+        if to_frames(phase.duration, frameDur) < 1:
+            warnings.append('phase ' + phase.name + ' (' + str(phase.duration) + ' s) is shorter than one frame')
+        if phase.text is None and to_frames(phase.breathPace / 2, frameDur) < 1:
+            warnings.append('phase ' + phase.name + ': half a breath (' + str(phase.breathPace / 2) +
+                            ' s) is shorter than one frame')
+    return warnings
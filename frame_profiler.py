@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Frame Profiler
+
+Times each stage of every trial frame, to find where the time went when a frame drops: reading the keys, picking
+the frame of the plan, drawing the stimuli, waiting in win.flip() (which also draws any autoDraw stimuli and waits
+for the vsync), and logging the flip. Each stage is stamped with time.perf_counter into a preallocated array, so the
+frame loop does no more than read the clock and store one row; the costs are worked out at the end of the run.
+Deliberate waits, e.g. while a static screen is held, are not counted.
+
+Saved at the end of the run, next to the frame log:
+    _frame_profile.tsv        per phase and stage: frames, mean, 99th percentile and largest cost, and a histogram
+    _frame_profile_worst.tsv  the frames that took longest from the top of the loop to the end of logging, with
+                              the cost of each stage and the interval since the previous flip
+Turn it on with profile_frames (see engine.py); when off, the frame loop only checks one flag per stage.
+
+"""
+
+from __future__ import absolute_import, division
+import time
+import numpy as np
+
+STAGES = ['keys', 'plan', 'draw', 'flip', 'log']  # in the order they happen in the frame loop
+BINS_MS = [0, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20]  # lower edges of the histogram bins, the last one open
+WORST = 20  # frames listed in _frame_profile_worst.tsv
+
+stamp = time.perf_counter  # the clock stages are timed on: monotonic, sub-microsecond
+
+
+class FrameProfiler(object):
+    """
+    Stage timings of the frames of one run, each tied to the FrameLog record of its flip.
+    capacity = number of frames to make room for up front (e.g. the length of the frame plan) - it grows if needed
+    """
+
+    def __init__(self, capacity=1024):
+        self.stamps = np.zeros((max(capacity, 1), len(STAGES) + 1))  # the top of the loop, then the end of each stage
+        self.records = np.zeros(max(capacity, 1), dtype=int)  # FrameLog record of each frame
+        self.n = 0  # frames timed
+
+    def add(self, record, stamps):
+        """Timings of one frame: record = its index in the FrameLog, stamps = STAGES + 1 times from stamp()"""
+        if self.n == len(self.stamps):
+            self.stamps = np.vstack([self.stamps, np.zeros(self.stamps.shape)])
+            self.records = np.concatenate([self.records, np.zeros(len(self.records), dtype=int)])
+        self.stamps[self.n] = stamps
+        self.records[self.n] = record
+        self.n += 1
+
+    def costs(self):
+        """Seconds spent in each stage of each frame (frames x STAGES)"""
+        return np.diff(self.stamps[:self.n], axis=1)
+
+    def histograms(self, frameLog):
+        """Per phase (in order of first appearance) and stage: frames, mean, 99th percentile, largest and bin counts"""
+        costs = self.costs()
+        phaseIds = frameLog.data['phase'][self.records[:self.n]]
+        edges = np.array(BINS_MS + [np.inf]) / 1000.0
+        rows = []
+        for phaseId in sorted(set(phaseIds.tolist()), key=phaseIds.tolist().index):
+            phaseCosts = costs[phaseIds == phaseId]
+            for column, stage in enumerate(STAGES + ['total']):
+                values = phaseCosts.sum(axis=1) if stage == 'total' else phaseCosts[:, column]
+                rows.append({'phase': frameLog.phases[phaseId], 'stage': stage, 'frames': len(values),
+                             'mean': values.mean(), 'p99': np.percentile(values, 99), 'max': values.max(),
+                             'counts': np.histogram(values, edges)[0]})
+        return rows
+
+    def worst(self, frameLog, number=WORST):
+        """The number frames with the longest total cost, longest first: (record, stage costs, flip interval)"""
+        costs = self.costs()
+        order = np.argsort(-costs.sum(axis=1), kind='stable')[:number]
+        flipTimes = frameLog.data['flip_time']
+        return [(frameLog.data[self.records[n]], costs[n],
+                 flipTimes[self.records[n]] - flipTimes[self.records[n] - 1] if self.records[n] else None)
+                for n in order]
+
+    def save(self, fileStem, frameLog):
+        """Write fileStem + '_frame_profile.tsv' and '_frame_profile_worst.tsv'; returns the histogram rows"""
+        rows = self.histograms(frameLog)
+        with open(fileStem + '_frame_profile.tsv', 'w') as profileFile:
+            profileFile.write('\t'.join(['phase', 'stage', 'frames', 'mean_ms', 'p99_ms', 'max_ms'] +
+                                        ['%g-%g_ms' % (low, high) for low, high in zip(BINS_MS[:-1], BINS_MS[1:])] +
+                                        ['%g+_ms' % BINS_MS[-1]]) + '\n')
+            for row in rows:
+                profileFile.write('%s\t%s\t%i\t%.4f\t%.4f\t%.4f\t' % (row['phase'], row['stage'], row['frames'],
+                                                                      row['mean'] * 1000, row['p99'] * 1000,
+                                                                      row['max'] * 1000) +
+                                  '\t'.join('%i' % count for count in row['counts']) + '\n')
+        with open(fileStem + '_frame_profile_worst.tsv', 'w') as worstFile:
+            worstFile.write('\t'.join(['frameN', 'trial', 'phase', 'flip_time', 'interval_ms'] +
+                                      [stage + '_ms' for stage in STAGES] + ['total_ms']) + '\n')
+            for record, costs, interval in self.worst(frameLog):
+                fields = ['%i' % record['frameN'], '%i' % record['trial'], frameLog.phases[record['phase']],
+                          '%.6f' % record['flip_time'], 'n/a' if interval is None else '%.3f' % (interval * 1000)]
+                fields += ['%.3f' % (cost * 1000) for cost in costs] + ['%.3f' % (costs.sum() * 1000)]
+                worstFile.write('\t'.join(fields) + '\n')
+        return rows
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Glyph Cache
+
+Lays out every text a task can show (cue words and countdown numbers) once, straight after the Window is created,
+and keeps one ready-rendered stimulus per text. The frame loop then swaps between cached stimuli instead of
+assigning .text on every frame, which makes PsychoPy re-check and often re-rasterise the TextStim.
+One cache can serve several tasks on the same Window (see session.py): texts already laid out in the same style
+are reused. With a stimulus_atlas.StimulusAtlas, texts rasterised on an earlier launch are loaded from disk instead
+of being laid out again.
+
+"""
+
+from __future__ import absolute_import, division
+
+
+class GlyphCache(object):
+    """Ready-rendered text stimuli, looked up by (stimulus name, text)"""
+
+    def __init__(self, win, textStim, atlas=None):
+        self.win = win
+        self.textStim = textStim  # stimulus class used to lay out the text, i.e. visual.TextStim
+        self.atlas = atlas  # where to get the stimuli from instead, already rasterised (or None)
+        self.glyphs = {}
+        self.styles = {}  # stimulus name: the stimArgs its glyphs were laid out with
+
+    def add(self, name, texts, **stimArgs):
+        """
+        Lay out one stimulus per text, all sharing the same font, position, height, colour etc.
+        Adding a name again in a different style lays its texts out again, in the new style
+        """
+        if name in self.styles and self.styles[name] != stimArgs:
+            for key in [key for key in self.glyphs if key[0] == name]:
+                del self.glyphs[key]
+        self.styles[name] = stimArgs
+        for text in texts:
+            if (name, text) in self.glyphs:
+                continue
+            if self.atlas is not None:
+                self.glyphs[(name, text)] = self.atlas.stimulus(name + '_' + text, text, stimArgs)
+            else:
+                self.glyphs[(name, text)] = self.textStim(win=self.win, name=name + '_' + text, text=text,
+                                                          **stimArgs)
+
+    def get(self, name, text):
+        return self.glyphs[(name, text)]
+
+    def draw(self, name, text):
+        self.glyphs[(name, text)].draw()
+
+    def prerender(self):
+        """Draw every glyph once off-screen so its texture is uploaded before the first real frame"""
+        for glyph in self.glyphs.values():
+            glyph.draw()
+        self.win.clearBuffer()
+
+    def resolve(self, plan, countdownName='timedisplay'):
+        """
+        Turn each frame of a frame plan into the tuple of cached stimuli to draw on that frame,
+        so the frame loop does not even have to look the glyphs up
+        """
+        frames = []
+        for frame in plan:
+            if frame.countdown:
+                frames.append((self.glyphs[(frame.phase, frame.text)], self.glyphs[(countdownName, frame.countdown)]))
+            else:
+                frames.append((self.glyphs[(frame.phase, frame.text)],))
+        return frames
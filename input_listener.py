@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Input Listener
+
+Reads the keyboard on a background thread, through PsychoPy's keyboard backend (psychopy.hardware.keyboard), which
+timestamps every key press at sub-millisecond resolution. Presses go into a queue the frame loop can empty without
+ever blocking, and the abort key raises a flag, so ending the experiment and logging scanner triggers no longer
+depend on the frame rate - and no key is missed during long rest blocks.
+PsychoPy before 3.1 has no keyboard backend: EventKeyboard reads psychopy.event instead, polled from the frame loop
+(it is not safe to read from another thread), so presses are timed to within a frame.
+
+"""
+
+from __future__ import absolute_import, division
+from collections import deque
+import threading
+import time
+
+
+class KeyPress(object):
+    """A key press read by EventKeyboard: its name, and when it went down on core.getTime"""
+
+    def __init__(self, name, tDown):
+        self.name = name
+        self.tDown = tDown
+
+
+class EventKeyboard(object):
+    """
+    psychopy.hardware.keyboard.Keyboard for PsychoPy before 3.1, reading psychopy.event - its press times are on
+    core.getTime, so its clock is core.monotonicClock
+    """
+
+    def __init__(self):
+        from psychopy import core, event
+        self.event = event
+        self.clock = core.monotonicClock
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        return [KeyPress(name, t) for name, t in self.event.getKeys(keyList=keyList, timeStamped=True)]
+
+    def waitKeys(self, maxWait=float('inf'), keyList=None, waitRelease=True, clear=True):
+        keys = self.event.waitKeys(maxWait=maxWait, keyList=keyList, timeStamped=True)
+        return [KeyPress(name, t) for name, t in keys or []]
+
+    def clearEvents(self, eventType=None):
+        self.event.clearEvents(eventType)
+
+
+class InputListener(object):
+    """
+    Collects key presses as (time, key name, kind), kind being 'abort', 'trigger' or 'key'.
+    keyboard = psychopy.hardware.keyboard.Keyboard (or EventKeyboard, or the simulation stand-in) - its press times
+    are taken to be on its own clock if it has one (keyboard.clock), otherwise on getTime
+    getTime = the raw timer key press times are kept on, the one core.Clock counts from (psychopy.clock.getTime)
+    threaded = False polls the keyboard from the frame loop instead, e.g. when running on a virtual clock
+    onEvent = function also given (time, key name, kind) of every press as it is read, e.g. to show it on the dashboard
+    pollInterval = seconds between reads of the keyboard - the backend times each press itself, so this only sets
+    how soon the abort key is seen
+    """
+
+    def __init__(self, keyboard, getTime, abortKeys, triggerKeys=(), threaded=True, pollInterval=0.01,
+                 onEvent=None):
+        self.keyboard = keyboard
+        self.getTime = getTime
+        self.abortKeys = list(abortKeys)
+        self.triggerKeys = list(triggerKeys)
+        self.threaded = threaded
+        self.pollInterval = pollInterval
+        self.onEvent = onEvent
+        self.events = deque()  # appended by the listener, emptied by drain() - both ends are thread safe
+        self.aborted = False
+        self.counts = {'key': 0, 'trigger': 0, 'abort': 0}  # presses of each kind so far
+        self._flagged = dict(self.counts)  # counts at the last key_flags()
+        self._abortEvent = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self.keyboard.clearEvents()
+        if self.threaded:
+            self._running = True
+            self._thread = threading.Thread(target=self._listen, name='InputListener')
+            self._thread.daemon = True  # never keeps the experiment from closing
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.poll()  # anything pressed since the last poll
+
+    def _listen(self):
+        while self._running:
+            self.poll()
+            time.sleep(self.pollInterval)
+
+    def poll(self):
+        """Move any new key presses from the keyboard into the queue"""
+        self._store(self.keyboard.getKeys(waitRelease=False, clear=True))
+
+    def _store(self, keys):
+        clock = getattr(self.keyboard, 'clock', None)
+        offset = clock.getLastResetTime() if clock is not None else 0.0  # from the keyboard's clock to getTime
+        for key in keys:
+            if key.name in self.abortKeys:
+                kind = 'abort'
+            elif key.name in self.triggerKeys:
+                kind = 'trigger'
+            else:
+                kind = 'key'
+            tDown = key.tDown + offset
+            self.events.append((tDown, key.name, kind))
+            self.counts[kind] += 1
+            if self.onEvent is not None:
+                self.onEvent(tDown, key.name, kind)
+            if kind == 'abort':
+                self.aborted = True
+                self._abortEvent.set()
+
+    def check_abort(self):
+        """True once the abort key has been pressed - never blocks"""
+        if not self.threaded:
+            self.poll()
+        return self.aborted
+
+    def wait_abort(self, timeout):
+        """Wait up to timeout seconds, returning True straight away if the abort key is pressed"""
+        if self.threaded:
+            return self._abortEvent.wait(timeout)
+        deadline = self.getTime() + timeout
+        while not self.aborted and self.getTime() < deadline:
+            keys = self.keyboard.waitKeys(maxWait=deadline - self.getTime(), waitRelease=False, clear=True)
+            self._store(keys or [])
+        return self.aborted
+
+    def key_flags(self, flags):
+        """
+        The kinds of key pressed since the last call, as the sum of their flags ({kind: bit}, see frame_log) -
+        cheap enough for every frame
+        """
+        pressed = 0
+        for kind, flag in flags.items():
+            count = self.counts[kind]
+            if count != self._flagged[kind]:
+                self._flagged[kind] = count
+                pressed += flag
+        return pressed
+
+    def drain(self, clock):
+        """Empty the queue, returning (time on clock, key name, kind) for every key pressed since the last call"""
+        offset = clock.getLastResetTime()
+        events = []
+        while self.events:
+            tDown, name, kind = self.events.popleft()
+            events.append((tDown - offset, name, kind))
+        return events
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Physio Stream
+
+Records the end-tidal CO2 / O2 signal alongside the task, on the same clock. A background thread reads a streaming
+source - a serial port, a local socket, or a recorded file replayed for testing - and stamps every sample on
+arrival with the raw timer globalClock counts from (psychopy.clock.getTime - not core.getTime, which starts at 0
+when PsychoPy is loaded) into a preallocated ring buffer. A second thread writes the buffer to disk in chunks, with
+times on globalClock (so 0 is the scanner trigger, and samples from before the trigger have negative times).
+Neither thread ever waits on the frame loop, and the frame loop never waits on them.
+
+A source is given as a string:
+    serial:COM3:9600             serial port (and baud rate), needs pyserial
+    socket:127.0.0.1:5005        TCP stream from e.g. the gas analyser software, one sample per line
+    replay:recording.txt:100     a text file of samples, replayed at 100 samples per second
+Each line of the stream is one sample: numbers separated by spaces, tabs or commas (other lines are skipped).
+
+"""
+
+from __future__ import absolute_import, division
+import re
+import socket
+import threading
+import time
+import numpy as np
+
+DEFAULT_CAPACITY = 2 ** 20  # samples the ring buffer holds - over 17 minutes at 1 kHz
+CHUNK_INTERVAL = 0.5  # seconds between writes to disk
+
+_separators = re.compile(r'[\s,;]+')
+
+
+def parse_line(line, channels):
+    """The first channels numbers on a line of the stream, or None if it is not a sample (e.g. a header)"""
+    fields = [field for field in _separators.split(line.strip()) if field]
+    if len(fields) < channels:
+        return None
+    try:
+        return [float(field) for field in fields[:channels]]
+    except ValueError:
+        return None
+
+
+############
+#  SOURCES #
+############
+
+# A source has read(), returning the new samples as a list of (time or None, line) - None to stamp the sample on
+# arrival - waiting at most about a tenth of a second, and close().
+
+class SerialSource(object):
+    """Lines from a serial port"""
+
+    def __init__(self, port, baudrate=9600, timeout=0.1):
+        import serial  # pyserial, installed with PsychoPy - only needed for this source
+        self.port = serial.Serial(port, baudrate=baudrate, timeout=timeout)
+
+    def read(self):
+        line = self.port.readline()
+        if not line:
+            return []
+        samples = [(None, line.decode('ascii', 'replace'))]
+        while self.port.in_waiting:
+            samples.append((None, self.port.readline().decode('ascii', 'replace')))
+        return samples
+
+    def close(self):
+        self.port.close()
+
+
+class SocketSource(object):
+    """Lines from a TCP stream"""
+
+    def __init__(self, host, port, timeout=0.1):
+        self.socket = socket.create_connection((host, port), timeout=5)
+        self.socket.settimeout(timeout)
+        self._partial = b''
+
+    def read(self):
+        try:
+            received = self.socket.recv(65536)
+        except socket.timeout:
+            return []
+        if not received:  # the other end closed the stream
+            time.sleep(0.1)
+            return []
+        lines = (self._partial + received).split(b'\n')
+        self._partial = lines.pop()
+        return [(None, line.decode('ascii', 'replace')) for line in lines]
+
+    def close(self):
+        self.socket.close()
+
+
+class ReplaySource(object):
+    """
+    A recorded text file played back at rate samples per second from the first read, on getTime - each sample is
+    stamped with the time it is due, so a replay on simulation's virtual clock gives the same times as in real time
+    """
+
+    def __init__(self, fileName, rate, getTime):
+        with open(fileName) as replayFile:
+            self.lines = replayFile.readlines()
+        self.rate = rate
+        self.getTime = getTime
+        self.start = None
+        self.next = 0  # next line to play
+
+    def read(self):
+        now = self.getTime()
+        if self.start is None:
+            self.start = now
+        due = min(len(self.lines), int((now - self.start) * self.rate) + 1)
+        samples = [(self.start + n / self.rate, self.lines[n]) for n in range(self.next, due)]
+        self.next = due
+        if not samples:
+            time.sleep(min(0.1, 1.0 / self.rate))
+        return samples
+
+    def close(self):
+        pass
+
+
+def open_source(description, getTime):
+    """A source from its description, e.g. 'serial:COM3:9600' (see the top of this file)"""
+    kind, _, details = description.partition(':')
+    if kind == 'serial':
+        port, _, baudrate = details.rpartition(':')
+        if not port:
+            return SerialSource(details)
+        return SerialSource(port, int(baudrate))
+    if kind == 'socket':
+        host, _, port = details.rpartition(':')
+        return SocketSource(host or '127.0.0.1', int(port))
+    if kind == 'replay':
+        fileName, _, rate = details.rpartition(':')
+        return ReplaySource(fileName, float(rate), getTime)
+    raise ValueError('unknown physio source: ' + description)
+
+
+################
+#  RING BUFFER #
+################
+
+class RingBuffer(object):
+    """
+    The last capacity samples as rows of (time, channel values...), in preallocated memory. One thread writes,
+    any number read; samples are numbered from 0 in the order they arrived, so a reader can ask for everything since
+    the last sample it saw
+    """
+
+    def __init__(self, capacity, channels):
+        self.capacity = capacity
+        self.data = np.zeros((capacity, 1 + channels))
+        self.written = 0  # samples written since the start
+        self._lock = threading.Lock()
+
+    def append(self, rows):
+        rows = np.asarray(rows, dtype=float)
+        arrived = len(rows)
+        if arrived > self.capacity:
+            rows = rows[-self.capacity:]
+        with self._lock:
+            start = (self.written + arrived - len(rows)) % self.capacity
+            end = start + len(rows)
+            if end <= self.capacity:
+                self.data[start:end] = rows
+            else:
+                split = self.capacity - start
+                self.data[start:] = rows[:split]
+                self.data[:end - self.capacity] = rows[split:]
+            self.written += arrived
+
+    def since(self, index):
+        """
+        Copy of the samples from number index on, the number to ask for next time, and how many samples had already
+        been overwritten
+        """
+        with self._lock:
+            written = self.written
+            first = max(index, written - self.capacity)
+            positions = np.arange(first, written) % self.capacity
+            return self.data[positions], written, first - index
+
+    def latest(self, n):
+        """Copy of the last n samples (fewer at the start)"""
+        rows, written, lost = self.since(max(0, self.written - n))
+        return rows
+
+
+#############
+#  RECORDER #
+#############
+
+class PhysioRecorder(object):
+    """
+    Reads a source into a ring buffer on one thread and writes it to fileName on another.
+    channels = names of the signals, in the order they come on each line (e.g. ['CO2', 'O2'])
+    getTime = the raw timer to stamp samples on, the one core.Clock counts from (psychopy.clock.getTime)
+    Call align(globalClock) once the clock is reset at the trigger: samples are written from then on, with their
+    times on that clock (the ones already in the buffer included)
+    """
+
+    def __init__(self, source, channels, getTime, fileName, capacity=DEFAULT_CAPACITY,
+                 chunkInterval=CHUNK_INTERVAL):
+        self.source = source
+        self.channels = list(channels)
+        self.getTime = getTime
+        self.fileName = fileName
+        self.buffer = RingBuffer(capacity, len(self.channels))
+        self.chunkInterval = chunkInterval
+        self.offset = None  # getTime at the clock's reset, once aligned
+        self.skipped = 0  # lines that were not samples
+        self.lost = 0  # samples overwritten before they were written to disk
+        self._written = 0  # next sample to write to disk
+        self._running = False
+        self._threads = []
+        self._file = None
+
+    def start(self):
+        self._file = open(self.fileName, 'w')
+        self._file.write('\t'.join(['time'] + self.channels) + '\n')
+        self._running = True
+        for target, name in [(self._acquire, 'PhysioAcquire'), (self._write, 'PhysioWrite')]:
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True  # never keeps the experiment from closing
+            thread.start()
+            self._threads.append(thread)
+
+    def align(self, clock):
+        """Put the saved times on clock (a core.Clock, e.g. globalClock reset at the trigger)"""
+        self.offset = clock.getLastResetTime()
+
+    def clock_times(self, stamps):
+        """Times on the aligned clock of samples stamped on getTime"""
+        return stamps - (self.offset or 0.0)
+
+    def _acquire(self):
+        while self._running:
+            self._store(self.source.read())
+
+    def _store(self, samples):
+        rows = []
+        now = self.getTime()
+        for t, line in samples:
+            values = parse_line(line, len(self.channels))
+            if values is None:
+                self.skipped += 1
+                continue
+            rows.append([now if t is None else t] + values)
+        if rows:
+            self.buffer.append(rows)
+
+    def _write(self):
+        while self._running:
+            time.sleep(self.chunkInterval)
+            if self.offset is not None:
+                self.flush()
+
+    def flush(self):
+        """Write the samples that arrived since the last write"""
+        rows, self._written, lost = self.buffer.since(self._written)
+        self.lost += lost
+        if len(rows):
+            rows[:, 0] = self.clock_times(rows[:, 0])
+            line = '\t'.join(['%.6f'] + ['%.6g'] * len(self.channels)) + '\n'
+            self._file.write((line * len(rows)) % tuple(rows.ravel()))
+            self._file.flush()
+
+    def stop(self):
+        """Stop reading, write what is left and close the file"""
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._store(self.source.read())  # anything that came in since the last read
+        self.source.close()
+        if self.offset is None:
+            self._file.write('# never aligned to the trigger: times are psychopy.clock.getTime\n')
+        self.flush()
+        self._file.write('# %i samples, %i lost (ring buffer full), %i lines skipped\n'
+                         % (self.buffer.written, self.lost, self.skipped))
+        self._file.close()
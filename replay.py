@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Replay
+
+Shows what the participant saw during a run, from its frame log (_frames.bin and _frames.json, see frame_log.py),
+without PsychoPy, a display or the scanner PC - it draws with Pillow, so it runs on any headless machine.
+Each distinct screen (phase, text and countdown) is drawn once and reused, so a 15-minute run replays in seconds:
+
+    python replay.py data/P01_Breath_Hold.py_2026_Oct_18_1200_frames.bin --strip strip.png --every 5
+    python replay.py data/P01_Breath_Hold.py_2026_Oct_18_1200_frames.bin --frames replay_frames --trial 2
+
+--strip saves one image of the screen every few seconds, side by side with their times; add --physio with the
+run's _physio.tsv to plot the CO2 trace under it, the phases shaded behind it. --frames saves the screen every time
+it changed, as numbered images listed in index.tsv with their flip times, how long each stayed up, trials and
+phases.
+
+"""
+
+from __future__ import absolute_import, division
+import argparse
+import os
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+import frame_log  # reads the saved frame log
+
+# used when a frame log does not say how the screen looked (saved before replay existed)
+DEFAULT_DISPLAY = {'size': [1440, 900], 'color': [0, 0, 0], 'styles': {}}
+DEFAULT_STYLE = {'pos': [0, 0], 'height': 0.5, 'color': 'white'}
+DEFAULT_COUNTDOWN = {'pos': [0, -0.3], 'height': 0.2, 'color': 'yellow'}
+FONTS = ['arial.ttf', 'Arial.ttf', 'LiberationSans-Regular.ttf', 'DejaVuSans.ttf']  # the first one found is used
+PHASE_COLOURS = [(230, 159, 0), (86, 180, 233), (0, 158, 115), (240, 228, 66), (0, 114, 178), (213, 94, 0),
+                 (204, 121, 167)]  # for shading the phases on the CO2 plot
+
+_fonts = {}  # loaded fonts, by size
+
+
+def font(size):
+    """The replay font at size pixels"""
+    if size not in _fonts:
+        for name in FONTS:
+            try:
+                _fonts[size] = ImageFont.truetype(name, size)
+                break
+            except IOError:
+                continue
+        else:
+            _fonts[size] = ImageFont.load_default()
+    return _fonts[size]
+
+
+def rgb(color):
+    """A PsychoPy colour (a name, or rgb from -1 to 1) as 0-255 RGB"""
+    if isinstance(color, str):
+        return ImageColor.getrgb(color)
+    return tuple(int(round((value + 1) * 127.5)) for value in color[:3])
+
+
+class ScreenRenderer(object):
+    """Draws the screen for a (phase, text, countdown) as PsychoPy would have, at scale times the window size"""
+
+    def __init__(self, display, scale=0.25):
+        self.display = dict(DEFAULT_DISPLAY, **display)
+        self.width = max(1, int(round(self.display['size'][0] * scale)))
+        self.height = max(1, int(round(self.display['size'][1] * scale)))
+        self.background = rgb(self.display['color'])
+        self._screens = {}
+
+    def _text(self, draw, text, style):
+        """Draw text centred on style's pos, with height in norm units (a fraction of half the window height)"""
+        x = (style['pos'][0] + 1) / 2 * self.width
+        y = (1 - style['pos'][1]) / 2 * self.height
+        size = max(1, int(round(style['height'] * self.height / 2)))
+        draw.multiline_text((x, y), text, fill=rgb(style['color']), font=font(size), anchor='mm', align='center')
+
+    def screen(self, phase, text, countdown):
+        """The screen as an image - drawn the first time it is asked for"""
+        key = (phase, text, countdown)
+        if key not in self._screens:
+            image = Image.new('RGB', (self.width, self.height), self.background)
+            draw = ImageDraw.Draw(image)
+            styles = self.display['styles']
+            if phase == 'rest':
+                self._text(draw, text or u'+', dict(DEFAULT_STYLE, **styles.get('fixation', {})))
+            elif text:
+                self._text(draw, text, dict(DEFAULT_STYLE, **styles.get(phase, {})))
+            if countdown:
+                self._text(draw, countdown, dict(DEFAULT_COUNTDOWN, **styles.get('timedisplay', {})))
+            self._screens[key] = image
+        return self._screens[key]
+
+
+def screen_changes(records):
+    """Index of every record that shows something different from the one before it"""
+    if not len(records):
+        return np.array([], dtype=int)
+    content = np.column_stack([records['phase'], records['text'], records['countdown']])
+    changed = np.concatenate([[True], np.any(content[1:] != content[:-1], axis=1)])
+    return np.nonzero(changed)[0]
+
+
+def write_frames(outDir, records, meta, renderer, end):
+    """
+    One image per change of screen, and index.tsv listing them: file, flip time, how long the screen stayed up
+    (the last one until end), frameN, trial, phase
+    """
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    phases, texts = meta['phases'], meta['texts']
+    changes = screen_changes(records)
+    offsets = np.append(records['flip_time'][changes[1:]], end)
+    with open(os.path.join(outDir, 'index.tsv'), 'w') as index:
+        index.write('file\tflip_time\tduration\tframeN\ttrial\tphase\n')
+        for number, (n, offset) in enumerate(zip(changes, offsets)):
+            record = records[n]
+            fileName = 'screen_%05i.png' % number
+            renderer.screen(phases[record['phase']], texts[record['text']],
+                            texts[record['countdown']]).save(os.path.join(outDir, fileName))
+            index.write('%s\t%.6f\t%.6f\t%i\t%i\t%s\n' % (fileName, record['flip_time'],
+                                                          offset - record['flip_time'], record['frameN'],
+                                                          record['trial'], phases[record['phase']]))
+
+
+def read_physio(fileName, channel='CO2'):
+    """Times and values of one channel of a recording saved by physio_stream.PhysioRecorder"""
+    with open(fileName) as physioFile:
+        columns = physioFile.readline().strip().split('\t')
+    values = np.loadtxt(fileName, skiprows=1, comments='#', ndmin=2)
+    return values[:, 0], values[:, columns.index(channel)]
+
+
+def image_strip(records, meta, renderer, end, every=5.0, physio=None, columns=12, plotHeight=200):
+    """
+    The screen every `every` seconds from the first flip until end, in rows of columns images, each labelled with
+    its time. With physio = (times, values), the trace is plotted underneath across the width of the strip, with
+    the phases shaded
+    """
+    phases, texts = meta['phases'], meta['texts']
+    flipTimes = records['flip_time']
+    start = flipTimes[0]
+    sampleTimes = np.arange(start, end, every)
+    shown = np.searchsorted(flipTimes, sampleTimes, side='right') - 1  # record on screen at each sample time
+    labelHeight = max(12, renderer.height // 8)
+    cellHeight = renderer.height + labelHeight
+    nRows = int(np.ceil(len(sampleTimes) / columns))
+    width = columns * renderer.width
+    strip = Image.new('RGB', (width, nRows * cellHeight + (plotHeight if physio is not None else 0)),
+                      (255, 255, 255))
+    draw = ImageDraw.Draw(strip)
+    for n, (t, index) in enumerate(zip(sampleTimes, shown)):
+        record = records[index]
+        x, y = (n % columns) * renderer.width, (n // columns) * cellHeight
+        strip.paste(renderer.screen(phases[record['phase']], texts[record['text']], texts[record['countdown']]),
+                    (x, y))
+        label = '%.1f s' % t
+        if record['trial'] >= 0:
+            label += ' - trial %i' % record['trial']
+        draw.text((x + 2, y + renderer.height + 1), label, fill=(0, 0, 0), font=font(labelHeight - 2))
+
+    if physio is not None:
+        top = nRows * cellHeight
+        times, values = physio
+        inRun = (times >= start) & (times <= end)
+        times, values = times[inRun], values[inRun]
+
+        def to_x(seconds):
+            return (np.asarray(seconds) - start) / max(end - start, 1e-9) * (width - 1)
+
+        # phases shaded behind the trace
+        changes = np.concatenate([[0], np.nonzero(np.diff(records['phase']))[0] + 1, [len(records)]])
+        for first, last in zip(changes[:-1], changes[1:]):
+            colour = PHASE_COLOURS[records['phase'][first] % len(PHASE_COLOURS)]
+            end_x = to_x(flipTimes[last] if last < len(records) else end)
+            draw.rectangle([to_x(flipTimes[first]), top, end_x, top + plotHeight - 1],
+                           fill=tuple(128 + value // 2 for value in colour))
+        if len(values) > 1:
+            low, high = values.min(), values.max()
+            ys = top + (plotHeight - 1) * (1 - (values - low) / max(high - low, 1e-9))
+            draw.line(list(zip(to_x(times).tolist(), ys.tolist())), fill=(0, 0, 0), width=1)
+            draw.text((2, top + 2), 'CO2 %.1f - %.1f' % (low, high), fill=(0, 0, 0), font=font(14))
+    return strip
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('frames', help='the run\'s _frames.bin')
+    parser.add_argument('--strip', help='save an image strip of the run to this file (e.g. strip.png)')
+    parser.add_argument('--every', type=float, default=5.0, help='seconds between images on the strip')
+    parser.add_argument('--columns', type=int, default=12, help='images in each row of the strip')
+    parser.add_argument('--physio', help='the run\'s _physio.tsv, to plot the CO2 trace under the strip')
+    parser.add_argument('--channel', default='CO2', help='channel of the physio file to plot')
+    parser.add_argument('--frames-dir', '--frames', dest='framesDir',
+                        help='save an image every time the screen changed to this folder')
+    parser.add_argument('--trial', type=int, help='only replay this trial (counting from 0)')
+    parser.add_argument('--scale', type=float, default=0.25, help='size of the images, as a fraction of the screen')
+    args = parser.parse_args(argv)
+    if not (args.strip or args.framesDir):
+        parser.error('nothing to do: give --strip and/or --frames')
+
+    records, meta = frame_log.load(args.frames)
+    end = meta.get('endTime')  # when the last screen came down (not saved before replay.py existed)
+    if args.trial is not None:
+        inTrial = np.nonzero(records['trial'] == args.trial)[0]
+        if len(inTrial) and inTrial[-1] + 1 < len(records):
+            end = records['flip_time'][inTrial[-1] + 1]  # the trial ends when the next screen goes up
+        records = records[inTrial]
+    if not len(records):
+        parser.error('no frames to replay')
+    if end is None:
+        end = records['flip_time'][-1] + meta['frameDur']
+    renderer = ScreenRenderer(meta.get('display') or {}, args.scale)
+    if args.framesDir:
+        write_frames(args.framesDir, records, meta, renderer, end)
+    if args.strip:
+        physio = read_physio(args.physio, args.channel) if args.physio else None
+        image_strip(records, meta, renderer, end, args.every, physio, args.columns).save(args.strip)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Scanner Sync
+
+launchScan only waits for the first scanner pulse. This keeps counting the pulses that follow (as read by the
+input listener), logs the arrival time of every volume, and estimates the drift between the scanner and stimulus
+PC clocks with a straight-line fit of pulse time against volume number. Phase onsets can then be re-anchored to
+the volume timeline: over a 15 minute run, a drift of a few hundred ppm is a large fraction of a second.
+Times are in seconds on globalClock.
+
+"""
+
+from __future__ import absolute_import, division
+
+
+class PulseTracker(object):
+    """Arrival times of the scanner pulses of one run, and the fitted volume timeline"""
+
+    def __init__(self, TR, volumes):
+        self.TR = TR  # repetition time set on the scanner
+        self.volumes = volumes  # number of volumes expected
+        self.pulses = []  # (volume, time) - volume counts from 0 at the first pulse, skipping missed pulses
+
+    def add(self, t):
+        """Add one pulse; its volume number comes from the time since the first pulse, so a missed pulse is a gap"""
+        if not self.pulses:
+            self.pulses.append((0, t))
+            return
+        volume = int(round((t - self.pulses[0][1]) / self.TR))
+        if volume > self.pulses[-1][0]:
+            self.pulses.append((volume, t))
+
+    def add_events(self, events):
+        """Add the 'trigger' events drained from the input listener"""
+        for t, name, kind in events:
+            if kind == 'trigger':
+                self.add(t)
+
+    def fit(self):
+        """Least-squares line time = start + measuredTR * volume, or the nominal TR until there are two pulses"""
+        if not self.pulses:
+            return 0.0, self.TR
+        if len(self.pulses) < 2:
+            return self.pulses[0][1], self.TR
+        n = len(self.pulses)
+        meanVolume = sum(volume for volume, t in self.pulses) / n
+        meanTime = sum(t for volume, t in self.pulses) / n
+        covariance = sum((volume - meanVolume) * (t - meanTime) for volume, t in self.pulses)
+        variance = sum((volume - meanVolume) ** 2 for volume, t in self.pulses)
+        measuredTR = covariance / variance
+        return meanTime - measuredTR * meanVolume, measuredTR
+
+    def drift_ppm(self):
+        """How much faster (positive) the PC clock runs than the scanner's, in parts per million"""
+        start, measuredTR = self.fit()
+        return (measuredTR / self.TR - 1) * 1e6
+
+    def total_drift(self):
+        """PC clock time gained on the scanner between the first and last pulse, in seconds"""
+        start, measuredTR = self.fit()
+        if not self.pulses:
+            return 0.0
+        return (measuredTR - self.TR) * self.pulses[-1][0]
+
+    def to_volume(self, t):
+        """Fractional volume number at a globalClock time"""
+        start, measuredTR = self.fit()
+        return (t - start) / measuredTR
+
+    def to_scanner_time(self, t):
+        """A globalClock time as seconds on the scanner's timeline (volume number x TR since the first pulse)"""
+        return self.to_volume(t) * self.TR
+
+    def missed(self):
+        """Number of pulses missing between the first and the last one received"""
+        if not self.pulses:
+            return 0
+        return self.pulses[-1][0] + 1 - len(self.pulses)
+
+    def save(self, fileName):
+        """One line per pulse: volume, arrival time, interval since the previous pulse, residual from the fit"""
+        start, measuredTR = self.fit()
+        with open(fileName, 'w') as volumeFile:
+            volumeFile.write('volume\ttime\tinterval\tresidual\n')
+            previous = None
+            for volume, t in self.pulses:
+                if previous is None:
+                    interval = ''
+                else:
+                    interval = '%.6f' % (t - previous)
+                volumeFile.write('%i\t%.6f\t%s\t%.6f\n' % (volume, t, interval, t - (start + measuredTR * volume)))
+                previous = t
+            volumeFile.write('# TR = %.6f s, measured TR = %.9f s, drift = %.1f ppm (%.6f s over the run), '
+                             '%i of %i volumes received, %i missed\n'
+                             % (self.TR, measuredTR, self.drift_ppm(), self.total_drift(), len(self.pulses),
+                                self.volumes, self.missed()))
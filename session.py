@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Session
+
+Runs a queue of task scripts (e.g. Fixation, Breath_Hold, Cued_Deep_Breathing) one after another in one process:
+one full-screen Window with its frame rate measured once, one pool of stimuli and one log file for the whole
+session, and the usual data files for each task. Nothing is set up again between tasks, and the screen never drops
+out of full-screen in front of the participant.
+Each task takes its parameters from the CHANGE PARAMETERS section of its own script.
+
+"""
+
+from __future__ import absolute_import, division
+import os
+import sys
+import engine  # runs each task on the shared window
+import startup  # command line / config file launch and cached frame rate
+import task_protocol  # reads each task script and fills in its protocol
+
+
+def load_session(taskScripts, scriptDir, overrides):
+    """
+    (expName, protocol, parameters) of every task, in order. A name=value override changes that parameter in every
+    task that uses it, and has to be used by at least one
+    """
+    tasks = []
+    used = set()
+    for taskScript in taskScripts:
+        namespace = task_protocol.read_task(os.path.join(scriptDir, taskScript))
+        protocol, parameters = task_protocol.load_task(namespace, os.path.join(scriptDir, 'protocols',
+                                                                               namespace['protocolName']))
+        protocolNames = task_protocol.protocol_parameters(protocol)
+        taskOverrides = dict((name, value) for name, value in overrides.items()
+                             if name in parameters or name in protocolNames)
+        startup.apply_parameters(parameters, taskOverrides, protocolNames)
+        used.update(taskOverrides)
+        tasks.append((taskScript, task_protocol.resolve(protocol, parameters), parameters))
+    for name in overrides:
+        if name not in used:
+            raise ValueError('unknown parameter: ' + name)
+    return tasks
+
+
+def run_session(namespace):
+    """
+    Run a session script: namespace is the script's globals(), with the task scripts to run in 'tasks', and
+    'simulate' and 'dashboard_port' for every task (the tasks' own settings for these are ignored)
+    """
+    launchOptions = startup.parse_args(sys.argv[1:], description=namespace.get('__doc__'))
+    scriptDir = os.path.dirname(os.path.abspath(namespace['__file__']))
+    settings = {'simulate': namespace.get('simulate', False), 'dashboard_port': namespace.get('dashboard_port', 0)}
+    overrides = dict(launchOptions.parameters)
+    for name in settings:
+        if name in overrides:
+            startup.apply_parameters(settings, {name: overrides.pop(name)})
+    tasks = load_session(namespace['tasks'], scriptDir, overrides)
+
+    from psychopy import data, logging
+    psy = engine.Modules(simulate=settings['simulate'])
+    errors = []
+    for expName, protocol, parameters in tasks:
+        errors.extend(expName + ': ' + error for error in task_protocol.check_protocol(protocol))
+    if errors:
+        for error in errors:
+            print('** WARNING: ' + error)
+        psy.core.quit()
+
+    # Define Paths & Data Saving
+    os.chdir(scriptDir)  # to ensure relative paths start from the same directory
+
+    expInfo = {'Participant': '', 'Session': '001'}
+    expInfo.update(launchOptions.info)
+    if any(protocol.get('dialog', True) for expName, protocol, parameters in tasks) and not expInfo['Participant']:
+        if not psy.ask(expInfo, 'Session'):
+            psy.core.quit()  # user pressed cancel
+    expInfo['date'] = data.getDateStr()  # add a simple timestamp
+
+    # one log file for the whole session
+    dataDir = scriptDir + os.sep + u'data'
+    if not os.path.isdir(dataDir):  # not there on a fresh checkout
+        os.makedirs(dataDir)
+    logging.LogFile(dataDir + os.sep + u'%s_session_%s.log' % (expInfo['Participant'], expInfo['date']),
+                    level=logging.EXP)
+    logging.console.setLevel(logging.WARNING)  # this outputs to the screen, not a file
+
+    win, frameRate, frameDur = engine.open_window(psy, engine.frame_rate_profiles(psy, scriptDir),
+                                                  launchOptions.remeasure)
+    glyphs = engine.new_glyph_cache(psy, win, scriptDir)
+    if settings['dashboard_port']:
+        import dashboard  # shows the session to the operator, from another process
+        publisher = dashboard.Publisher(settings['dashboard_port'])
+    else:
+        publisher = None
+
+    try:
+        for expName, protocol, parameters in tasks:
+            logging.exp('session: starting ' + expName)
+            thisExp, filename = engine.new_experiment(dict(expInfo, date=data.getDateStr()), expName, scriptDir)
+            engine.add_parameters(thisExp, parameters)
+            thisExp.extraInfo['frameRate'] = frameRate
+
+            try:
+                completed, frameLog = engine.run_task(psy, win, frameDur, protocol, thisExp, filename, glyphs,
+                                                      publisher)
+            finally:
+                engine.save_experiment(thisExp, filename)  # whatever was collected, however the task ended
+            if not completed:
+                logging.exp('session: %s aborted with the end experiment key, no more tasks are run' % expName)
+                break
+    finally:
+        # Close everything
+        if publisher is not None:
+            publisher.close()
+        win.close()
+    psy.core.quit()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Simulation
+
+Stand-ins for the parts of PsychoPy that need a display, a participant or a scanner (gui, visual, core, event and
+launchScan), all running on one virtual clock. With simulate = True a task script runs its real logic headless and
+much faster than real time: every flip moves the virtual clock on to the next frame, waits jump straight to their
+deadline, and keys and the scanner trigger come from a script instead of the keyboard.
+PsychoPy's data and logging modules are still used for real, so the same data and log files are written.
+
+"""
+
+from __future__ import absolute_import, division
+import math
+import random
+import sys
+
+# what a simulated run presses by default: start past the instructions straight away
+DEFAULT_KEYS = [(0.0, 'space')]
+UPTIME = 3 * 24 * 3600.0  # seconds the simulated computer has been on when PsychoPy is loaded
+
+
+class VirtualClock(object):
+    """
+    The one clock every simulated component reads - time only moves when something waits or flips.
+    now is the raw timer core.Clock counts from (psychopy.clock.getTime), which has been running since the computer
+    started; core.getTime counts from when PsychoPy was loaded (at loaded), so the two differ by the uptime, as in
+    PsychoPy
+    """
+
+    def __init__(self, uptime=UPTIME):
+        self.now = uptime
+        self.loaded = uptime
+
+    def getTime(self):
+        return self.now
+
+    def advance_to(self, t):
+        if t > self.now:
+            self.now = t
+
+
+class Clock(object):
+    """core.Clock on the virtual clock"""
+
+    def __init__(self, virtualClock):
+        self._virtual = virtualClock
+        self._timeAtLastReset = virtualClock.now
+
+    def getTime(self):
+        return self._virtual.now - self._timeAtLastReset
+
+    def getLastResetTime(self):
+        return self._timeAtLastReset
+
+    def reset(self, newT=0.0):
+        self._timeAtLastReset = self._virtual.now + newT
+
+    def add(self, t):
+        self._timeAtLastReset += t
+
+
+class MonotonicClock(Clock):
+    """core.monotonicClock on the virtual clock: reset when PsychoPy was loaded, it is what core.getTime reads"""
+
+    def __init__(self, virtualClock):
+        Clock.__init__(self, virtualClock)
+        self._timeAtLastReset = virtualClock.loaded
+
+
+class CountdownTimer(Clock):
+    """core.CountdownTimer on the virtual clock"""
+
+    def __init__(self, virtualClock, start=0):
+        Clock.__init__(self, virtualClock)
+        if start:
+            self.add(start)
+
+    def getTime(self):
+        return self._timeAtLastReset - self._virtual.now
+
+
+class NullWindow(object):
+    """
+    visual.Window that draws nothing - flip() waits (virtually) for the next vsync and records the interval.
+    To look like a real display: flipJitter = flips return up to this many seconds after their vsync, and
+    dropRate = chance that a flip misses its vsync and lands on the next one (both drawn from rng)
+    """
+
+    def __init__(self, virtualClock, frameRate, size=(1440, 900), units='norm', color=(0, 0, 0), flipJitter=0.0,
+                 dropRate=0.0, rng=None, **kwargs):
+        self._virtual = virtualClock
+        self.frameRate = frameRate
+        self.monitorFramePeriod = 1.0 / frameRate
+        self.flipJitter = flipJitter
+        self.dropRate = dropRate
+        self.rng = rng or random.Random()
+        self.nDropped = 0  # vsyncs missed on purpose
+        self.size = size
+        self.units = units
+        self.color = list(color)
+        self._recording = False
+        self._justTurnedOn = False
+        self.frameIntervals = []
+        self.lastFrameT = None
+        self.frameN = 0  # number of flips so far
+        self._toCall = []
+
+    @property
+    def recordFrameIntervals(self):
+        return self._recording
+
+    @recordFrameIntervals.setter
+    def recordFrameIntervals(self, value):
+        # as in PsychoPy, the interval up to the first flip after recording is turned back on is not kept
+        self._justTurnedOn = bool(value) and not self._recording
+        self._recording = bool(value)
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return self.frameRate
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._toCall.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True):
+        """Move the virtual clock on to the next vsync and return the flip time"""
+        frameDur = self.monitorFramePeriod
+        vsync = math.floor(self._virtual.now / frameDur + 1e-6) + 1
+        if self.dropRate and self.rng.random() < self.dropRate:
+            vsync += 1
+            self.nDropped += 1
+        self._virtual.advance_to(vsync * frameDur)
+        if self.flipJitter:
+            self._virtual.advance_to(self._virtual.now + self.rng.uniform(0, self.flipJitter))
+        now = self._virtual.now
+        if self._recording and self.lastFrameT is not None and not self._justTurnedOn:
+            self.frameIntervals.append(now - self.lastFrameT)
+        self._justTurnedOn = False
+        self.lastFrameT = now
+        self.frameN += 1
+        for function, args, kwargs in self._toCall:
+            function(*args, **kwargs)
+        self._toCall = []
+        return now
+
+    def clearBuffer(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullStim(object):
+    """visual.TextStim (or any other stimulus) that keeps its attributes but draws nothing"""
+
+    def __init__(self, win=None, **kwargs):
+        self.win = win
+        self.text = ''
+        self.autoDraw = False
+        self.status = None
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def draw(self, win=None):
+        pass
+
+    def setAutoDraw(self, value):
+        self.autoDraw = value
+
+
+class KeyPress(str):
+    """A scripted key press: a key name (so it compares like event.getKeys results) with the time it was pressed"""
+
+    def __new__(cls, name, tDown):
+        key = str.__new__(cls, name)
+        key.name = name
+        key.tDown = tDown
+        return key
+
+
+class ScriptedInput(object):
+    """
+    Key presses and scanner triggers read from a script of (time on the raw timer, key name) - timestamped presses
+    are given on core.getTime, as psychopy.event gives them
+    """
+
+    def __init__(self, virtualClock, keys):
+        self._virtual = virtualClock
+        self.pending = sorted([KeyPress(str(name), float(t)) for t, name in keys], key=lambda key: key.tDown)
+
+    def _take(self, keyList, until):
+        """Remove and return keys pressed up to time until (unwanted keys are discarded, as PsychoPy does)"""
+        taken = []
+        while self.pending and self.pending[0].tDown <= until:
+            key = self.pending.pop(0)
+            if keyList is None or key.name in keyList:
+                taken.append(key)
+        return taken
+
+    def next_key(self, keyList):
+        """The next scripted press of one of keyList, or None"""
+        for key in self.pending:
+            if keyList is None or key.name in keyList:
+                return key
+        return None
+
+    def getKeys(self, keyList=None, timeStamped=False):
+        keys = self._take(keyList, self._virtual.now)
+        if timeStamped:
+            return [(key.name, key.tDown - self._virtual.loaded) for key in keys]
+        return [key.name for key in keys]
+
+    def waitKeys(self, maxWait=float('inf'), keyList=None, timeStamped=False):
+        """Jump to the next wanted key press, or to maxWait if there is none before then"""
+        deadline = self._virtual.now + maxWait
+        key = self.next_key(keyList)
+        if key is None or key.tDown > deadline:
+            self._take(keyList, deadline)
+            self._virtual.advance_to(deadline)
+            return None
+        self._virtual.advance_to(key.tDown)
+        keys = self._take(keyList, key.tDown)
+        if timeStamped:
+            return [(pressed.name, pressed.tDown - self._virtual.loaded) for pressed in keys]
+        return [pressed.name for pressed in keys]
+
+    def clearEvents(self, eventType=None):
+        self._take(None, self._virtual.now)
+
+
+class ScriptedKeyboard(object):
+    """hardware.keyboard.Keyboard reading its own copy of the key script (the real one sees every key too)"""
+
+    def __init__(self, scriptedInput):
+        self.input = scriptedInput
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        return self.input._take(keyList, self.input._virtual.now)
+
+    def waitKeys(self, maxWait=float('inf'), keyList=None, waitRelease=True, clear=True):
+        deadline = self.input._virtual.now + maxWait
+        key = self.input.next_key(keyList)
+        if key is None or key.tDown > deadline:
+            self.input._take(keyList, deadline)
+            self.input._virtual.advance_to(deadline)
+            return None
+        self.input._virtual.advance_to(key.tDown)
+        return self.input._take(keyList, key.tDown)
+
+    def clearEvents(self, eventType=None):
+        self.input.clearEvents()
+
+
+class _Namespace(object):
+    """Holds the functions and classes standing in for one PsychoPy module"""
+
+    def __init__(self, **members):
+        self.__dict__.update(members)
+
+
+class _Dialog(object):
+    """gui.DlgFromDict that fills in empty fields and always presses OK"""
+
+    def __init__(self, dictionary, title='', participant='sim', **kwargs):
+        for field in dictionary:
+            if field == 'Participant' and not dictionary[field]:
+                dictionary[field] = participant
+        self.OK = True
+
+
+def _quit():
+    """core.quit(): flush the log file and stop the script"""
+    try:
+        from psychopy import logging
+        logging.flush()
+    except ImportError:
+        pass
+    sys.exit(0)
+
+
+def pulse_script(syncKey, TR, volumes, start=0.0, driftPPM=0.0, jitter=0.0, rng=None):
+    """
+    Key script of a scanner sending syncKey once per volume from time start. driftPPM makes the scanner clock run
+    slow (positive) or fast (negative) compared to the stimulus PC clock. jitter = each pulse after the first
+    arrives up to this many seconds either side of its volume (drawn from rng).
+    """
+    pcTR = TR * (1 + driftPPM * 1e-6)
+    rng = rng or random.Random()
+    return [(start + volume * pcTR + (rng.uniform(-jitter, jitter) if jitter and volume else 0.0), str(syncKey))
+            for volume in range(volumes)]
+
+
+def install(frameRate=60.0, keys=None, triggerDelay=0.0, participant='sim', driftPPM=0.0, flipJitter=0.0,
+            dropRate=0.0, seed=None, pulseJitter=0.0):
+    """
+    Build the stand-ins for a simulated run, and point PsychoPy's log timestamps at the virtual clock.
+    frameRate, flipJitter and dropRate describe the display (see NullWindow); seed makes its jitter and dropped
+    frames the same on every run.
+    keys = script of (time, key name) presses, default DEFAULT_KEYS; the scanner pulses are the sync keys in it, or
+    if the script has none, a pulse every TR for the number of volumes in launchScan's settings, starting
+    triggerDelay seconds after launchScan starts waiting (see pulse_script for driftPPM and pulseJitter).
+    Returns gui, visual, core, event, launchScan - use them in place of PsychoPy's (event.Keyboard stands in for
+    psychopy.hardware.keyboard.Keyboard).
+    """
+    virtualClock = VirtualClock()
+    monotonicClock = MonotonicClock(virtualClock)
+    if keys is None:
+        keys = DEFAULT_KEYS
+    scriptedInput = ScriptedInput(virtualClock, [(virtualClock.now + t, name) for t, name in keys])
+    keyboards = []
+
+    def Keyboard(**kwargs):
+        # sees the keys still to come when it is created, like a keyboard plugged in at that moment
+        keyboard = ScriptedKeyboard(ScriptedInput(virtualClock, [(key.tDown, key.name)
+                                                                 for key in scriptedInput.pending]))
+        keyboards.append(keyboard)
+        return keyboard
+
+    rng = random.Random(seed)
+    try:
+        from psychopy import logging
+        logging.setDefaultClock(monotonicClock)
+    except ImportError:
+        pass
+
+    def launchScan(win, settings, globalClock=None, mode='scan', **kwargs):
+        """Wait (virtually) for the sync key, then reset globalClock - as launchScan does in scan mode"""
+        syncKey = str(settings['sync'])
+        if scriptedInput.next_key([syncKey]) is None:
+            pulses = pulse_script(syncKey, settings['TR'], settings['volumes'], virtualClock.now + triggerDelay,
+                                  driftPPM, pulseJitter, rng)
+            for eachInput in [scriptedInput] + [keyboard.input for keyboard in keyboards]:
+                eachInput.pending.extend(KeyPress(name, t) for t, name in pulses)
+                eachInput.pending.sort(key=lambda key: key.tDown)
+        scriptedInput.waitKeys(keyList=[syncKey])
+        if globalClock is not None:
+            globalClock.reset()
+
+    gui = _Namespace(DlgFromDict=lambda dictionary, title='', **kwargs: _Dialog(dictionary, title, participant))
+    visual = _Namespace(Window=lambda *args, **kwargs: NullWindow(virtualClock, frameRate, flipJitter=flipJitter,
+                                                                  dropRate=dropRate, rng=rng, **kwargs),
+                        TextStim=NullStim, ImageStim=NullStim)
+    core = _Namespace(Clock=lambda: Clock(virtualClock),
+                      CountdownTimer=lambda start=0: CountdownTimer(virtualClock, start),
+                      getTime=monotonicClock.getTime,
+                      monotonicClock=monotonicClock,
+                      wait=lambda secs, hogCPUperiod=0.2: virtualClock.advance_to(virtualClock.now + secs),
+                      quit=_quit,
+                      virtualClock=virtualClock)
+    event = _Namespace(getKeys=scriptedInput.getKeys, waitKeys=scriptedInput.waitKeys,
+                       clearEvents=scriptedInput.clearEvents, scriptedInput=scriptedInput,
+                       Keyboard=Keyboard)  # stands in for psychopy.hardware.keyboard.Keyboard
+    return gui, visual, core, event, launchScan
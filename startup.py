@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Startup
+
+Gets a task running without stopping for input: participant, session and task parameters can come from the
+command line or a config file (so the dialog is skipped), and the monitor frame rate is read from a cached
+per-display profile instead of being measured every run.
+
+    python Breath_Hold.py --participant P01 --session 002 tHold=15 trialnum=3
+    python Breath_Hold.py --config P01_session2.json
+    python Run_Protocol.py --protocol my_design.json --participant P01
+
+A config file is JSON: {"Participant": "P01", "Session": "002", "parameters": {"tHold": 15}}
+Parameters given on the command line win over the config file, which wins over the script's CHANGE PARAMETERS.
+
+"""
+
+from __future__ import absolute_import, division
+from collections import namedtuple
+import argparse
+import json
+import os
+import platform
+import time
+
+# expInfo fields given at launch, task parameters to override, whether to re-measure the frame rate, and the
+# protocol file to run instead of the script's own (or None)
+LaunchOptions = namedtuple('LaunchOptions', ['info', 'parameters', 'remeasure', 'protocol'])
+
+PROFILE_MAX_AGE = 7  # days before a cached frame rate is measured again
+
+
+def parse_args(argv, description=''):
+    """Read the command line (and the config file it names, if any)"""
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--participant', help='participant ID - skips the dialog')
+    parser.add_argument('--session', help='session number')
+    parser.add_argument('--config', help='JSON file with Participant, Session and parameters')
+    parser.add_argument('--remeasure', action='store_true', help='measure the frame rate even if it is cached')
+    parser.add_argument('--protocol', help='protocol file to run (see engine.py)')
+    parser.add_argument('parameters', nargs='*', metavar='name=value', help='task parameter to change')
+    args = parser.parse_args(argv)
+
+    info = {}
+    parameters = {}
+    if args.config:
+        with open(args.config) as configFile:
+            config = json.load(configFile)
+        for field in ['Participant', 'Session']:
+            if field in config:
+                info[field] = str(config[field])
+        parameters.update(config.get('parameters', {}))
+    for item in args.parameters:
+        if '=' not in item:
+            parser.error('parameters must be given as name=value, not ' + item)
+        name, value = item.split('=', 1)
+        parameters[name] = value
+    if args.participant is not None:
+        info['Participant'] = args.participant
+    if args.session is not None:
+        info['Session'] = args.session
+    return LaunchOptions(info, parameters, args.remeasure, args.protocol)
+
+
+def _convert(value, current):
+    """Turn a command line string into the type of the parameter it replaces"""
+    if not isinstance(value, str) or isinstance(current, str):
+        return value
+    if isinstance(current, bool):
+        return value.lower() in ['1', 'true', 'yes']
+    if isinstance(current, int):
+        number = float(value)
+        if number == int(number):
+            return int(number)
+        return number
+    if isinstance(current, float):
+        return float(value)
+    return value
+
+
+def guess_value(value):
+    """Turn a command line string into a number if it reads as one (for parameters with no current value)"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return _convert(value, 0)
+    except ValueError:
+        return value
+
+
+def apply_parameters(namespace, parameters, extraNames=()):
+    """
+    Overwrite task parameters (the script's globals()) - only names the script already defines, or extraNames
+    (parameters a protocol uses that the script does not define)
+    """
+    for name, value in parameters.items():
+        if name in extraNames and name not in namespace:
+            namespace[name] = guess_value(value)
+            continue
+        if name.startswith('_') or not isinstance(namespace.get(name), (int, float, str)):
+            raise ValueError('unknown parameter: ' + name)
+        namespace[name] = _convert(value, namespace[name])
+
+
+def frame_rate(win, profileFile, screen=0, remeasure=False, maxAge=PROFILE_MAX_AGE):
+    """
+    Frame rate of the monitor the window is on: from the profile cached for this computer, screen and resolution
+    if it is less than maxAge days old, otherwise measured (and cached, if the measurement worked - a cache that
+    cannot be written is warned about, and the measured rate used all the same).
+    profileFile = None always measures and caches nothing.
+    """
+    if profileFile is None:
+        return win.getActualFrameRate()
+    key = '%s screen %i %ix%i' % (platform.node(), screen, win.size[0], win.size[1])
+    profiles = {}
+    if os.path.exists(profileFile):
+        with open(profileFile) as cache:
+            profiles = json.load(cache)
+    profile = profiles.get(key)
+    if profile is not None and not remeasure and time.time() - profile['measured'] < maxAge * 24 * 3600:
+        return profile['frameRate']
+
+    measuredRate = win.getActualFrameRate()
+    if measuredRate is not None:
+        profiles[key] = {'frameRate': measuredRate, 'measured': time.time(),
+                         'date': time.strftime('%Y-%m-%d %H:%M')}
+        try:
+            profileDir = os.path.dirname(profileFile)
+            if profileDir and not os.path.isdir(profileDir):  # the data folder is not there on a fresh checkout
+                os.makedirs(profileDir)
+            with open(profileFile, 'w') as cache:
+                json.dump(profiles, cache, indent=1, sort_keys=True)
+        except (IOError, OSError) as error:  # the measured rate still does for this run
+            from psychopy import logging
+            logging.warning('could not cache the frame rate in %s: %s' % (profileFile, error))
+    return measuredRate
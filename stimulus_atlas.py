@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stimulus Atlas
+
+Keeps every text the tasks show - cue words, countdown numbers, the fixation cross and the instructions - already
+rasterised, packed into one image on disk (data/stimulus_atlas.png, indexed by data/stimulus_atlas.json). At start-up
+each text is cut out of the atlas and loaded straight into a texture as an ImageStim, so nothing has to be laid out
+before the instructions screen and the first draw of every stimulus costs the same.
+Each entry is keyed by everything its pixels depend on: text, font, height, wrap width, colour, window size, units
+and background colour, and the PsychoPy version. A text not in the atlas, or one whose key has changed, is laid out
+with TextStim and rasterised once, then added to the atlas for the next launch. Entries no launch has used for
+ENTRY_MAX_AGE days (old cue texts, sizes and colours) are dropped, so the atlas does not keep growing.
+
+"""
+
+from __future__ import absolute_import, division
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+ATLAS_WIDTH = 2048  # pixels - entries are packed in rows (shelves) across this width
+ENTRY_MAX_AGE = 30  # days an entry is kept without being used
+_NOT_IN_KEY = ['pos', 'depth', 'name']  # stimulus arguments that do not change how the text is rasterised
+
+
+def entry_key(text, stimArgs, win, version):
+    """The key of a text's entry: a hash of everything its pixels depend on"""
+    described = dict((name, value) for name, value in stimArgs.items() if name not in _NOT_IN_KEY)
+    described.update(text=text, winSize=list(win.size), winUnits=win.units, winColor=list(np.ravel(win.color)),
+                     version=version)
+    return hashlib.sha1(json.dumps(described, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def ink_colour(color):
+    """A stimulus colour in PsychoPy's rgb colour space (a name, hex, or rgb from -1 to 1) as 0-255 RGB"""
+    if isinstance(color, str):
+        from PIL import ImageColor
+        return np.array(ImageColor.getrgb(color), dtype=int)
+    return np.round((np.asarray(color, dtype=float)[:3] + 1) * 127.5).astype(int)
+
+
+def cut_out(frame, background, ink):
+    """
+    The text on a rasterised frame (height x width x 3 uint8, drawn at the centre on background) as RGBA in its ink
+    colour (0-255 RGB), with alpha taken from how far each pixel is from the background towards the ink. The crop is
+    centred on the middle of the window, so the image goes back at the text's position unchanged
+    """
+    difference = np.abs(frame.astype(int) - background).max(axis=2)
+    rows, columns = np.nonzero(difference)
+    height, width = difference.shape
+    if not len(rows):
+        return np.zeros((2, 2, 4), dtype=np.uint8)  # nothing drawn, e.g. a space
+    halfHeight = max(height // 2 - rows.min(), rows.max() + 1 - height // 2)
+    halfWidth = max(width // 2 - columns.min(), columns.max() + 1 - width // 2)
+    top, left = height // 2 - halfHeight, width // 2 - halfWidth
+    crop = frame[top:top + 2 * halfHeight, left:left + 2 * halfWidth]
+    alpha = difference[top:top + 2 * halfHeight, left:left + 2 * halfWidth]
+    image = np.empty(crop.shape[:2] + (4,), dtype=np.uint8)
+    image[:, :, :3] = ink
+    image[:, :, 3] = np.clip(np.round(alpha * 255.0 / max(np.abs(ink - background).max(), 1)), 0, 255)
+    return image
+
+
+class StimulusAtlas(object):
+    """
+    Rasterised texts on disk (fileStem + '.png' and '.json'), handed out as ImageStims on win.
+    textStim and imageStim = the stimulus classes, i.e. visual.TextStim and visual.ImageStim
+    """
+
+    def __init__(self, win, textStim, imageStim, fileStem):
+        from psychopy import __version__ as version
+        self.win = win
+        self.textStim = textStim
+        self.imageStim = imageStim
+        self.fileStem = fileStem
+        self.version = version
+        self.entries = {}  # key: [x, y, width, height, PsychoPy version, time last used] in the atlas
+        self.atlas = np.zeros((0, ATLAS_WIDTH, 4), dtype=np.uint8)
+        self.loaded = 0  # texts taken from the atlas this launch
+        self.rasterised = 0  # texts laid out and added to it
+        self._shelf = [0, 0, 0]  # where the next entry goes: x, y and height of the current row
+        self._background = None  # colour of a cleared window
+        if os.path.exists(fileStem + '.json') and os.path.exists(fileStem + '.png'):
+            self._load()
+
+    def _load(self):
+        from PIL import Image
+        with open(self.fileStem + '.json') as indexFile:
+            index = json.load(indexFile)
+        atlas = np.asarray(Image.open(self.fileStem + '.png').convert('RGBA'))
+        if atlas.shape[1] != ATLAS_WIDTH:
+            return  # laid out differently: start again
+        self.atlas = atlas.copy()
+        self.entries = index['entries']
+        self._shelf = index['shelf']
+        for entry in self.entries.values():
+            if len(entry) < 6:  # saved before entries were dated
+                entry.append(time.time())
+
+    def stimulus(self, name, text, stimArgs):
+        """An ImageStim of text as TextStim(**stimArgs) would draw it - from the atlas, rasterised if not in it"""
+        from PIL import Image
+        from psychopy.tools.monitorunittools import convertToPix
+        key = entry_key(text, stimArgs, self.win, self.version)
+        if key in self.entries:
+            self.loaded += 1
+            self.entries[key][5] = time.time()
+        else:
+            self._add(key, self._rasterise(text, stimArgs))
+            self.rasterised += 1
+        x, y, width, height = self.entries[key][:4]
+        pos = convertToPix(np.array([0.0, 0.0]), np.array(stimArgs.get('pos', (0, 0)), dtype=float), self.win.units,
+                           self.win)
+        return self.imageStim(win=self.win, name=name, image=Image.fromarray(self.atlas[y:y + height, x:x + width]),
+                              units='pix', pos=pos, size=(width, height), interpolate=False)
+
+    def _read_back(self):
+        """The back buffer as height x width x 3 uint8 (getMovieFrame keeps a copy for a movie, so it is taken back)"""
+        self.win.getMovieFrame(buffer='back')
+        return np.asarray(self.win.movieFrames.pop().convert('RGB'))
+
+    def _rasterise(self, text, stimArgs):
+        """Draw the text at the centre of the back buffer, read it back and cut it out"""
+        stim = self.textStim(win=self.win, text=text, **dict(stimArgs, pos=(0, 0)))
+        self.win.clearBuffer()
+        if self._background is None:
+            self._background = self._read_back()[0, 0].astype(int)
+        stim.draw()
+        frame = self._read_back()
+        self.win.clearBuffer()
+        return cut_out(frame, self._background, ink_colour(stimArgs.get('color', 'white')))
+
+    def _add(self, key, image):
+        height, width = image.shape[:2]
+        width = min(width, ATLAS_WIDTH)
+        x, y, rowHeight = self._shelf
+        if x + width > ATLAS_WIDTH:  # start a new row
+            x, y, rowHeight = 0, y + rowHeight, 0
+        rowHeight = max(rowHeight, height)
+        if y + rowHeight > len(self.atlas):
+            self.atlas = np.vstack([self.atlas, np.zeros((y + rowHeight - len(self.atlas), ATLAS_WIDTH, 4),
+                                                         dtype=np.uint8)])
+        self.atlas[y:y + height, x:x + width] = image[:, :width]
+        self.entries[key] = [x, y, width, height, self.version, time.time()]
+        self._shelf = [x + width, y, rowHeight]
+
+    def save(self, maxAge=ENTRY_MAX_AGE):
+        """
+        Write the atlas back: the index whenever an entry was used (it keeps when each was last used), and the image
+        too if anything was added or dropped - entries of other PsychoPy versions, or not used for maxAge days
+        """
+        from PIL import Image
+        oldest = time.time() - maxAge * 24 * 3600
+        kept = [(key, entry) for key, entry in self.entries.items() if entry[4] == self.version and entry[5] >= oldest]
+        dropped = len(kept) < len(self.entries)
+        if dropped:
+            images = [(key, used, self.atlas[y:y + height, x:x + width].copy())
+                      for key, (x, y, width, height, version, used) in kept]
+            self.entries, self._shelf = {}, [0, 0, 0]
+            self.atlas = np.zeros((0, ATLAS_WIDTH, 4), dtype=np.uint8)
+            for key, used, image in images:
+                self._add(key, image)
+                self.entries[key][5] = used
+        if not (self.loaded or self.rasterised or dropped):
+            return
+        folder = os.path.dirname(self.fileStem)
+        if folder and not os.path.isdir(folder):  # the data folder is not there on a fresh checkout
+            os.makedirs(folder)
+        if self.rasterised or dropped:
+            Image.fromarray(self.atlas).save(self.fileStem + '.png')
+        with open(self.fileStem + '.json', 'w') as indexFile:
+            json.dump({'entries': self.entries, 'shelf': self._shelf}, indexFile)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Task Protocol
+
+Reads a task script's parameters and its protocol file, fills the protocol in and checks it - everything about a
+task that is known before a window opens (the protocol format is described in engine.py). Only the standard library
+is used, so the offline tools (bids_events.py, design_planner.py, end_tidal_analysis.py) read a task without loading
+PsychoPy.
+
+"""
+
+from __future__ import absolute_import, division
+import json
+import runpy
+
+
+def read_task(scriptFile):
+    """The globals() of a task script, without running it (its RUN section only runs as __main__)"""
+    return runpy.run_path(scriptFile, run_name='session_task')
+
+
+def load_protocol(fileName):
+    with open(fileName) as protocolFile:
+        return json.load(protocolFile)
+
+
+def resolve(value, parameters):
+    """Fill every "$name" in a protocol (or part of one) with the parameter of that name"""
+    if isinstance(value, dict):
+        return dict((key, resolve(item, parameters)) for key, item in value.items())
+    if isinstance(value, list):
+        return [resolve(item, parameters) for item in value]
+    if isinstance(value, str) and value.startswith('$'):
+        if value[1:] not in parameters:
+            raise ValueError('the protocol needs a parameter called ' + value[1:])
+        return parameters[value[1:]]
+    return value
+
+
+def protocol_parameters(value):
+    """Names of all the parameters a protocol (or part of one) uses"""
+    if isinstance(value, dict):
+        return set().union(*[protocol_parameters(item) for item in value.values()])
+    if isinstance(value, list):
+        return set().union(*[protocol_parameters(item) for item in value])
+    if isinstance(value, str) and value.startswith('$'):
+        return set([value[1:]])
+    return set()
+
+
+def check_protocol(protocol):
+    """Return a list of errors that stop the protocol being run as designed"""
+    errors = []
+    names = []
+    for phase in protocol.get('phases', []):
+        if phase['name'] in names:
+            errors.append('two phases are called ' + phase['name'])
+        names.append(phase['name'])
+        if phase.get('text') is None:
+            if not phase.get('breathPace'):
+                errors.append('phase ' + phase['name'] + ' needs a text or a breathPace')
+                continue
+            # number of repeats (breath in and out) in the phase - has to be an integer
+            repeats = phase['duration'] / phase['breathPace']
+            if repeats != int(repeats):
+                errors.append(str(repeats) + ' breaths in phase ' + phase['name'] +
+                              ' is not an integer, please change its breathPace')
+    return errors
+
+
+def script_parameters(namespace):
+    """The task parameters a script defines: its public numbers, strings and switches"""
+    return dict((name, value) for name, value in namespace.items()
+                if not name.startswith('_') and isinstance(value, (int, float, str)))
+
+
+def load_task(namespace, protocolFile):
+    """
+    A task's protocol (not yet filled in), and its parameters: the protocol's own defaults, overwritten by the
+    CHANGE PARAMETERS of the script (namespace)
+    """
+    protocol = load_protocol(protocolFile)
+    parameters = dict(protocol.get('parameters', {}))
+    parameters.update(script_parameters(namespace))
+    return protocol, parameters
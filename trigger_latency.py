@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Trigger Latency
+
+Measures how long after the scanner pulse each part of a run reaches the screen: from the trigger pulse to the
+first flip of the rest block and of every trial phase, compared with when the protocol plans it. Runs the real task
+(engine.run_task) many times, with the trigger pulse landing at a different moment each run, on a stand-in scanner
+that sends the sync key every TR with the pulse jitter asked for - no scanner time needed.
+
+    python trigger_latency.py --runs 300 --tr 1 2 --pulse-jitter 0 0.0005
+    python trigger_latency.py --display --runs 20 trialnum=1 tHold=5
+
+By default the runs are simulated (see simulation.py) on a display of --frame-rate Hz with --flip-jitter and
+--drop-rate, in parallel on every core. With --display they run in a real window on this computer, one after
+another in real time, with the pulses sent by a thread on the stimulus PC clock: use it to qualify a new stimulus
+PC. The pulses are sent in software, so the delay of the trigger interface (USB button box, serial port) is not
+included - measure that once with the interface's own tools.
+
+Latency = flip time - (trigger pulse + planned onset): 0 is a phase on screen exactly when the protocol says.
+Saves every onset of every run (trigger_latency.tsv) and the distribution of latencies for each phase - mean, SD,
+percentiles and largest, in ms - for each TR and pulse jitter (trigger_latency_summary.tsv).
+
+"""
+
+from __future__ import absolute_import, division
+from collections import deque
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import numpy as np
+import engine  # runs the task
+import simulation  # the simulated display and scanner, and scripted key presses
+import startup  # turns name=value strings into parameters
+import task_protocol  # reads the task script, and fills in and checks its protocol
+
+SEED = 1
+PERCENTILES = [50, 95, 99]
+_SPIN = 0.002  # seconds before each pulse that the sync generator stops sleeping and watches the clock
+
+
+class SyncGenerator(object):
+    """
+    Stand-in scanner for a real display: sends syncKey every TR (each pulse after the first up to jitter seconds
+    either side of its volume) from a background thread, timestamped on getTime as it is sent, to every
+    PulseKeyboard reading it. Like the sync generator of launchScan's test mode, but the pulses reach the keyboard
+    the task listens to. getTime = the raw timer core.Clock counts from (engine.Modules.getTime), as the keyboard's
+    press times are
+    """
+
+    def __init__(self, syncKey, TR, volumes, getTime, jitter=0.0, rng=None):
+        self.syncKey = str(syncKey)
+        self.TR = TR
+        self.volumes = volumes
+        self.getTime = getTime
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.queues = []  # one per PulseKeyboard
+        self.sent = []  # time of every pulse sent
+        self.first = threading.Event()  # set at the first pulse
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, delay=0.0):
+        """Send the first pulse delay seconds from now, then one every TR"""
+        self._thread = threading.Thread(target=self._send, args=(self.getTime() + delay,), name='SyncGenerator')
+        self._thread.daemon = True  # never keeps the experiment from closing
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _send(self, start):
+        for volume in range(self.volumes):
+            due = start + volume * self.TR
+            if self.jitter and volume:
+                due += self.rng.uniform(-self.jitter, self.jitter)
+            if self._stop.wait(max(due - _SPIN - self.getTime(), 0)):
+                return
+            while self.getTime() < due:
+                pass
+            pulse = simulation.KeyPress(self.syncKey, self.getTime())
+            for queue in self.queues:
+                queue.append(pulse)
+            self.sent.append(pulse.tDown)
+            self.first.set()
+
+    def launch_scan(self, win, settings, globalClock=None, mode='scan', **kwargs):
+        """Stands in for launchScan: start the pulses (delay = kwargs['delay']), wait for the first, reset the clock"""
+        self.start(kwargs.get('delay', 0.0))
+        self.first.wait()
+        if globalClock is not None:
+            globalClock.reset()
+
+
+class PulseKeyboard(object):
+    """
+    hardware.keyboard.Keyboard that also has the pulses of a SyncGenerator pressed on it - on the keyboard's own
+    clock, if it has one, like its key presses
+    """
+
+    def __init__(self, keyboard, generator):
+        self.keyboard = keyboard
+        self.clock = getattr(keyboard, 'clock', None)
+        self.pulses = deque()
+        generator.queues.append(self.pulses)
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        keys = list(self.keyboard.getKeys(keyList=keyList, waitRelease=waitRelease, clear=clear))
+        offset = self.clock.getLastResetTime() if self.clock is not None else 0.0
+        while self.pulses:
+            pulse = self.pulses.popleft()
+            if keyList is None or pulse.name in keyList:
+                keys.append(simulation.KeyPress(pulse.name, pulse.tDown - offset))
+        return keys
+
+    def clearEvents(self, eventType=None):
+        self.keyboard.clearEvents(eventType)
+        self.pulses.clear()
+
+
+def onset_latencies(frameLog, firstPulse):
+    """
+    (trial, phase, planned onset, latency) of the first flip of every phase and rest block, firstPulse being the
+    time of the trigger pulse on the run's globalClock
+    """
+    rows = []
+    for flipTime, frameN, trial, phase in frameLog.onsets():
+        if trial < 0:
+            phase = 'rest start' if frameN < 0 else 'rest end'
+        planned = frameLog.planned_time(frameN)
+        rows.append((trial, phase, planned, flipTime - (firstPulse + planned)))
+    return rows
+
+
+def first_pulse(volumesFile):
+    """Time of the first pulse in a run's _volumes.tsv"""
+    with open(volumesFile) as pulseFile:
+        pulseFile.readline()
+        return float(pulseFile.readline().split('\t')[1])
+
+
+def check_trigger(firstPulse, tolerance=0.1):
+    """
+    Raise an error unless the run read the trigger pulse back (through the keyboard and the task's listener) just
+    before launchScan reset globalClock on it - if not, the pulses are stamped on another clock than key presses
+    """
+    if not -tolerance <= firstPulse <= 0:
+        raise RuntimeError('trigger pulse read at %.6f s on globalClock, which was reset as it came in: the sync '
+                           'generator and the keyboard are not on the same clock' % firstPulse)
+
+
+def run_once(psy, win, frameDur, protocol, workDir, name):
+    """Run a (filled in) protocol once, returning the latency of every onset (see onset_latencies)"""
+    from psychopy import data, logging
+    logging.console.setLevel(logging.ERROR)  # each run's drift warning would bury the results
+    filename = os.path.join(workDir, name)
+    thisExp = data.ExperimentHandler(name=name, version='', extraInfo={}, runtimeInfo=None, originPath=None,
+                                     savePickle=False, saveWideText=False, dataFileName=filename)
+    completed, frameLog = engine.run_task(psy, win, frameDur, protocol, thisExp, filename, quiet=True)
+    thisExp.abort()
+    if not completed:
+        raise KeyboardInterrupt('run aborted')
+    firstPulse = first_pulse(filename + '_volumes.tsv')
+    check_trigger(firstPulse)
+    return onset_latencies(frameLog, firstPulse)
+
+
+def _simulated_run(job):
+    """One run on the virtual clock (in a worker): the trigger pulse lands at a random moment between two vsyncs"""
+    protocol, TR, pulseJitter, frameRate, flipJitter, dropRate, seed, workDir = job
+    rng = random.Random(seed)
+    psy = engine.Modules(simulate=True, frameRate=frameRate, flipJitter=flipJitter, dropRate=dropRate, seed=seed,
+                         pulseJitter=pulseJitter, triggerDelay=rng.uniform(0, TR))
+    win, measuredRate, frameDur = engine.open_window(psy)
+    return run_once(psy, win, frameDur, protocol, workDir, 'run%i' % seed)
+
+
+def simulate(protocol, settings, runs, frameRate=60.0, flipJitter=0.0, dropRate=0.0, processes=None, seed=SEED):
+    """
+    Run protocol runs times for each (TR, pulse jitter) in settings on the virtual clock. Returns
+    {(TR, pulse jitter): [(run, trial, phase, planned onset, latency)]}
+    """
+    workDir = tempfile.mkdtemp(prefix='trigger_latency_')
+    jobs = []
+    for TR, pulseJitter in settings:
+        scanProtocol = dict(protocol, MRinfo=dict(protocol.get('MRinfo', {'sync': 5, 'volumes': 300}), TR=TR))
+        jobs += [(scanProtocol, TR, pulseJitter, frameRate, flipJitter, dropRate, seed + len(jobs) + run, workDir)
+                 for run in range(runs)]
+    pool = multiprocessing.Pool(processes) if processes != 1 else None
+    try:
+        results = pool.imap(_simulated_run, jobs) if pool is not None else map(_simulated_run, jobs)
+        latencies = dict((setting, []) for setting in settings)
+        for number, (job, rows) in enumerate(zip(jobs, results)):
+            latencies[(job[1], job[2])] += [(number % runs,) + row for row in rows]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(workDir, ignore_errors=True)
+    return latencies
+
+
+def measure_display(protocol, settings, runs, seed=SEED):
+    """
+    Run protocol runs times for each (TR, pulse jitter) in settings in a real window on this computer, with the
+    pulses from a SyncGenerator. Returns the same as simulate
+    """
+    psy = engine.Modules()
+    win, measuredRate, frameDur = engine.open_window(psy)
+    workDir = tempfile.mkdtemp(prefix='trigger_latency_')
+    rng = random.Random(seed)
+    realKeyboard = psy.Keyboard
+    latencies = dict((setting, []) for setting in settings)
+    try:
+        for TR, pulseJitter in settings:
+            MRinfo = dict(protocol.get('MRinfo', {'sync': 5, 'volumes': 300}), TR=TR)
+            for run in range(runs):
+                generator = SyncGenerator(MRinfo['sync'], TR, MRinfo['volumes'], psy.getTime, pulseJitter, rng)
+                delay = rng.uniform(0, TR)
+                psy.Keyboard = lambda **kwargs: PulseKeyboard(realKeyboard(**kwargs), generator)
+                psy.launchScan = lambda *args, **kwargs: generator.launch_scan(*args, delay=delay, **kwargs)
+                try:
+                    rows = run_once(psy, win, frameDur, dict(protocol, MRinfo=MRinfo), workDir, 'run%i' % run)
+                finally:
+                    generator.stop()
+                latencies[(TR, pulseJitter)] += [(run,) + row for row in rows]
+                print('TR %g s, pulse jitter %g ms: run %i of %i, trigger to first flip %.2f ms'
+                      % (TR, pulseJitter * 1000, run + 1, runs, rows[0][3] * 1000))
+    finally:
+        win.close()
+        shutil.rmtree(workDir, ignore_errors=True)
+    return latencies
+
+
+def summarise(latencies):
+    """Per (TR, pulse jitter) and phase, in order of first onset: onsets, mean, SD, percentiles and largest (s)"""
+    summary = []
+    for (TR, pulseJitter), rows in sorted(latencies.items()):
+        phases = []
+        byPhase = {}
+        for run, trial, phase, planned, latency in rows:
+            if phase not in byPhase:
+                phases.append(phase)
+                byPhase[phase] = []
+            byPhase[phase].append(latency)
+        for phase in phases + ['all']:
+            values = np.array([row[4] for row in rows] if phase == 'all' else byPhase[phase])
+            summary.append(dict(zip(['p%i' % percentile for percentile in PERCENTILES],
+                                    np.percentile(values, PERCENTILES)),
+                                TR=TR, pulse_jitter=pulseJitter, phase=phase, onsets=len(values),
+                                mean=values.mean(), sd=values.std(), min=values.min(), max=values.max()))
+    return summary
+
+
+def save(fileName, latencies, summary):
+    with open(fileName, 'w') as onsetFile:
+        onsetFile.write('TR\tpulse_jitter_ms\trun\ttrial\tphase\tplanned_onset\tlatency_ms\n')
+        for (TR, pulseJitter), rows in sorted(latencies.items()):
+            for run, trial, phase, planned, latency in rows:
+                onsetFile.write('%g\t%.3f\t%i\t%i\t%s\t%.6f\t%.3f\n' % (TR, pulseJitter * 1000, run, trial, phase,
+                                                                        planned, latency * 1000))
+    statistics = ['mean', 'sd', 'min'] + ['p%i' % percentile for percentile in PERCENTILES] + ['max']
+    with open(os.path.splitext(fileName)[0] + '_summary.tsv', 'w') as summaryFile:
+        summaryFile.write('\t'.join(['TR', 'pulse_jitter_ms', 'phase', 'onsets'] +
+                                    [statistic + '_ms' for statistic in statistics]) + '\n')
+        for row in summary:
+            summaryFile.write('%g\t%.3f\t%s\t%i\t' % (row['TR'], row['pulse_jitter'] * 1000, row['phase'],
+                                                      row['onsets']) +
+                              '\t'.join('%.3f' % (row[statistic] * 1000) for statistic in statistics) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--task', default='Breath_Hold.py', help='task script to run (default: Breath_Hold.py)')
+    parser.add_argument('--runs', type=int, default=200, help='runs for each TR and pulse jitter')
+    parser.add_argument('--tr', type=float, nargs='+', help='TRs in seconds (default: MRinfo of the protocol)')
+    parser.add_argument('--pulse-jitter', type=float, nargs='+', default=[0.0],
+                        help='seconds each pulse may arrive either side of its volume')
+    parser.add_argument('--display', action='store_true', help='run in a real window on this computer')
+    parser.add_argument('--frame-rate', type=float, default=60.0, help='simulated display rate in Hz')
+    parser.add_argument('--flip-jitter', type=float, default=0.0, help='simulated flip jitter in seconds')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='simulated chance of a dropped frame per flip')
+    parser.add_argument('--processes', type=int, help='worker processes for simulated runs (default: one per core)')
+    parser.add_argument('--out', default='trigger_latency.tsv', help='file to save every onset to')
+    parser.add_argument('parameters', nargs='*', metavar='name=value', help='change task parameters')
+    args = parser.parse_args(argv)
+
+    scriptDir = os.path.dirname(os.path.abspath(args.task))
+    namespace = task_protocol.read_task(args.task)
+    protocol, parameters = task_protocol.load_task(namespace, os.path.join(scriptDir, 'protocols',
+                                                                           namespace['protocolName']))
+    changes = {}
+    for item in args.parameters:
+        if '=' not in item:
+            parser.error('parameters must be given as name=value, not ' + item)
+        name, value = item.split('=', 1)
+        changes[name] = value
+    startup.apply_parameters(parameters, changes, task_protocol.protocol_parameters(protocol))
+    protocol = task_protocol.resolve(protocol, parameters)
+    errors = task_protocol.check_protocol(protocol)
+    if errors:
+        parser.error('; '.join(errors))
+    # straight to the trigger, with nothing recorded but the flips
+    protocol = dict(protocol, instructions='', trigger=True, physio={})
+
+    TRs = args.tr or [protocol.get('MRinfo', {'TR': 3})['TR']]
+    settings = list(itertools.product(TRs, args.pulse_jitter))
+    if args.display:
+        latencies = measure_display(protocol, settings, args.runs)
+    else:
+        latencies = simulate(protocol, settings, args.runs, args.frame_rate, args.flip_jitter, args.drop_rate,
+                             args.processes)
+    summary = summarise(latencies)
+    save(args.out, latencies, summary)
+    for row in summary:
+        print('TR %g s, pulse jitter %5.2f ms  %-12s %5i onsets: latency mean %6.2f ms (SD %.2f), median %6.2f, '
+              '95%% %6.2f, 99%% %6.2f, max %6.2f ms'
+              % (row['TR'], row['pulse_jitter'] * 1000, row['phase'], row['onsets'], row['mean'] * 1000,
+                 row['sd'] * 1000, row['p50'] * 1000, row['p95'] * 1000, row['p99'] * 1000, row['max'] * 1000))
+
+
+if __name__ == '__main__':
+    main()